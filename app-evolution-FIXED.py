@@ -5,16 +5,215 @@ BACKEND с динамическими фонами + VIDEO анимация пр
 ИСПРАВЛЕННАЯ ВЕРСИЯ - все работает правильно!
 """
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Request, Response, jsonify, request, send_file
+from werkzeug.routing import BaseConverter
+from werkzeug.security import safe_join
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+import argparse
+import asyncio
+import atexit
+import bisect
+import gzip
+import hashlib
+import http.client
 import json
+import logging
+import logging.handlers
+import mimetypes
 import os
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait
+from contextlib import contextmanager
 from datetime import datetime
+from email.utils import formatdate
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from types import MappingProxyType
+from urllib.parse import parse_qsl, unquote_to_bytes, urlencode, urlsplit
 
-app = Flask(__name__)
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Pillow не обязателен: без него нет WebP/AVIF-вариантов картинок
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # brotli не обязателен: без него страницы сжимаются только gzip
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: процесс всего один, он и считает варианты картинок
+    fcntl = None
+
+# Свой /static: файлы отдаются из памяти, сжатыми и с отпечатком в имени
+app = Flask(__name__, static_folder=None)
 
 # ==================== КОНФИГ ====================
 GAME_STATE_FILE = 'game_state.json'
 
+# Комнаты (классы): /r/<room>/... Маршруты без префикса работают с DEFAULT_ROOM,
+# чьё состояние по-прежнему лежит в GAME_STATE_FILE
+ROOMS_DIR = 'rooms'
+DEFAULT_ROOM = 'main'
+ROOM_ID_PATTERN = r'[A-Za-z0-9_-]{1,64}'
+# Комната без запросов дольше ROOM_IDLE_TTL сек выгружается из памяти
+ROOM_IDLE_TTL = 30 * 60
+ROOM_SWEEP_INTERVAL = 60
+
+# Отложенная запись (group commit): ждём FLUSH_DELAY сек тишины, но не дольше
+# FLUSH_MAX_DELAY, и дописываем все накопленные события журнала одним fsync
+FLUSH_DELAY = 0.1
+FLUSH_MAX_DELAY = 1.0
+# Неудачная запись журнала повторяется через FLUSH_RETRY_DELAY сек, после
+# каждой следующей ошибки - вдвое позже, но не реже FLUSH_RETRY_MAX_DELAY
+FLUSH_RETRY_DELAY = 0.5
+FLUSH_RETRY_MAX_DELAY = 30.0
+
+# Где хранить состояние: 'json' - файлы (снимок + журнал), 'sqlite' - база SQLite (WAL)
+GAME_STORAGE = os.environ.get('GAME_STORAGE', 'json')
+SQLITE_DB_FILE = os.environ.get('GAME_SQLITE_DB', 'game_state.db')
+# Соединений с базой на процесс не больше этого (пул: поток берёт соединение
+# на одну операцию); лишние потоки ждут, пока соединение освободится
+SQLITE_POOL_SIZE = int(os.environ.get('GAME_SQLITE_POOL', '16'))
+
+# Журнал событий <файл состояния>.journal: снимок состояния пишется каждые
+# SNAPSHOT_EVERY событий, журнал крупнее JOURNAL_ROTATE_BYTES уходит в архив
+SNAPSHOT_EVERY = 200
+JOURNAL_ROTATE_BYTES = 1024 * 1024
+
+# Server-Sent Events: пинг раз в SSE_HEARTBEAT сек, чтобы прокси не рвали соединение
+SSE_HEARTBEAT = 15
+SSE_RETRY_MS = 2000
+
+# Long-poll: /api/game?wait=25&since=<version> держит запрос не дольше этого
+LONG_POLL_MAX_WAIT = 30
+
+# POST /api/commands: сколько операций можно прислать одним пакетом
+COMMANDS_MAX = 500
+
+# /api/game/delta: от скольких последних версий комнаты можно прислать
+# только изменения (от более старой - весь ответ)
+DELTA_HISTORY = 64
+
+# История комнаты в памяти: столько последних изменений (кольцевой буфер
+# массивов, ~23 байта на запись); /api/history сжимает её до points точек
+HISTORY_SIZE = 2048
+HISTORY_POINTS = 300
+HISTORY_POINTS_MAX = 2000
+
+# Вклад учеников: award с полем student копит урон ученика; топ - столько мест
+LEADERBOARD_SIZE = 10
+STUDENT_ID_MAX = 64
+
+# Боевой режим (serve): адрес, потоки на процесс, число процессов, сколько
+# секунд держать простаивающее keep-alive соединение и ждать запросы при остановке
+SERVE_HOST = os.environ.get('GAME_HOST', '0.0.0.0')
+SERVE_PORT = int(os.environ.get('GAME_PORT', '5000'))
+SERVE_THREADS = int(os.environ.get('GAME_THREADS', '64'))
+SERVE_WORKERS = int(os.environ.get('GAME_WORKERS', '1'))
+SERVE_KEEPALIVE = float(os.environ.get('GAME_KEEPALIVE', '15'))
+SERVE_GRACE = 10
+# Несколько процессов делят комнаты через SQLite: изменения других
+# процессов подхватываются не реже раза в SHARED_POLL_INTERVAL сек
+SHARED_POLL_INTERVAL = 0.05
+# Свежее состояние комнат процессы публикуют в общей памяти: слотов
+# на столько комнат (остальные - через базу, 0 - без общей памяти),
+# ждущих SSE и long-poll будит проверка раз в 5 мс
+SHARED_MEMORY_ROOMS = int(os.environ.get('GAME_SHM_ROOMS', '1024'))
+SHARED_MEMORY_POLL_INTERVAL = 0.005
+# Слот, который так долго остаётся в записи, брошен умершим процессом:
+# читатели идут в базу, пока слот не перепишут
+SHARED_MEMORY_READ_TIMEOUT = 0.1
+# Пул потоков serve (без --async): SSE и long-poll держат поток всё время
+# соединения, поэтому им отдаётся не больше (1 - SERVE_PUSH_RESERVE) потоков.
+# Сверх этого - 503 с Retry-After, и страницы переходят на обычный опрос
+SERVE_PUSH_RESERVE = 0.25
+SERVE_PUSH_RETRY = 5
+# Асинхронный режим (serve --async): SSE и long-poll живут в цикле событий
+# без своего потока. Ограничения запроса, буфер записи на соединение и
+# сколько секунд клиенту можно не читать поток, прежде чем его отключат
+ASYNC_MAX_HEADER_BYTES = 16 * 1024
+ASYNC_MAX_BODY_BYTES = 1024 * 1024
+ASYNC_WRITE_BUFFER = 64 * 1024
+ASYNC_SLOW_CONSUMER_TIMEOUT = 30
+
+# Кампании: стадии из файлов campaigns/<id>.json, перечитываются без
+# перезапуска (проверка mtime раз в CAMPAIGN_SCAN_INTERVAL сек). Встроенная
+# кампания DEFAULT_CAMPAIGN - это BOSSES, файл с тем же id её заменяет
+CAMPAIGNS_DIR = os.environ.get('GAME_CAMPAIGNS_DIR', 'campaigns')
+CAMPAIGN_SCAN_INTERVAL = 2
+CAMPAIGN_MAX_STAGES = 500
+CAMPAIGN_MAX_BYTES = 1024 * 1024
+DEFAULT_CAMPAIGN = 'ocean'
+
+# Медиа: сколько секунд браузер может не перепроверять файл
+MEDIA_DIR = 'media'
+MEDIA_MAX_AGE = 600
+# Картинки до MEDIA_CACHE_ITEM_BYTES держим в памяти (LRU, всего до MEDIA_CACHE_TOTAL_BYTES)
+MEDIA_CACHE_ITEM_BYTES = 512 * 1024
+MEDIA_CACHE_TOTAL_BYTES = 32 * 1024 * 1024
+# URL с отпечатком (/media/monster2.3fa9c1d2.jpeg) кэшируется браузером на год
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Как часто проверять media/ на изменения (по mtime и размеру)
+MEDIA_SCAN_INTERVAL = 2
+LEVEL_UP_VIDEO = '/media/next_level.mp4'
+# Ученики начинают предзагрузку медиа в случайный момент этого окна (мс)
+ASSET_PREFETCH_WINDOW_MS = 20000
+
+# Уменьшенные WebP/AVIF/JPEG-копии картинок (нужен Pillow), кэш в media/.cache
+IMAGE_VARIANT_DIR = os.path.join(MEDIA_DIR, '.cache')
+IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+IMAGE_VARIANT_QUALITY = {'avif': 50, 'webp': 80, 'jpeg': 82}
+IMAGE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# Варианты считает один процесс (serve --workers), остальные раз в столько
+# секунд проверяют, какие из ожидаемых файлов уже готовы
+IMAGE_VARIANT_COLLECT_INTERVAL = 1
+# За nginx/apache: отдавать файлы через X-Sendfile (MEDIA_X_SENDFILE=1)
+app.config['USE_X_SENDFILE'] = os.environ.get('MEDIA_X_SENDFILE') == '1'
+
+# Страницы: шаблоны в templates/, их CSS/JS в static/ рядом с приложением.
+# Всё собирается и сжимается один раз при старте
+STATIC_DIR = 'static'
+PAGE_GZIP_LEVEL = 9
+PAGE_BROTLI_QUALITY = 11
+
+# Лог: уровень (LOG_LEVEL=DEBUG/INFO/WARNING), очередь к фоновому потоку
+# и сколько последних записей держать в памяти для /api/logs
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = 10000
+LOG_RING_SIZE = 500
+# Выборка: из событий этого типа пишется только каждое N-е
+LOG_SAMPLING = {
+    'sse.connect': 5,
+}
+# Не больше N записей за период (сек); остальные только считаются
+LOG_RATE_LIMITS = {
+    'game.poll': (1, 1.0),  # сотни опросов в секунду -> одна строка со счётчиком
+    'http': (20, 1.0),
+    'media.missing': (5, 1.0),
+}
+
+# /metrics в формате Prometheus; METRICS=0 отключает замеры запросов
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+# Корзины времени ответа (сек): от попадания в кэш до long-poll
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
 BOSSES = {
     1: {
         'name': 'Кракен',
@@ -66,830 +265,4028 @@ BOSSES = {
     },
 }
 
-def create_media_directory():
-    """Создать директорию для медиа-файлов если её нет"""
-    if not os.path.exists('media'):
-        os.makedirs('media')
+# ==================== ЛОГИРОВАНИЕ ====================
+# Обработчики зовут log_event(): запись только кладётся в очередь, а
+# форматирует и печатает её фоновый поток, так что медленный stdout не
+# тормозит запросы. Частые события прореживаются ещё до очереди.
 
-def load_game_state():
-    """Загрузить состояние игры из файла"""
-    if os.path.exists(GAME_STATE_FILE):
+log = logging.getLogger('monster')
+
+class EventPolicy(logging.Filter):
+    """Выборка и ограничение частоты по типу события (record.event)"""
+    
+    def __init__(self, sampling, rate_limits):
+        super().__init__()
+        self.sampling = sampling
+        self.rate_limits = rate_limits
+        self._seen = {}     # event -> сколько записей пришло (для выборки)
+        self._windows = {}  # event -> [начало окна, записано в окне, пропущено]
+        self._lock = threading.Lock()
+    
+    def filter(self, record):
+        if not hasattr(record, 'event'):
+            # Чужие логгеры: журнал запросов werkzeug и прочее
+            record.event = 'http' if record.name == 'werkzeug' else record.name
+            record.room = None
+        event = record.event
+        every = self.sampling.get(event)
+        limit = self.rate_limits.get(event)
+        if every is None and limit is None:
+            return True
+        
+        with self._lock:
+            if every is not None:
+                seen = self._seen.get(event, 0)
+                self._seen[event] = seen + 1
+                if seen % every:
+                    return False
+            if limit is not None:
+                count, period = limit
+                now = record.created
+                window = self._windows.get(event)
+                if window is None or now - window[0] >= period:
+                    dropped = window[2] if window is not None else 0
+                    self._windows[event] = [now, 1, 0]
+                    if dropped:
+                        record.msg = f"{record.msg} (+{dropped} похожих пропущено)"
+                elif window[1] < count:
+                    window[1] += 1
+                else:
+                    window[2] += 1
+                    return False
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование - в фоновом потоке"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        return record
+    
+    def enqueue(self, record):
         try:
-            with open(GAME_STATE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Лучше потерять строку лога, чем заблокировать запрос
+            self.dropped += 1
+
+class LogRingBuffer(logging.Handler):
+    """Последние записи лога в памяти для панели учителя"""
     
-    return {
-        'level': 1,
-        'current_hp': BOSSES[1]['max_hp'],
-        'max_hp': BOSSES[1]['max_hp'],
-        'last_updated': datetime.now().isoformat()
-    }
+    def __init__(self, capacity=LOG_RING_SIZE):
+        super().__init__()
+        self._items = deque(maxlen=capacity)
+        self._seq = 0
+    
+    def emit(self, record):
+        with self.lock:
+            self._seq += 1
+            self._items.append({
+                'seq': self._seq,
+                't': round(record.created, 3),
+                'level': record.levelname,
+                'event': record.event,
+                'room': record.room,
+                'message': record.getMessage(),
+            })
+    
+    def since(self, seq=0, room=None, limit=LOG_RING_SIZE):
+        """Записи новее seq; room - только эта комната и общие записи"""
+        with self.lock:
+            items = [item for item in self._items
+                     if item['seq'] > seq and (room is None or item['room'] in (room, None))]
+            last_seq = self._seq
+        return items[-limit:], last_seq
 
-def save_game_state(state):
-    """Сохранить состояние игры в файл"""
-    try:
-        with open(GAME_STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"❌ Ошибка сохранения: {e}")
+def log_event(level, event, msg, *args, room=None, exc_info=False):
+    """Записать событие; аргументы форматируются лениво, в фоновом потоке"""
+    if log.isEnabledFor(level):
+        log.log(level, msg, *args, exc_info=exc_info, extra={'event': event, 'room': room})
 
-def get_boss_info(level):
-    """Получить информацию о боссе по уровню"""
-    # Если уровень > 4, циклируем (5 -> 1, 6 -> 2, и т.д.)
-    boss_level = ((level - 1) % len(BOSSES)) + 1
-    return BOSSES[boss_level]
+def setup_logging():
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(EventPolicy(LOG_SAMPLING, LOG_RATE_LIMITS))
+    for logger in (log, logging.getLogger('werkzeug')):
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+    
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(message)s', '%H:%M:%S'))
+    ring = LogRingBuffer()
+    listener = logging.handlers.QueueListener(log_queue, console, ring)
+    listener.start()
+    # Зарегистрирован раньше остальных, значит остановится последним и допишет всё
+    atexit.register(listener.stop)
+    return queue_handler, ring
 
-# ==================== API ROUTES ====================
+log_queue_handler, log_ring = setup_logging()
 
-@app.route('/api/game', methods=['GET'])
-def get_game_state():
-    """Получить текущее состояние игры"""
-    state = load_game_state()
-    boss_info = get_boss_info(state['level'])
+# ==================== МЕТРИКИ ====================
+# Счётчики в памяти, /metrics отдаёт их в текстовом формате Prometheus.
+# На горячем пути только perf_counter() и пара коротких блокировок.
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value != float('inf') else '+Inf'
+    return str(value)
+
+class MetricValue:
+    """Значение счётчика или датчика; блокировка общая с метрикой"""
     
-    response_data = {
-        'level': state['level'],
-        'hp': state['current_hp'],
-        'max_hp': state['max_hp'],
-        'monster': boss_info['name'],
-        'emoji': boss_info['emoji'],
-        'image': boss_info['image'],
-        'background': {
-            'name': boss_info['background'],
-            'color': boss_info['background_color'],
-            'gradient': boss_info['background_gradient'],
-            'light_intensity': boss_info['light_intensity'],
-            'water_effect': boss_info['water_effect'],
-            'particle_color': boss_info['particle_color'],
-        },
-        'timestamp': state['last_updated']
-    }
+    __slots__ = ('value', 'lock')
     
-    print(f"📊 GET /api/game: Уровень {state['level']}, ХП {state['current_hp']}/{state['max_hp']}")
-    return jsonify(response_data)
+    def __init__(self, lock):
+        self.value = 0
+        self.lock = lock
+    
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+    
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
 
-@app.route('/api/award-points', methods=['POST'])
-def award_points():
-    """Учитель начисляет баллы (урон боссу)"""
-    try:
-        data = request.json or {}
-        amount = int(data.get('amount', 0))
-        
-        state = load_game_state()
-        damage = max(1, amount // 10)  # Минимум 1 урон
-        
-        state['current_hp'] = max(0, state['current_hp'] - damage)
-        state['last_updated'] = datetime.now().isoformat()
-        save_game_state(state)
-        
-        boss_info = get_boss_info(state['level'])
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+    
+    def __init__(self, bounds, lock):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина - +Inf
+        self.sum = 0.0
+        self.lock = lock
+    
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+    
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+class Metric:
+    """Метрика с метками: labels(...) возвращает дочернее значение
+    
+    Несколько метрик могут делить одну блокировку (lock), тогда их можно
+    обновить вместе за одно её взятие.
+    """
+    
+    kind = 'untyped'
+    
+    def __init__(self, name, help_text, labelnames=(), callback=None, lock=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback  # значение считается при сборе (только без меток)
+        self._children = {}
+        self._lock = lock or threading.Lock()
+        self._default = None
+        if not self.labelnames and callback is None:
+            self._default = self.labels()
+    
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+    
+    def _new_child(self):
+        return MetricValue(self._lock)
+    
+    def inc(self, amount=1):
+        self._default.inc(amount)
+    
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, '', self.callback()
+            return
+        with self._lock:
+            values = [(labels, child.value) for labels, child in self._children.items()]
+        for labels, value in sorted(values):
+            yield self.name, format_labels(self.labelnames, labels), value
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def dec(self, amount=1):
+        self._default.dec(amount)
+    
+    @contextmanager
+    def track(self):
+        """Увеличить на время блока"""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=METRICS_LATENCY_BUCKETS, lock=None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, lock=lock)
+    
+    def _new_child(self):
+        return HistogramValue(self.bounds, self._lock)
+    
+    def observe(self, value):
+        self._default.observe(value)
+    
+    def time(self):
+        return self._default.time()
+    
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(child.counts), child.sum) for labels, child in self._children.items()]
+        for labels, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                yield f"{self.name}_bucket", format_labels(self.labelnames, labels, le), cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), cumulative
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+metrics = MetricsRegistry()
+# Метрики запросов обновляются вместе, за одно взятие общей блокировки
+HTTP_METRICS_LOCK = threading.Lock()
+HTTP_REQUESTS = metrics.register(Counter(
+    'http_requests_total', 'HTTP-запросы по обработчику, методу и коду ответа',
+    ('endpoint', 'method', 'status'), lock=HTTP_METRICS_LOCK))
+HTTP_LATENCY = metrics.register(Histogram(
+    'http_request_duration_seconds', 'Время обработки запроса (для SSE - до начала потока)',
+    ('endpoint',), lock=HTTP_METRICS_LOCK))
+HTTP_IN_FLIGHT = metrics.register(Gauge(
+    'http_requests_in_flight', 'Запросы, которые обрабатываются прямо сейчас', lock=HTTP_METRICS_LOCK))
+PERSIST_LATENCY = metrics.register(Histogram(
+    'state_persist_duration_seconds', 'Запись состояния: append журнала, снимок, транзакция flusher-а',
+    ('operation',)))
+PERSIST_ERRORS = metrics.register(Counter(
+    'state_persist_errors_total', 'Неудачные записи журнала и снимков', ('operation',)))
+MEDIA_BYTES = metrics.register(Counter(
+    'media_bytes_served_total', 'Байты тел ответов /media (из памяти или с диска)', ('source',)))
+SSE_SUBSCRIBERS = metrics.register(Gauge(
+    'sse_subscribers', 'Открытые потоки /api/game/stream'))
+LONG_POLL_WAITERS = metrics.register(Gauge(
+    'long_poll_waiters', 'Запросы /api/game?wait=, ждущие изменения'))
+PUSH_REJECTED = metrics.register(Counter(
+    'push_rejected_total', 'SSE и long-poll, отклонённые с 503: заняты все места пула', ('kind',)))
+metrics.register(Gauge('rooms_loaded', 'Комнаты в памяти', callback=lambda: len(rooms)))
+metrics.register(Counter('log_records_dropped_total', 'Записи лога, не влезшие в очередь',
+                         callback=lambda: log_queue_handler.dropped))
+
+class TrackedRequest(Request):
+    """Запрос, который оставляет ссылку на себя в environ для RequestMetrics
+    
+    Flask обнуляет environ['werkzeug.request'] в конце запроса, а обёртке
+    нужен url_rule уже после этого.
+    """
+    
+    def __init__(self, environ, *args, **kwargs):
+        super().__init__(environ, *args, **kwargs)
+        environ['monster.request'] = self
+
+class RequestMetrics:
+    """WSGI-обёртка вокруг приложения: время и исход каждого запроса
+    
+    Берёт всё из environ, без прокси request/g и хуков Flask: так замер
+    стоит пару микросекунд даже на частых опросах /api/game.
+    """
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.in_flight = HTTP_IN_FLIGHT.labels()
+    
+    def __call__(self, environ, start_response):
+        if not METRICS_ENABLED:
+            return self.wsgi_app(environ, start_response)
+        status = '500'
         
-        response_data = {
-            'success': True,
-            'damage': damage,
-            'new_hp': state['current_hp'],
-            'max_hp': state['max_hp'],
-            'boss_dead': state['current_hp'] <= 0,
-            'level': state['level'],
-            'monster': boss_info['name']
-        }
+        def capture_status(status_line, headers, exc_info=None):
+            nonlocal status
+            status = status_line[:3]
+            return start_response(status_line, headers, exc_info)
         
-        print(f"💥 award_points: Урон {damage}, осталось {state['current_hp']} ХП")
-        return jsonify(response_data)
-    except Exception as e:
-        print(f"❌ Ошибка award_points: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 400
+        started = time.perf_counter()
+        with HTTP_METRICS_LOCK:
+            self.in_flight.value += 1
+        try:
+            return self.wsgi_app(environ, capture_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            # pop разрывает цикл environ <-> запрос; url_rule есть, если маршрут нашёлся
+            rule = getattr(environ.pop('monster.request', None), 'url_rule', None)
+            endpoint = rule.endpoint if rule is not None else 'none'
+            requests_value = HTTP_REQUESTS.labels(endpoint, environ['REQUEST_METHOD'], status)
+            latency = HTTP_LATENCY.labels(endpoint)
+            bucket = bisect.bisect_left(latency.bounds, elapsed)
+            with HTTP_METRICS_LOCK:
+                self.in_flight.value -= 1
+                requests_value.value += 1
+                latency.counts[bucket] += 1
+                latency.sum += elapsed
 
-@app.route('/api/level-up', methods=['POST'])
-def level_up():
-    """Переход на новый уровень"""
+app.request_class = TrackedRequest
+app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+def create_media_directory():
+    """Создать директорию для медиа-файлов если её нет"""
+    if not os.path.exists(MEDIA_DIR):
+        os.makedirs(MEDIA_DIR)
+
+def default_game_state(campaign=None):
+    """Начальное состояние игры (уровень 1); campaign - кампания комнаты"""
+    max_hp = get_boss_info(1, campaign)['max_hp']
+    state = {
+        'level': 1,
+        'current_hp': max_hp,
+        'max_hp': max_hp,
+        'version': 0,
+        'last_updated': datetime.now().isoformat()
+    }
+    if campaign is not None:
+        state['campaign'] = campaign
+    return state
+
+def journal_path(path):
+    """Журнал событий рядом с файлом состояния"""
+    return path + '.journal'
+
+def read_snapshot(path):
+    """Прочитать последний снимок состояния"""
     try:
-        state = load_game_state()
-        
-        # ГЛАВНОЕ: Увеличиваем уровень СНАЧАЛА
-        old_level = state['level']
-        state['level'] = old_level + 1
-        
-        # Получаем информацию о новом боссе
-        next_boss = get_boss_info(state['level'])
-        
-        # Обновляем ХП
-        state['current_hp'] = next_boss['max_hp']
-        state['max_hp'] = next_boss['max_hp']
-        state['last_updated'] = datetime.now().isoformat()
-        
-        # ВАЖНО: Сохраняем ВСЕ изменения ПЕРЕД отправкой ответа
-        save_game_state(state)
-        
-        response_data = {
-            'success': True,
-            'old_level': old_level,
-            'new_level': state['level'],
-            'new_boss': next_boss['name'],
-            'emoji': next_boss['emoji'],
-            'image': next_boss['image'],
-            'new_hp': state['current_hp'],
-            'new_max_hp': state['max_hp'],
-            'level_up_video': '/media/next_level.mp4',
-            'background': {
-                'name': next_boss['background'],
-                'color': next_boss['background_color'],
-                'gradient': next_boss['background_gradient'],
-                'light_intensity': next_boss['light_intensity'],
-                'water_effect': next_boss['water_effect'],
-                'particle_color': next_boss['particle_color'],
-            }
-        }
-        
-        print(f"🚀 level_up: Уровень {old_level} → {state['level']}")
-        print(f"📖 Новый босс: {next_boss['name']}")
-        return jsonify(response_data)
-    except Exception as e:
-        print(f"❌ Ошибка level_up: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 400
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        state.setdefault('version', 0)
+        return state
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        # Не затираем молча: откладываем битый файл в сторону для разбора
+        log_event(logging.ERROR, 'storage.error', "❌ Ошибка чтения %s: %s", path, e)
+        try:
+            os.replace(path, path + '.corrupt')
+        except OSError:
+            pass
+    
+    return default_game_state()
 
-@app.route('/api/reset', methods=['POST'])
-def reset_game():
-    """Сбросить игру"""
+def apply_record(state, record):
+    """Повторить событие журнала, если оно новее состояния; True - применено"""
+    if record['v'] <= state['version']:
+        return False
+    func = OPERATIONS.get(record['op'])
+    if func is None:
+        log_event(logging.WARNING, 'journal.unknown_op', "⚠️ Журнал: неизвестная операция %s", record['op'])
+        return False
     try:
-        if os.path.exists(GAME_STATE_FILE):
-            os.remove(GAME_STATE_FILE)
-        
-        state = load_game_state()
-        save_game_state(state)
-        
-        print("♻️  Игра перезагружена")
-        return jsonify({'success': True, 'message': 'Game reset'})
-    except Exception as e:
-        print(f"❌ Ошибка reset: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 400
+        func(state, **record.get('args', {}))
+    except ValueError as e:
+        # Например, кампанию из события уже убрали из каталога: версия
+        # всё равно растёт, иначе следующие события не применятся
+        log_event(logging.WARNING, 'journal.skipped', "⚠️ Журнал: событие v%s (%s) пропущено: %s",
+                  record['v'], record['op'], e)
+    state['version'] = record['v']
+    state['last_updated'] = record['t']
+    return True
 
-# ==================== МЕДИА ROUTES ====================
+def replay_journal(state, path):
+    """Применить к снимку события журнала новее него; вернуть их число"""
+    replayed = 0
+    good_offset = 0
+    try:
+        with open(path, 'r+b') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка после сбоя: отрезаем, иначе следующая
+                    # запись склеится с ней
+                    log_event(logging.WARNING, 'journal.torn', "⚠️ Журнал %s: обрезанная запись удалена", path)
+                    f.truncate(good_offset)
+                    break
+                good_offset += len(line)
+                if apply_record(state, record):
+                    replayed += 1
+    except FileNotFoundError:
+        pass
+    return replayed
 
-@app.route('/media/<filename>', methods=['GET'])
-def serve_media(filename):
-    """Служить медиа-файлы"""
+def append_journal(records, path):
+    """Дописать события в журнал одной записью и одним fsync"""
+    data = ''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in records)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def rotate_journal(path):
+    """Отправить большой журнал в архив (история урока не теряется)"""
     try:
-        file_path = os.path.join('media', filename)
-        if os.path.exists(file_path):
-            return send_file(file_path)
-        else:
-            print(f"⚠️ Файл не найден: {file_path}")
-            return {'error': 'File not found'}, 404
-    except Exception as e:
-        print(f"❌ Ошибка serve_media: {e}")
-        return {'error': str(e)}, 500
+        if os.path.getsize(path) < JOURNAL_ROTATE_BYTES:
+            return
+        os.replace(path, f"{path}.{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    except OSError:
+        pass
 
-# ==================== СТРАНИЦА УЧЕНИКА ====================
+def write_snapshot_file(state, path):
+    """Сохранить снимок состояния (атомарно: временный файл + rename)"""
+    tmp_path = path + '.tmp'
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        log_event(logging.ERROR, 'storage.error', "❌ Ошибка сохранения: %s", e)
+        return False
 
-@app.route('/student')
-def student():
-    return '''
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Портал ученика</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        
-        html, body {
-            font-family: 'Segoe UI', sans-serif;
-            min-height: 100vh;
-            padding: 20px;
-            transition: background 0.8s ease-in-out;
-        }
-        
-        /* Фоны по уровням */
-        body.bg-ocean-deep {
-            background: linear-gradient(135deg, #001a33 0%, #003d5c 50%, #001f3f 100%);
-        }
-        body.bg-ocean-mid {
-            background: linear-gradient(135deg, #0066cc 0%, #0099ff 50%, #004080 100%);
-        }
-        body.bg-ocean-shallow {
-            background: linear-gradient(135deg, #00ccff 0%, #66ffff 50%, #0099ff 100%);
-        }
-        body.bg-volcano {
-            background: linear-gradient(135deg, #660000 0%, #ff3300 30%, #330000 100%);
-        }
-        
-        /* По умолчанию */
-        body {
-            background: linear-gradient(135deg, #001a33 0%, #003d5c 50%, #001f3f 100%);
-        }
-        
-        .container { max-width: 600px; margin: 0 auto; }
-        
-        .header {
-            background: rgba(255, 255, 255, 0.95);
-            backdrop-filter: blur(10px);
-            padding: 20px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            text-align: center;
-        }
-        .header h1 { color: #1e5a96; margin-bottom: 10px; }
-        .header p { color: #666; }
-        
-        .monster-card {
-            background: rgba(255, 224, 178, 0.95);
-            backdrop-filter: blur(10px);
-            padding: 40px;
-            border-radius: 15px;
-            text-align: center;
-            margin-bottom: 20px;
-            box-shadow: 0 10px 40px rgba(0,0,0,0.3);
-            border: 2px solid rgba(255, 255, 255, 0.3);
-        }
-        
-        .monster-image {
-            width: 200px;
-            height: 200px;
-            object-fit: contain;
-            margin: 0 auto 15px;
-            display: block;
-            border-radius: 10px;
-            animation: monsterAppear 0.8s ease-out;
-            filter: drop-shadow(0 4px 8px rgba(0, 0, 0, 0.3));
-        }
-        
-        @keyframes monsterAppear {
-            from { opacity: 0; transform: scale(0.5) translateY(20px); }
-            to { opacity: 1; transform: scale(1) translateY(0); }
-        }
-        
-        .monster-name { font-size: 28px; font-weight: bold; color: #333; margin-bottom: 15px; }
-        .monster-level { font-size: 16px; color: #666; margin-bottom: 20px; }
-        
-        .hp-bar-container {
-            background: rgba(200, 200, 200, 0.5);
-            height: 50px;
-            border-radius: 25px;
-            overflow: hidden;
-            border: 3px solid rgba(0, 0, 0, 0.3);
-        }
-        .hp-bar {
-            height: 100%;
-            background: linear-gradient(90deg, #4caf50 0%, #8bc34a 100%);
-            transition: width 0.6s ease;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            font-weight: bold;
-            font-size: 16px;
-            text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.3);
-        }
-        
-        .status { padding: 15px; background: rgba(255, 255, 255, 0.9); border-radius: 8px; margin-bottom: 20px; display: none; }
-        .status.show { display: block; }
-        
-        /* ВИДЕО НА ВЕСЬ ЭКРАН */
-        .video-overlay {
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background: rgba(0, 0, 0, 0.95);
-            z-index: 2000;
-            align-items: center;
-            justify-content: center;
-        }
-        .video-overlay.show {
-            display: flex;
-            animation: fadeIn 0.3s;
-        }
-        
-        .video-container {
-            width: 90%;
-            max-width: 900px;
-            max-height: 90vh;
-        }
-        
-        .video-container video {
-            width: 100%;
-            height: auto;
-            border-radius: 10px;
-            box-shadow: 0 10px 50px rgba(0, 0, 0, 0.5);
-        }
-        
-        @keyframes fadeIn {
-            from { opacity: 0; }
-            to { opacity: 1; }
-        }
-        
-        .confetti { position: fixed; pointer-events: none; }
-        .water-particle { position: fixed; pointer-events: none; opacity: 0.6; border-radius: 50%; }
-        
-        .back-link {
-            display: inline-block;
-            color: white;
-            text-decoration: none;
-            margin-bottom: 20px;
-            font-weight: bold;
-            text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.5);
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <a href="/" class="back-link">← Назад</a>
-        
-        <div class="header">
-            <h1>👨‍🎓 Портал ученика</h1>
-            <p id="levelDisplay">Уровень: <span id="levelNum">1</span></p>
-        </div>
-        
-        <div id="statusMessage" class="status"></div>
-        
-        <div class="monster-card">
-            <img id="monsterImage" class="monster-image" src="/media/monster1.jpeg" alt="Монстр">
-            <div class="monster-name" id="monsterName">Кракен</div>
-            <div class="monster-level">Уровень 1</div>
-            
-            <div class="hp-bar-container">
-                <div class="hp-bar" id="hpBar" style="width: 100%;">
-                    <span id="hpText">100/100 HP</span>
-                </div>
-            </div>
-        </div>
-    </div>
-    
-    <!-- ВИДЕО НА ВЕСЬ ЭКРАН -->
-    <div class="video-overlay" id="videoOverlay">
-        <div class="video-container">
-            <video id="levelUpVideo" autoplay playsinline>
-                <source src="/media/next_level.mp4" type="video/mp4">
-                Ваш браузер не поддерживает видео
-            </video>
-        </div>
-    </div>
-    
-    <script>
-        let lastLevel = 1;
-        let lastHp = 100;
-        let lastBackground = 'ocean_deep';
-        let syncInProgress = false;
-        
-        async function syncWithServer() {
-            if (syncInProgress) return;
-            syncInProgress = true;
-            
-            try {
-                const response = await fetch('/api/game');
-                const data = await response.json();
-                
-                console.log('📊 Sync data:', {
-                    level: data.level,
-                    hp: data.hp,
-                    max_hp: data.max_hp,
-                    bg: data.background.name
-                });
-                
-                // Обновить фон если он изменился
-                if (data.background && data.background.name !== lastBackground) {
-                    console.log('🎨 Фон меняется:', lastBackground, '→', data.background.name);
-                    updateBackground(data.background);
-                    lastBackground = data.background.name;
-                }
-                
-                // Проверка на новый уровень
-                if (data.level > lastLevel) {
-                    console.log('🚀 НОВЫЙ УРОВЕНЬ:', lastLevel, '→', data.level);
-                    showLevelUpAnimation(data);
-                    lastLevel = data.level;
-                }
-                
-                // Обновить ХП если изменился
-                if (data.hp !== lastHp) {
-                    console.log('💚 ХП меняется:', lastHp, '→', data.hp);
-                    animateHpChange(lastHp, data.hp, data.max_hp);
-                    lastHp = data.hp;
-                }
-                
-                // Обновить UI
-                document.getElementById('monsterName').textContent = data.monster;
-                document.getElementById('levelNum').textContent = data.level;
-                document.getElementById('monsterImage').src = data.image;
-                
-            } catch (error) {
-                console.error('❌ Sync error:', error);
-            } finally {
-                syncInProgress = false;
-            }
-        }
-        
-        function updateBackground(backgroundData) {
-            const body = document.body;
-            
-            // Удалить все классы фона
-            body.classList.remove('bg-ocean-deep', 'bg-ocean-mid', 'bg-ocean-shallow', 'bg-volcano');
-            
-            // Добавить новый класс
-            const bgClassName = 'bg-' + backgroundData.name.replace(/_/g, '-');
-            body.classList.add(bgClassName);
-            
-            console.log('✅ Фон применен:', bgClassName);
-            
-            if (backgroundData.water_effect) {
-                createWaterParticles(backgroundData.particle_color);
-            }
-        }
-        
-        function createWaterParticles(color) {
-            for (let i = 0; i < 5; i++) {
-                setTimeout(() => {
-                    const particle = document.createElement('div');
-                    particle.className = 'water-particle';
-                    particle.style.left = Math.random() * 100 + '%';
-                    particle.style.top = '-20px';
-                    particle.style.width = particle.style.height = Math.random() * 20 + 10 + 'px';
-                    particle.style.background = color;
-                    document.body.appendChild(particle);
-                    
-                    particle.animate([
-                        { transform: 'translateY(0) translateX(0)', opacity: 0.8 },
-                        { transform: `translateY(${window.innerHeight}px) translateX(${Math.random() * 100 - 50}px)`, opacity: 0 }
-                    ], { duration: 3000 + Math.random() * 2000 });
-                    
-                    setTimeout(() => particle.remove(), 5000);
-                }, i * 200);
-            }
-        }
-        
-        function animateHpChange(from, to, max) {
-            const bar = document.getElementById('hpBar');
-            const oldPercent = (from / max) * 100;
-            const newPercent = (to / max) * 100;
-            
-            bar.style.width = oldPercent + '%';
-            setTimeout(() => {
-                bar.style.width = newPercent + '%';
-                document.getElementById('hpText').textContent = to + '/' + max + ' HP';
-            }, 50);
-        }
-        
-        async function showLevelUpAnimation(data) {
-            console.log('🎬 Показываем видео...');
-            
-            try {
-                const videoOverlay = document.getElementById('videoOverlay');
-                const videoElement = document.getElementById('levelUpVideo');
-                
-                // Показать видео
-                videoOverlay.classList.add('show');
-                console.log('✅ Видео-overlay показан');
-                
-                // Убедиться что видео есть
-                const videoSrc = '/media/next_level.mp4';
-                videoElement.src = videoSrc;
-                
-                // Попробовать воспроизвести
-                const playPromise = videoElement.play();
-                if (playPromise !== undefined) {
-                    playPromise.then(() => {
-                        console.log('✅ Видео воспроизводится');
-                    }).catch(error => {
-                        console.error('❌ Ошибка воспроизведения:', error);
-                    });
-                }
-                
-                // Confetti!
-                createConfetti();
-                
-                // Закрыть после завершения видео
-                videoElement.onended = () => {
-                    console.log('✅ Видео закончилось');
-                    videoOverlay.classList.remove('show');
-                };
-                
-                // Или закрыть через 8 сек макс
-                setTimeout(() => {
-                    videoOverlay.classList.remove('show');
-                    console.log('⏱️ Видео закрыто (timeout)');
-                }, 8000);
-                
-            } catch (error) {
-                console.error('❌ Ошибка видео:', error);
-            }
-        }
-        
-        function createConfetti() {
-            console.log('🎉 Confetti!');
-            for (let i = 0; i < 50; i++) {
-                setTimeout(() => {
-                    const conf = document.createElement('div');
-                    conf.className = 'confetti';
-                    conf.style.left = Math.random() * 100 + '%';
-                    conf.style.top = '-10px';
-                    conf.style.background = ['#ffeb3b', '#ff9800', '#32b8c6', '#4caf50'][Math.floor(Math.random() * 4)];
-                    conf.style.width = conf.style.height = Math.random() * 10 + 5 + 'px';
-                    conf.style.borderRadius = '50%';
-                    document.body.appendChild(conf);
-                    
-                    conf.animate([
-                        { transform: 'translateY(0) rotate(0deg)', opacity: 1 },
-                        { transform: `translateY(${window.innerHeight}px) rotate(${Math.random() * 360}deg)`, opacity: 0 }
-                    ], { duration: 3000 });
-                    
-                    setTimeout(() => conf.remove(), 3000);
-                }, i * 20);
-            }
-        }
-        
-        // Синхронизация каждые 300мс (быстрее!)
-        setInterval(syncWithServer, 300);
-        
-        // Первая загрузка
-        console.log('🚀 Загружаем первый раз...');
-        syncWithServer();
-    </script>
-</body>
-</html>
-    '''
+# ==================== КАТАЛОГ КАМПАНИЙ ====================
 
-# ==================== СТРАНИЦА УЧИТЕЛЯ ====================
+# Поля стадии в файле кампании: допустимые типы и значение по умолчанию
+# (None - поле обязательно). background_gradient по умолчанию - background_color
+STAGE_FIELDS = {
+    'name': (str, None),
+    'max_hp': (int, None),
+    'image': (str, None),
+    'emoji': (str, '👾'),
+    'background': (str, 'ocean_deep'),
+    'background_color': (str, '#001f3f'),
+    'background_gradient': (str, ''),
+    'light_intensity': ((int, float), 0.5),
+    'water_effect': (bool, True),
+    'particle_color': (str, '#00ccff'),
+}
 
-@app.route('/teacher')
-def teacher():
-    return '''
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Панель учителя</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: 'Segoe UI', sans-serif;
-            background: linear-gradient(135deg, #1e5a96 0%, #32b8c6 100%);
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .container { max-width: 600px; margin: 0 auto; }
-        .header {
-            background: white;
-            padding: 20px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-        }
-        .header h1 { color: #1e5a96; }
-        
-        .card {
-            background: white;
-            padding: 25px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            box-shadow: 0 5px 15px rgba(0,0,0,0.1);
-        }
-        
-        .card h2 { color: #1e5a96; margin-bottom: 15px; font-size: 18px; }
-        .form-group { margin-bottom: 15px; }
-        label {
-            display: block;
-            margin-bottom: 5px;
-            font-weight: bold;
-            color: #333;
-        }
-        select, input {
-            width: 100%;
-            padding: 10px;
-            border: 1px solid #ddd;
-            border-radius: 5px;
-            font-size: 14px;
-        }
-        
-        .btn {
-            width: 100%;
-            padding: 12px;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-            font-weight: bold;
-            font-size: 16px;
-            transition: all 0.3s;
-        }
-        
-        .btn-primary { background: #4caf50; color: white; }
-        .btn-primary:hover { background: #45a049; }
-        
-        .btn-danger { background: #f44336; color: white; }
-        .btn-danger:hover { background: #da190b; }
-        
-        .status {
-            padding: 15px;
-            border-radius: 5px;
-            margin-bottom: 15px;
-            display: none;
-        }
-        .status.show { display: block; }
-        .status.success { background: #c8e6c9; color: #2e7d32; }
-        .status.error { background: #ffcdd2; color: #c62828; }
-        
-        .back-link {
-            display: inline-block;
-            color: white;
-            text-decoration: none;
-            margin-bottom: 20px;
-            font-weight: bold;
-        }
-        
-        .debug { background: #f5f5f5; padding: 10px; border-radius: 5px; font-size: 12px; font-family: monospace; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <a href="/" class="back-link">← Назад</a>
-        
-        <div class="header">
-            <h1>👨‍🏫 Панель учителя</h1>
-            <p>Управление игровым процессом</p>
-        </div>
-        
-        <div class="card">
-            <h2>🎮 Начислить баллы</h2>
-            <div id="statusMessage" class="status"></div>
-            
-            <div class="form-group">
-                <label>Количество баллов:</label>
-                <input type="number" id="pointsInput" value="100" min="0" max="1000">
-            </div>
-            
-            <button class="btn btn-primary" onclick="awardPoints()">✅ Начислить баллы</button>
-        </div>
-        
-        <div class="card">
-            <h2>📊 Статус</h2>
-            <div id="bossStatus" style="padding: 15px; background: #f5f5f5; border-radius: 5px; margin-bottom: 15px;">
-                <p id="bossInfo">Загрузка...</p>
-            </div>
-            <button class="btn btn-danger" onclick="levelUp()">🚀 УРОВЕНЬ +1</button>
-        </div>
-        
-        <div class="card">
-            <h2>🔧 Отладка</h2>
-            <button class="btn btn-primary" onclick="resetGame()" style="background: #ff9800;">♻️ Сбросить игру</button>
-            <div id="debugInfo" class="debug" style="margin-top: 10px; white-space: pre-wrap; max-height: 200px; overflow-y: auto;"></div>
-        </div>
-    </div>
-    
-    <script>
-        let debugLog = [];
-        
-        function addDebug(msg) {
-            debugLog.push('[' + new Date().toLocaleTimeString() + '] ' + msg);
-            if (debugLog.length > 10) debugLog.shift();
-            document.getElementById('debugInfo').textContent = debugLog.join('\\n');
-        }
-        
-        async function updateBossStatus() {
-            try {
-                const response = await fetch('/api/game');
-                const data = await response.json();
-                
-                const info = document.getElementById('bossInfo');
-                info.innerHTML = `
-                    <strong>${data.emoji} ${data.monster}</strong><br>
-                    Уровень: ${data.level}<br>
-                    ХП: ${data.hp}/${data.max_hp}
-                `;
-                addDebug(`Status: L${data.level} ${data.monster} ${data.hp}/${data.max_hp}HP`);
-            } catch (error) {
-                addDebug('❌ Status error: ' + error.message);
-            }
-        }
-        
-        async function awardPoints() {
-            const points = parseInt(document.getElementById('pointsInput').value);
-            
-            if (points <= 0) {
-                showStatus('❌ Введите положительное число', 'error');
-                return;
-            }
-            
-            try {
-                const response = await fetch('/api/award-points', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ amount: points })
-                });
-                
-                const data = await response.json();
-                
-                if (data.success) {
-                    showStatus(`✅ ${points} баллов! Урон: ${data.damage}HP. Осталось: ${data.new_hp}/${data.max_hp}HP`, 'success');
-                    addDebug(`Award: +${points} баллов, ${data.damage} урона`);
-                    
-                    if (data.boss_dead) {
-                        showStatus('☠️ БОСС УБИТ! Нажмите УРОВЕНЬ +1', 'success');
-                        addDebug('Boss defeated!');
-                    }
-                    
-                    updateBossStatus();
-                }
-            } catch (error) {
-                showStatus('❌ Ошибка: ' + error, 'error');
-                addDebug('❌ Award error: ' + error);
-            }
-        }
-        
-        async function levelUp() {
-            try {
-                addDebug('Requesting level-up...');
-                const response = await fetch('/api/level-up', { method: 'POST' });
-                const data = await response.json();
-                
-                if (data.success) {
-                    addDebug(`✅ Level up: ${data.old_level} → ${data.new_level}`);
-                    showStatus(`✅ УРОВЕНЬ ${data.new_level}!\n🎮 Новый босс: ${data.emoji} ${data.new_boss}`, 'success');
-                    updateBossStatus();
-                } else {
-                    addDebug(`❌ Level-up failed: ${data.error}`);
-                    showStatus('❌ Ошибка: ' + data.error, 'error');
-                }
-            } catch (error) {
-                addDebug('❌ Level-up error: ' + error);
-                showStatus('❌ Ошибка: ' + error, 'error');
-            }
-        }
-        
-        async function resetGame() {
-            if (!confirm('Вы уверены? Это сбросит всё!')) return;
-            
-            try {
-                const response = await fetch('/api/reset', { method: 'POST' });
-                const data = await response.json();
-                
-                if (data.success) {
-                    showStatus('✅ Игра сброшена', 'success');
-                    addDebug('Game reset');
-                    updateBossStatus();
-                }
-            } catch (error) {
-                addDebug('❌ Reset error: ' + error);
-                showStatus('❌ Ошибка: ' + error, 'error');
-            }
-        }
-        
-        function showStatus(message, type) {
-            const elem = document.getElementById('statusMessage');
-            elem.textContent = message;
-            elem.className = 'status show ' + type;
-            setTimeout(() => { elem.classList.remove('show'); }, 4000);
-        }
-        
-        setInterval(updateBossStatus, 500);
-        updateBossStatus();
-    </script>
-</body>
-</html>
-    '''
+def compile_stage(raw, number):
+    """Проверить стадию из файла кампании; вернуть неизменяемый словарь"""
+    if not isinstance(raw, dict):
+        raise ValueError(f"стадия {number}: нужен объект")
+    unknown = sorted(set(raw) - set(STAGE_FIELDS))
+    if unknown:
+        raise ValueError(f"стадия {number}: неизвестные поля {', '.join(unknown)}")
+    stage = {}
+    for field, (kind, default) in STAGE_FIELDS.items():
+        value = raw.get(field, default)
+        if value is None:
+            raise ValueError(f"стадия {number}: нет поля {field}")
+        # bool - подкласс int, но ХП true быть не может
+        if not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+            raise ValueError(f"стадия {number}: неверный тип поля {field}")
+        stage[field] = value
+    if stage['max_hp'] <= 0:
+        raise ValueError(f"стадия {number}: max_hp должно быть больше 0")
+    if not 0 <= stage['light_intensity'] <= 1:
+        raise ValueError(f"стадия {number}: light_intensity - от 0 до 1")
+    if not stage['name'].strip() or not stage['image'].strip():
+        raise ValueError(f"стадия {number}: пустое name или image")
+    stage['background_gradient'] = stage['background_gradient'] or stage['background_color']
+    return MappingProxyType(stage)
 
-# ==================== ГЛАВНАЯ ====================
+def load_campaign(path):
+    """Прочитать и проверить файл кампании; вернуть (название, кортеж стадий)"""
+    if os.path.getsize(path) > CAMPAIGN_MAX_BYTES:
+        raise ValueError(f"файл больше {CAMPAIGN_MAX_BYTES} байт")
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get('stages'), list):
+        raise ValueError('нужен объект {"title": ..., "stages": [...]}')
+    stages = data['stages']
+    if not 0 < len(stages) <= CAMPAIGN_MAX_STAGES:
+        raise ValueError(f"стадий должно быть от 1 до {CAMPAIGN_MAX_STAGES}")
+    title = data.get('title', '')
+    if not isinstance(title, str):
+        raise ValueError("title должно быть строкой")
+    return title, tuple(compile_stage(stage, number) for number, stage in enumerate(stages, 1))
 
-@app.route('/')
-def index():
-    return '''
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <title>Цифровой океан знаний</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body { font-family: 'Segoe UI'; background: linear-gradient(135deg, #1e5a96 0%, #32b8c6 100%); min-height: 100vh; display: flex; align-items: center; justify-content: center; }
-        .container { background: white; padding: 40px; border-radius: 15px; text-align: center; max-width: 500px; }
-        h1 { color: #1e5a96; margin-bottom: 30px; font-size: 32px; }
-        .button-group { display: grid; grid-template-columns: 1fr 1fr; gap: 15px; }
-        .btn { padding: 20px; border: none; border-radius: 8px; cursor: pointer; font-weight: bold; text-decoration: none; font-size: 16px; transition: transform 0.2s; }
-        .btn:hover { transform: translateY(-2px); }
-        .btn-student { background: #4caf50; color: white; }
-        .btn-teacher { background: #ff9800; color: white; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>🌊 Цифровой океан знаний</h1>
-        <div class="button-group">
-            <a href="/student" class="btn btn-student">👨‍🎓 Ученик</a>
-            <a href="/teacher" class="btn btn-teacher">👨‍🏫 Учитель</a>
-        </div>
-    </div>
-</body>
-</html>
-    '''
+class StageCatalog:
+    """Скомпилированный каталог: кампания -> кортеж стадий, уровень -> индекс
+    
+    Объект не меняется: новая версия каталога строится целиком и
+    подменяет старую одной ссылкой (CampaignLoader.catalog).
+    """
+    
+    __slots__ = ('stages', 'titles', 'generation')
+    
+    def __init__(self, campaigns, generation=0):
+        # campaigns: {id: (название, кортеж стадий)}
+        self.stages = MappingProxyType({campaign: stages for campaign, (_, stages) in campaigns.items()})
+        self.titles = MappingProxyType({campaign: title for campaign, (title, _) in campaigns.items()})
+        self.generation = generation
+    
+    def campaign_stages(self, campaign=None):
+        """Стадии кампании; неизвестная или None - кампания по умолчанию"""
+        stages = self.stages.get(campaign)
+        return stages if stages is not None else self.stages[DEFAULT_CAMPAIGN]
+    
+    def stage(self, level, campaign=None):
+        """Стадия для уровня: после последней стадии кампания идёт по кругу"""
+        stages = self.campaign_stages(campaign)
+        return stages[(level - 1) % len(stages)]
+    
+    def describe(self):
+        """Список кампаний для API"""
+        return [{'id': campaign, 'title': self.titles[campaign], 'stages': len(stages)}
+                for campaign, stages in sorted(self.stages.items())]
 
-if __name__ == '__main__':
-    create_media_directory()
+class CampaignLoader:
+    """Кампании из CAMPAIGNS_DIR: проверка, компиляция и подмена на лету
+    
+    Фоновый поток сверяет mtime и размер файлов. Изменившиеся файлы
+    читаются и проверяются в нём же, а запросы видят либо старый каталог,
+    либо новый целиком. Файл с ошибкой каталог не ломает: остаётся
+    прежняя версия этой кампании.
+    """
+    
+    def __init__(self, directory=CAMPAIGNS_DIR):
+        self.directory = directory
+        self.on_change = []  # вызываются после подмены каталога
+        self._builtin = ('Цифровой океан', tuple(compile_stage(BOSSES[n], n) for n in sorted(BOSSES)))
+        self.catalog = StageCatalog({DEFAULT_CAMPAIGN: self._builtin})
+        self._files = {}     # имя файла -> (mtime_ns, size, (название, стадии) или None)
+        self._watcher = None
+        self.refresh()
+    
+    def refresh(self):
+        """Перечитать изменившиеся файлы кампаний; True - каталог подменён"""
+        try:
+            scanned = list(os.scandir(self.directory))
+        except OSError:
+            scanned = []
+        files = {}
+        for item in scanned:
+            campaign, ext = os.path.splitext(item.name)
+            if ext != '.json' or not item.is_file() or not re.fullmatch(ROOM_ID_PATTERN, campaign):
+                continue
+            file_stat = item.stat()
+            old = self._files.get(item.name)
+            if old is not None and old[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+                files[item.name] = old
+                continue
+            try:
+                compiled = load_campaign(item.path)
+            except (OSError, ValueError) as e:
+                log_event(logging.ERROR, 'campaign.error', "❌ Кампания %s: %s", item.name, e)
+                compiled = old[2] if old is not None else None
+            files[item.name] = (file_stat.st_mtime_ns, file_stat.st_size, compiled)
+        
+        campaigns = {DEFAULT_CAMPAIGN: self._builtin}
+        for name, (_, _, compiled) in sorted(files.items()):
+            if compiled is not None:
+                campaigns[os.path.splitext(name)[0]] = compiled
+        previous = self.catalog.stages
+        self._files = files
+        # Файл с ошибкой оставил прежнюю версию: каталог тот же, не подменяем
+        if campaigns.keys() == previous.keys() and all(campaigns[c][1] is previous[c] for c in campaigns):
+            return False
+        self.catalog = StageCatalog(campaigns, self.catalog.generation + 1)
+        log_event(logging.INFO, 'campaign.catalog', "📚 Кампании: %s", ', '.join(
+            f"{campaign} ({len(stages)})" for campaign, stages in sorted(self.catalog.stages.items())))
+        for callback in self.on_change:
+            callback()
+        return True
+    
+    def start_watcher(self, interval=CAMPAIGN_SCAN_INTERVAL):
+        """Фоновая перепроверка файлов кампаний раз в interval секунд"""
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_loop, args=(interval,), name='campaign-watcher', daemon=True)
+            self._watcher.start()
+    
+    def _watch_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log_event(logging.ERROR, 'campaign.error', "❌ Ошибка каталога кампаний: %s", e)
+
+campaigns = CampaignLoader()
+campaigns.start_watcher()
+
+def get_boss_info(level, campaign=None):
+    """Стадия (босс) для уровня в кампании комнаты"""
+    return campaigns.catalog.stage(level, campaign)
+
+def build_background(boss_info):
+    """Блок background ответа API для босса"""
+    return {
+        'name': boss_info['background'],
+        'color': boss_info['background_color'],
+        'gradient': boss_info['background_gradient'],
+        'light_intensity': boss_info['light_intensity'],
+        'water_effect': boss_info['water_effect'],
+        'particle_color': boss_info['particle_color'],
+    }
+
+# ==================== ИГРОВЫЕ ОПЕРАЦИИ ====================
+# Каждая операция меняет переданную копию состояния и возвращает результат.
+# Вызываются только через GameStateStore.execute() под блокировкой.
+
+def leaderboard_add(top, student, score, size=LEADERBOARD_SIZE):
+    """Топ после роста счёта ученика - без пересортировки всех учеников.
+    
+    Счёт только растёт, поэтому ученик может лишь подняться: убираем его
+    прежнюю строку и вставляем на новое место (за равными по счёту).
+    """
+    top = [entry for entry in top if entry[0] != student]
+    rank = 0
+    while rank < len(top) and top[rank][1] >= score:
+        rank += 1
+    if rank < size:
+        top.insert(rank, [student, score])
+        del top[size:]
+    return top
+
+def leaderboard_delta(old, new):
+    """Изменившиеся места топа: [[место, ученик, урон], ...]"""
+    return [[rank, *entry] for rank, entry in enumerate(new) if rank >= len(old) or old[rank] != entry]
+
+def op_award(state, amount=0, student=None):
+    """Нанести урон боссу; с student - записать урон на счёт ученика"""
+    damage = max(1, int(amount) // 10)  # Минимум 1 урон
+    state['current_hp'] = max(0, state['current_hp'] - damage)
+    student = str(student).strip()[:STUDENT_ID_MAX] if student is not None else ''
+    if not student:
+        return {'damage': damage}
+    # Правка на месте: GameStateStore отдаёт операциям свою копию счёта
+    # (_working_copy), одну на выполнение, а не на каждое начисление пачки
+    scores = state.setdefault('scores', {})
+    scores[student] = scores.get(student, 0) + damage
+    state['top'] = leaderboard_add(state.get('top', []), student, scores[student])
+    return {'damage': damage, 'student': student, 'total': scores[student]}
+
+def op_level_up(state):
+    """Перейти на следующий уровень с полным ХП нового босса"""
+    old_level = state['level']
+    state['level'] = old_level + 1
+    next_boss = get_boss_info(state['level'], state.get('campaign'))
+    state['current_hp'] = next_boss['max_hp']
+    state['max_hp'] = next_boss['max_hp']
+    return {'old_level': old_level}
+
+def op_reset(state):
+    """Вернуть игру на уровень 1 (кампания комнаты остаётся)"""
+    campaign = state.get('campaign')
+    state.clear()
+    state.update(default_game_state(campaign))
+    return {}
+
+def op_set_campaign(state, campaign=DEFAULT_CAMPAIGN):
+    """Сменить кампанию комнаты: уровень 1 и полное ХП её первой стадии"""
+    stages = campaigns.catalog.stages.get(campaign)
+    if stages is None:
+        raise ValueError(f"Нет кампании: {campaign}")
+    state['campaign'] = campaign
+    state['level'] = 1
+    state['current_hp'] = state['max_hp'] = stages[0]['max_hp']
+    return {'campaign': campaign, 'stages': len(stages)}
+
+def op_set_hp(state, hp=0):
+    """Выставить ХП босса (в пределах 0..max_hp)"""
+    state['current_hp'] = max(0, min(int(hp), state['max_hp']))
+    return {'hp': state['current_hp']}
+
+def op_batch(state, commands=()):
+    """Несколько операций по порядку - одним событием журнала и одной версией"""
+    results = []
+    for command in commands:
+        args = dict(command)
+        op = args.pop('op', None)
+        func = OPERATIONS.get(op) if op != 'batch' else None
+        if func is None:
+            raise ValueError(f"Неизвестная операция: {op!r}")
+        try:
+            result = func(state, **args)
+        except TypeError:
+            raise ValueError(f"Неверные параметры {op}: {', '.join(args) or '-'}") from None
+        results.append({'op': op, **result})
+    return {'results': results}
+
+OPERATIONS = {
+    'award': op_award,
+    'level_up': op_level_up,
+    'reset': op_reset,
+    'set_hp': op_set_hp,
+    'set_campaign': op_set_campaign,
+    'batch': op_batch,
+}
+
+# ==================== ХРАНЕНИЕ НА ДИСКЕ ====================
+# Бэкенд хранения (GAME_STORAGE): снимок состояния комнаты + журнал событий.
+#   load(room)             -> (состояние, сколько событий после снимка)
+#   append(room, records)  дописать события (ошибка = исключение)
+#   snapshot(room, state)  сохранить снимок, True при успехе
+#   batch()                контекст: несколько комнат одной транзакцией
+#   rooms_at_level(level)  {комната: уровень} по сохранённым снимкам
+
+class JsonFileStorage:
+    """Файлы: <комната>.json (снимок) + <комната>.json.journal"""
+    
+    def __init__(self, rooms_dir=ROOMS_DIR):
+        self.rooms_dir = rooms_dir
+    
+    def state_path(self, room):
+        """Файл состояния комнаты (главная комната - старый GAME_STATE_FILE)"""
+        if room == DEFAULT_ROOM:
+            return GAME_STATE_FILE
+        return os.path.join(self.rooms_dir, f'{room}.json')
+    
+    def load(self, room):
+        path = self.state_path(room)
+        state = read_snapshot(path)
+        return state, replay_journal(state, journal_path(path))
+    
+    def append(self, room, records):
+        append_journal(records, journal_path(self.state_path(room)))
+    
+    def snapshot(self, room, state):
+        path = self.state_path(room)
+        if not write_snapshot_file(state, path):
+            return False
+        # Снимок содержит все события журнала, поэтому журнал можно архивировать
+        rotate_journal(journal_path(path))
+        return True
+    
+    @contextmanager
+    def batch(self):
+        yield
+    
+    def rooms_at_level(self, min_level):
+        found = {}
+        paths = {DEFAULT_ROOM: GAME_STATE_FILE}
+        if os.path.isdir(self.rooms_dir):
+            for name in os.listdir(self.rooms_dir):
+                if name.endswith('.json'):
+                    paths[name[:-len('.json')]] = os.path.join(self.rooms_dir, name)
+        for room, path in paths.items():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    level = json.load(f)['level']
+            except (OSError, ValueError, KeyError):
+                continue
+            if level >= min_level:
+                found[room] = level
+        return found
+    
+    def close(self):
+        pass
+
+class SqliteStorage:
+    """SQLite в режиме WAL: таблица rooms (снимки) + events (журнал).
+    
+    Соединения берутся из пула на одну операцию, поэтому их не больше
+    pool_size, сколько бы потоков ни создавал сервер. batch() и
+    exclusive() держат одно соединение потока до конца транзакции.
+    SQL-строки постоянные, поэтому sqlite3 переиспользует подготовленные
+    запросы из кэша каждого соединения.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (
+            room TEXT PRIMARY KEY,
+            level INTEGER NOT NULL,
+            current_hp INTEGER NOT NULL,
+            max_hp INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            last_updated TEXT NOT NULL,
+            state TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rooms_by_level ON rooms (level);
+        CREATE TABLE IF NOT EXISTS events (
+            room TEXT NOT NULL,
+            v INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            args TEXT NOT NULL,
+            t TEXT NOT NULL,
+            PRIMARY KEY (room, v)
+        ) WITHOUT ROWID;
+    """
+    SQL_LOAD = "SELECT state FROM rooms WHERE room = ?"
+    SQL_EVENTS = "SELECT v, op, args, t FROM events WHERE room = ? AND v > ? ORDER BY v"
+    SQL_APPEND = "INSERT OR IGNORE INTO events (room, v, op, args, t) VALUES (?, ?, ?, ?, ?)"
+    SQL_SNAPSHOT = """
+        INSERT INTO rooms (room, level, current_hp, max_hp, version, last_updated, state)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (room) DO UPDATE SET
+            level = excluded.level, current_hp = excluded.current_hp,
+            max_hp = excluded.max_hp, version = excluded.version,
+            last_updated = excluded.last_updated, state = excluded.state
+        WHERE excluded.version >= rooms.version
+    """
+    SQL_AT_LEVEL = "SELECT room, level FROM rooms WHERE level >= ? ORDER BY room"
+    
+    def __init__(self, db_path=SQLITE_DB_FILE, pool_size=SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue()  # свободные соединения, последнее - самое "тёплое"
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._local = threading.local()  # conn - соединение, которое держит batch()/exclusive()
+        self._closed = False
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def _checkin(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # операция упала посреди записи
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+    
+    @contextmanager
+    def _conn(self):
+        """Соединение на одну операцию: то, что держит транзакция потока, или из пула"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+    
+    @contextmanager
+    def _hold(self):
+        """Закрепить соединение за потоком до конца блока (вложенные - то же)"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held, False
+            return
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn, True
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+    
+    def _commit(self, conn):
+        # Внутри batch()/exclusive() фиксирует сама транзакция
+        if getattr(self._local, 'conn', None) is None:
+            conn.commit()
+    
+    def load(self, room):
+        with self._conn() as conn:
+            row = conn.execute(self.SQL_LOAD, (room,)).fetchone()
+        state = json.loads(row[0]) if row else default_game_state()
+        replayed = 0
+        for record in self.events_since(room, state['version']):
+            if apply_record(state, record):
+                replayed += 1
+        return state, replayed
+    
+    def events_since(self, room, version):
+        """События комнаты новее version (в том числе записанные другими процессами)"""
+        with self._conn() as conn:
+            rows = conn.execute(self.SQL_EVENTS, (room, version)).fetchall()
+        return [{'v': v, 'op': op, 'args': json.loads(args), 't': t} for v, op, args, t in rows]
+    
+    @contextmanager
+    def exclusive(self):
+        """Транзакция, сразу занимающая запись в базу (BEGIN IMMEDIATE).
+        
+        Пока она открыта, другие процессы ждут, поэтому прочитать новые
+        события и дописать своё внутри неё - атомарно для всех процессов.
+        """
+        with self._hold() as (conn, _):
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+    
+    def append(self, room, records):
+        with self._conn() as conn:
+            conn.executemany(self.SQL_APPEND, [
+                (room, r['v'], r['op'], json.dumps(r['args'], ensure_ascii=False), r['t'])
+                for r in records
+            ])
+            self._commit(conn)
+    
+    def snapshot(self, room, state):
+        with self._conn() as conn:
+            try:
+                conn.execute(self.SQL_SNAPSHOT, (
+                    room, state['level'], state['current_hp'], state['max_hp'],
+                    state['version'], state['last_updated'],
+                    json.dumps(state, ensure_ascii=False, separators=(',', ':')),
+                ))
+                self._commit(conn)
+                return True
+            except sqlite3.Error as e:
+                log_event(logging.ERROR, 'storage.error', "❌ Ошибка сохранения %s: %s", room, e, room=room)
+                return False
+    
+    @contextmanager
+    def batch(self):
+        """Все append/snapshot внутри - одной транзакцией"""
+        with self._hold() as (conn, outer):
+            try:
+                yield
+            finally:
+                if outer:
+                    try:
+                        conn.commit()
+                    except sqlite3.Error as e:
+                        log_event(logging.ERROR, 'storage.error', "❌ Ошибка фиксации транзакции: %s", e)
+    
+    def rooms_at_level(self, min_level):
+        with self._conn() as conn:
+            return dict(conn.execute(self.SQL_AT_LEVEL, (min_level,)).fetchall())
+    
+    def close(self):
+        """Закрыть свободные соединения; занятые закроются, когда вернутся в пул"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.commit()
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+STORAGE_BACKENDS = {
+    'json': JsonFileStorage,
+    'sqlite': SqliteStorage,
+}
+
+def create_storage(name=GAME_STORAGE, location=None):
+    """Создать бэкенд хранения по имени ('json' или 'sqlite'); location - папка комнат или файл базы"""
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"Неизвестный GAME_STORAGE={name!r}, доступны: {', '.join(STORAGE_BACKENDS)}")
+    backend = STORAGE_BACKENDS[name]
+    return backend(location) if location else backend()
+
+storage = create_storage()
+
+def load_game_state(room=DEFAULT_ROOM):
+    """Загрузить состояние игры: последний снимок + журнал после него"""
+    state, _ = storage.load(room)
+    return state
+
+def save_game_state(state, room=DEFAULT_ROOM):
+    """Сохранить снимок состояния игры"""
+    return storage.snapshot(room, state)
+
+# ==================== ОБЩАЯ ПАМЯТЬ ПРОЦЕССОВ ====================
+
+class SharedSlotError(Exception):
+    """Слот общей памяти не читается: процесс умер посреди записи в него"""
+
+class SharedRoomTable:
+    """Состояние комнат в общей памяти всех процессов (serve --workers N).
+
+    Таблица фиксированного размера: у комнаты свой слот (открытая адресация
+    по crc32 имени) с полями level, current_hp, max_hp, version, last_updated
+    и счётчиком seqlock. Пишет только процесс, держащий блокировку базы
+    (storage.exclusive()), поэтому писатель всегда один. Читатели не ждут:
+    повторяют чтение, если счётчик нечётный или изменился за время чтения.
+    Если процесс умер посреди записи, счётчик остаётся нечётным: читатели
+    сдаются через SHARED_MEMORY_READ_TIMEOUT (SharedSlotError, состояние
+    берётся из базы), а слот чинит следующая запись или главный процесс.
+    Счётчик и версия - выровненные 8-байтные слова в начале слота: они
+    пишутся одной командой процессора, а проверка «есть ли новее» - одно
+    чтение версии.
+    """
+
+    MAGIC = b'MONSTER1'
+    HEADER = struct.Struct('<8sI4x')  # метка, число слотов
+    # Слот: seq (0 - свободен, нечётный - идёт запись), version, затем BODY
+    BODY = struct.Struct('<64sqqq32s')  # комната, level, current_hp, max_hp, last_updated
+    SLOT_SIZE = 16 + BODY.size
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        magic, self.capacity = self.HEADER.unpack_from(shm.buf, 0)
+        if magic != self.MAGIC:
+            shm.close()
+            raise ValueError(f"Общая память {shm.name} - не таблица комнат")
+        self.full = False
+        self._buf = shm.buf
+        # struct.pack_into сначала обнуляет поле, поэтому seq и version
+        # пишутся только через это представление
+        self._words = shm.buf[:self.HEADER.size + self.capacity * self.SLOT_SIZE].cast('Q')
+        self._slots = {}  # комната -> номер слота (слот комнаты не меняется)
+
+    @classmethod
+    def create(cls, capacity=SHARED_MEMORY_ROOMS):
+        """Новая таблица (в главном процессе serve --workers)"""
+        shm = shared_memory.SharedMemory(create=True, size=cls.HEADER.size + capacity * cls.SLOT_SIZE)
+        cls.HEADER.pack_into(shm.buf, 0, cls.MAGIC, capacity)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Подключиться к таблице главного процесса по имени"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # Python < 3.13
+            shm = shared_memory.SharedMemory(name=name)
+            # Иначе трекер ресурсов удалит память при выходе этого процесса
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _word(self, slot):
+        """Номер слова seq слота (version - следующее)"""
+        return (self.HEADER.size + slot * self.SLOT_SIZE) // 8
+
+    def _read(self, slot):
+        """Согласованное чтение слота: (seq, version, остальные поля)"""
+        word = self._word(slot)
+        deadline = None
+        while True:
+            seq = self._words[word]
+            if not seq & 1:
+                version = self._words[word + 1]
+                fields = self.BODY.unpack_from(self._buf, word * 8 + 16)
+                if self._words[word] == seq:
+                    return seq, version, fields
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + SHARED_MEMORY_READ_TIMEOUT
+            elif now > deadline:
+                raise SharedSlotError(f"слот {slot} общей памяти {self.name} не дописан")
+            time.sleep(0)
+
+    def _find(self, key):
+        """(слот комнаты, None) или (None, первый свободный слот); (None, None) - мест нет"""
+        start = zlib.crc32(key) % self.capacity
+        for i in range(self.capacity):
+            slot = (start + i) % self.capacity
+            seq, _, fields = self._read(slot)
+            if seq == 0:
+                return None, slot
+            if fields[0] == key:
+                return slot, None
+        self.full = True
+        return None, None
+
+    @staticmethod
+    def _key(room):
+        return room.encode('ascii').ljust(64, b'\0')
+
+    def slot(self, room):
+        """Номер слота комнаты или None, если её ещё никто не менял"""
+        slot = self._slots.get(room)
+        if slot is None:
+            slot, _ = self._find(self._key(room))
+            if slot is not None:
+                self._slots[room] = slot
+        return slot
+
+    def read(self, room, newer_than=-1):
+        """Состояние комнаты, если его версия больше newer_than; иначе None"""
+        slot = self.slot(room)
+        if slot is None:
+            return None
+        if self._words[self._word(slot) + 1] <= newer_than:
+            return None
+        _, version, (_, level, current_hp, max_hp, last_updated) = self._read(slot)
+        if version <= newer_than:
+            return None
+        return {
+            'level': level,
+            'current_hp': current_hp,
+            'max_hp': max_hp,
+            'version': version,
+            'last_updated': last_updated.rstrip(b'\0').decode('ascii'),
+        }
+
+    def publish(self, room, state):
+        """Записать состояние комнаты; вызывать только под storage.exclusive()"""
+        key = self._key(room)
+        try:
+            slot = self.slot(room)
+            if slot is None:
+                _, slot = self._find(key)
+        except SharedSlotError as e:
+            log_event(logging.WARNING, 'shm.broken', "⚠️ Общая память: %s, [%s] идёт через базу", e, room, room=room)
+            return False
+        if slot is None:
+            log_event(logging.WARNING, 'shm.full', "⚠️ Общая память: нет слота для [%s], комната идёт через базу",
+                      room, room=room)
+            return False
+        self._slots[room] = slot
+        self._write(slot, key, state)
+        return True
+    
+    def _write(self, slot, key, state):
+        word = self._word(slot)
+        seq = self._words[word]
+        # Нечётный счётчик под блокировкой базы - запись умершего процесса
+        seq += seq & 1
+        self._words[word] = seq + 1
+        self._words[word + 1] = state['version']
+        self.BODY.pack_into(self._buf, word * 8 + 16, key,
+                            state['level'], state['current_hp'], state['max_hp'],
+                            state['last_updated'].encode('ascii'))
+        self._words[word] = seq + 2
+    
+    def repair(self, load):
+        """Переписать слоты, запись в которые оборвалась, состоянием из базы
+        (load(room) -> состояние); вызывать только под storage.exclusive().
+        Вернуть список починенных комнат."""
+        repaired = []
+        for slot in range(self.capacity):
+            word = self._word(slot)
+            seq = self._words[word]
+            if not seq & 1:
+                continue
+            key = self.BODY.unpack_from(self._buf, word * 8 + 16)[0]
+            room = key.rstrip(b'\0').decode('ascii', 'replace')
+            if re.fullmatch(ROOM_ID_PATTERN, room):
+                self._write(slot, key, load(room))
+                repaired.append(room)
+            elif seq == 1:
+                # Первая запись в свободный слот: его ещё никто не нашёл
+                self._words[word] = 0
+        return repaired
+
+    def close(self):
+        """Отключиться; главный процесс ещё и удаляет память"""
+        self._words.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# ==================== ХРАНИЛИЩЕ СОСТОЯНИЯ ====================
+
+class StateHistory:
+    """Кольцевой буфер изменений комнаты для графика ХП
+    
+    Запись - (версия, время, уровень, ХП, макс. ХП, изменение ХП, источник)
+    в колонках array, выделенных сразу на capacity записей: запись не
+    создаёт объектов, а память комнаты не растёт с длиной урока.
+    """
+    
+    SOURCES = ('load', 'sync', 'award', 'level_up', 'reset', 'set_hp', 'set_campaign', 'batch')
+    
+    def __init__(self, capacity=HISTORY_SIZE):
+        self.capacity = capacity
+        self.versions = array('Q', [0]) * capacity
+        self.times = array('d', [0.0]) * capacity
+        self.levels = array('H', [0]) * capacity
+        self.hp = array('i', [0]) * capacity
+        self.max_hp = array('i', [0]) * capacity
+        self.deltas = array('i', [0]) * capacity
+        self.sources = array('B', [0]) * capacity
+        self.count = 0  # записей за всё время; следующая ляжет в count % capacity
+        self._codes = {source: code for code, source in enumerate(self.SOURCES)}
+    
+    def append(self, state, delta, source):
+        """Добавить запись о состоянии; вызывать под блокировкой комнаты"""
+        i = self.count % self.capacity
+        self.versions[i] = state['version']
+        self.times[i] = round(time.time(), 3)
+        self.levels[i] = min(state['level'], 0xFFFF)
+        self.hp[i] = state['current_hp']
+        self.max_hp[i] = state['max_hp']
+        self.deltas[i] = delta
+        self.sources[i] = self._codes.get(source, 0)
+        self.count += 1
+    
+    def query(self, since=-1, points=HISTORY_POINTS):
+        """Записи с версией новее since (последняя version прошлого ответа),
+        не больше points точек
+        
+        Версия, в отличие от номера записи, не сбрасывается при выгрузке
+        комнаты и одна у всех процессов. Длинный отрезок сжимается: точка -
+        последняя запись группы, delta - сумма изменений ХП группы, n -
+        сколько записей в неё вошло. Вытесненные из буфера записи пропускаются.
+        """
+        cap = self.capacity
+        lo = self.count
+        # Версии в буфере растут: новые записи - в его конце
+        while lo > max(self.count - cap, 0) and self.versions[(lo - 1) % cap] > since:
+            lo -= 1
+        step = max(1, -(-(self.count - lo) // points))
+        columns = {'version': [], 't': [], 'level': [], 'hp': [], 'max_hp': [], 'delta': [], 'source': [], 'n': []}
+        for start in range(lo, self.count, step):
+            end = min(start + step, self.count)
+            last = (end - 1) % cap
+            columns['version'].append(self.versions[last])
+            columns['t'].append(self.times[last])
+            columns['level'].append(self.levels[last])
+            columns['hp'].append(self.hp[last])
+            columns['max_hp'].append(self.max_hp[last])
+            columns['delta'].append(sum(self.deltas[k % cap] for k in range(start, end)))
+            columns['source'].append(self.SOURCES[self.sources[last]])
+            columns['n'].append(end - start)
+        return {'size': cap, 'total': self.count, **columns}
+
+# Недавнее состояние комнаты для /api/game/delta: только поля, которые
+# сравнивает дельта (без счёта учеников - он весит килобайты)
+RecentState = namedtuple('RecentState', 'version level current_hp max_hp campaign')
+
+def recent_state(state):
+    return RecentState(state['version'], state['level'], state['current_hp'],
+                       state['max_hp'], state.get('campaign'))
+
+class StoreClosedError(Exception):
+    """Комнату выгрузили из памяти, пока с ней работал запрос"""
+
+class GameStateStore:
+    """Состояние одной комнаты в памяти - единственный источник правды.
+    
+    Снимок и журнал читаются один раз при создании. Все изменения идут
+    через execute(): под блокировкой, с ростом version, и каждое
+    попадает в журнал, который общий StateFlusher дописывает на диск.
+    """
+    
+    def __init__(self, room, storage, flusher=None, shared=False, table=None, listeners=()):
+        self.room = room
+        self.storage = storage
+        self.flusher = flusher
+        # shared: в ту же базу пишут другие процессы (serve --workers),
+        # table: их свежие состояния лежат в общей памяти (SharedRoomTable)
+        self.shared = shared
+        self.table = table
+        # listeners(room, state) зовутся при каждой смене состояния, под блокировкой
+        self.listeners = listeners
+        self.last_access = time.monotonic()
+        self._state, self._since_snapshot = storage.load(room)
+        self._recent = deque([recent_state(self._state)], maxlen=DELTA_HISTORY)
+        self._history = StateHistory()
+        self._history.append(self._state, 0, 'load')
+        self._journal = []
+        self._flush_failures = 0  # ошибок записи журнала подряд
+        self._closed = False
+        self._watchers = 0
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+    
+    @property
+    def version(self):
+        return self._state['version']
+    
+    @property
+    def closed(self):
+        return self._closed
+    
+    @property
+    def watchers(self):
+        """Сколько SSE/long-poll клиентов ждут изменений"""
+        return self._watchers
+    
+    def get(self):
+        """Текущее состояние (без обращения к диску)"""
+        if self.table is not None:
+            self.refresh()
+        # self._state никогда не меняется на месте - только заменяется целиком
+        return dict(self._state)
+    
+    def state_at(self, version):
+        """RecentState недавнего состояния с этой версией (для дельты) или None"""
+        # _set_state дописывает в deque из других потоков
+        with self._lock:
+            for state in reversed(self._recent):
+                if state.version == version:
+                    return state
+        return None
+    
+    def history(self, since=-1, points=HISTORY_POINTS):
+        """История ХП комнаты (StateHistory.query)"""
+        with self._lock:
+            return self._history.query(since, points)
+    
+    def _set_state(self, state, source):
+        """Заменить состояние и разбудить ждущих; вызывать под self._lock
+        
+        source - операция, которая привела к нему (для истории).
+        """
+        self._history.append(state, state['current_hp'] - self._state['current_hp'], source)
+        self._state = state
+        self._recent.append(recent_state(state))
+        self._changed.notify_all()
+        for listener in self.listeners:
+            listener(self.room, state)
+    
+    def execute(self, op, **params):
+        """Атомарно применить операцию; вернуть (новое состояние, результат)"""
+        func = OPERATIONS[op]
+        if self.shared:
+            return self._execute_shared(func, op, params)
+        with self._lock:
+            state, record, result = self._next_state(func, op, params)
+            self._set_state(state, op)
+            self._journal.append(record)
+        if self.flusher is not None:
+            self.flusher.mark_dirty(self)
+        return dict(state), result
+    
+    def _working_copy(self):
+        """Копия состояния, которую операции правят на месте; вызывать под self._lock
+        
+        Счёт учеников копируется отдельно: прежнее состояние ещё могут читать.
+        """
+        state = dict(self._state)
+        if 'scores' in state:
+            state['scores'] = dict(state['scores'])
+        return state
+    
+    def _next_state(self, func, op, params):
+        """Состояние после операции и запись журнала о ней; вызывать под self._lock"""
+        if self._closed:
+            raise StoreClosedError(self.room)
+        state = self._working_copy()
+        result = func(state, **params)
+        state['version'] = self._state['version'] + 1
+        state['last_updated'] = datetime.now().isoformat()
+        return state, {'v': state['version'], 'op': op, 'args': params, 't': state['last_updated']}, result
+    
+    def _execute_shared(self, func, op, params):
+        """execute() для нескольких процессов: догнать чужие события и записать
+        своё в одной транзакции базы; видно оно становится только после записи"""
+        with self._io_lock:
+            with PERSIST_LATENCY.labels('append').time(), self.storage.exclusive():
+                self.catch_up()
+                with self._lock:
+                    state, record, result = self._next_state(func, op, params)
+                self.storage.append(self.room, [record])
+                if self.table is not None:
+                    # Ещё под блокировкой базы: писатель в общую память один
+                    self.table.publish(self.room, state)
+            with self._lock:
+                # Фоновый catch_up мог уже прочитать эту запись из базы и
+                # следующие за ней - версия назад не откатывается
+                if state['version'] > self._state['version']:
+                    self._set_state(state, op)
+                else:
+                    state = self._state
+            self._since_snapshot += 1
+        if self.flusher is not None:
+            self.flusher.mark_dirty(self)  # только для периодического снимка
+        return dict(state), result
+    
+    def refresh(self):
+        """Подхватить изменение, о котором сообщила общая память; True - если было"""
+        try:
+            if self.table.read(self.room, newer_than=self._state['version']) is None:
+                return False
+        except SharedSlotError:
+            pass  # слот не дописан - новое состояние ищем в базе
+        # В общей памяти только поля босса, а счёт учеников - в событиях
+        # журнала: дочитываем их из базы. Если событие ещё не
+        # зафиксировано, фоновый поток повторит через 5 мс
+        return self.catch_up()
+    
+    def sync(self):
+        """Подхватить изменения других процессов: из общей памяти, а если
+        комнате не досталось слота - из журнала в базе"""
+        if self.table is not None:
+            try:
+                if not (self.table.full and self.table.slot(self.room) is None):
+                    return self.refresh()
+            except SharedSlotError:
+                pass
+        return self.catch_up()
+    
+    def catch_up(self):
+        """Применить события, которые записали другие процессы; True - если были"""
+        records = self.storage.events_since(self.room, self.version)
+        if not records:
+            return False
+        with self._lock:
+            state = self._working_copy()
+            applied = sum(apply_record(state, record) for record in records)
+            if applied:
+                # Несколько чужих событий разом - одна запись истории
+                self._set_state(state, records[-1]['op'] if applied == 1 else 'sync')
+        return bool(applied)
+    
+    def wait_for_change(self, since_version, timeout, generation=None):
+        """Дождаться состояния с версией, отличной от since_version, или
+        (если задана generation) новой сборки фрагментов payload_cache.
+        
+        Возвращает новое состояние или None по таймауту / при остановке.
+        """
+        with self._lock:
+            self._watchers += 1
+            try:
+                changed = self._changed.wait_for(
+                    lambda: (self._closed or self._state['version'] != since_version
+                             or (generation is not None and payload_cache.generation != generation)),
+                    timeout,
+                )
+            finally:
+                self._watchers -= 1
+            if not changed or self._closed:
+                return None
+            return dict(self._state)
+    
+    def wake(self):
+        """Разбудить ждущих без смены состояния (сменилась сборка фрагментов)"""
+        with self._lock:
+            self._changed.notify_all()
+    
+    def flush(self, snapshot=False):
+        """Дописать новые события в журнал; при необходимости - снимок.
+        Вернуть False, если журнал записать не удалось."""
+        with self._io_lock:
+            with self._lock:
+                records, self._journal = self._journal, []
+                state = self._state
+            pending = self._since_snapshot + len(records)
+            snapshot = pending > 0 and (snapshot or pending >= SNAPSHOT_EVERY)
+            
+            if records:
+                try:
+                    with PERSIST_LATENCY.labels('append').time():
+                        self.storage.append(self.room, records)
+                except Exception as e:
+                    PERSIST_ERRORS.labels('append').inc()
+                    log_event(logging.ERROR, 'storage.error', "❌ Ошибка записи журнала [%s]: %s", self.room, e, room=self.room)
+                    with self._lock:
+                        self._journal[:0] = records
+                    # Иначе записи ждали бы следующего действия в комнате
+                    self._flush_failures += 1
+                    if self.flusher is not None:
+                        delay = min(FLUSH_RETRY_DELAY * 2 ** (self._flush_failures - 1), FLUSH_RETRY_MAX_DELAY)
+                        self.flusher.mark_dirty(self, delay)
+                    return False
+                self._flush_failures = 0
+                self._since_snapshot = pending
+            
+            if snapshot:
+                with PERSIST_LATENCY.labels('snapshot').time():
+                    saved = self.storage.snapshot(self.room, state)
+                if saved:
+                    self._since_snapshot = 0
+                else:
+                    PERSIST_ERRORS.labels('snapshot').inc()
+        return True
+    
+    def stop(self):
+        """Не принимать новые операции (StoreClosedError) и разбудить ждущих"""
+        with self._lock:
+            self._closed = True
+            self._changed.notify_all()
+    
+    def reopen(self):
+        """Снова принимать операции: выгрузка не удалась"""
+        with self._lock:
+            self._closed = False
+    
+    def close(self):
+        """Закрыть комнату и записать последние изменения; False - не записались"""
+        self.stop()
+        return self.flush(snapshot=True)
+
+class StateFlusher:
+    """Один фоновый поток на все комнаты: отложенная запись на диск.
+    
+    Комната записывается через FLUSH_DELAY сек тишины после изменения,
+    но не позже FLUSH_MAX_DELAY сек после первого незаписанного изменения.
+    Все комнаты, которым пора, пишутся одной транзакцией storage.batch().
+    """
+    
+    def __init__(self, storage, flush_delay=FLUSH_DELAY, max_delay=FLUSH_MAX_DELAY):
+        self.storage = storage
+        self.flush_delay = flush_delay
+        self.max_delay = max_delay
+        self._pending = {}  # store -> (первое изменение, последнее изменение)
+        self._not_before = {}  # store -> раньше этого не писать (повтор после ошибки)
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def mark_dirty(self, store, delay=0):
+        """Запланировать запись комнаты; delay - не раньше чем через столько сек"""
+        now = time.monotonic()
+        with self._cond:
+            first, _ = self._pending.get(store, (now, now))
+            self._pending[store] = (first, now)
+            if delay:
+                self._not_before[store] = now + delay
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='state-flusher', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+    
+    def close(self):
+        """Остановить поток и записать всё, что ещё не записано"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=self.max_delay + 1)
+        with self._cond:
+            stores = list(self._pending)
+            self._pending.clear()
+            self._not_before.clear()
+        self._flush_all(stores)
+    
+    def _flush_all(self, stores):
+        with PERSIST_LATENCY.labels('batch').time(), self.storage.batch():
+            for store in stores:
+                store.flush()
+    
+    def _take_due(self):
+        """Забрать комнаты, которые пора записать; иначе вернуть время ожидания"""
+        now = time.monotonic()
+        due, timeout = [], None
+        for store, (first, last) in self._pending.items():
+            ready_at = max(min(last + self.flush_delay, first + self.max_delay),
+                           self._not_before.get(store, 0))
+            if ready_at <= now:
+                due.append(store)
+            elif timeout is None or ready_at - now < timeout:
+                timeout = ready_at - now
+        for store in due:
+            del self._pending[store]
+            self._not_before.pop(store, None)
+        return due, timeout
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                due, timeout = self._take_due()
+                while not due and not self._closed:
+                    self._cond.wait(timeout)
+                    due, timeout = self._take_due()
+                if self._closed and not due:
+                    return
+            self._flush_all(due)
+
+class RoomRegistry:
+    """Все комнаты процесса: ленивая загрузка и выгрузка простаивающих"""
+    
+    def __init__(self, storage, idle_ttl=ROOM_IDLE_TTL):
+        self.storage = storage
+        self.idle_ttl = idle_ttl
+        self.flusher = StateFlusher(storage)
+        self.shared = False
+        self.table = None
+        self.listeners = []  # callback(room, state) для каждой комнаты, см. GameStateStore
+        self._rooms = {}
+        self._closing = {}  # комната -> Event: выгружается, последние изменения ещё пишутся
+        self._lock = threading.Lock()
+        self._janitor = None
+        self._follower = None
+        self._closed = False
+    
+    def share_between_processes(self, table=None):
+        """Режим нескольких процессов на одной базе (serve --workers N)
+        
+        Изменения пишутся сразу, под блокировкой базы, а события других
+        процессов подхватываются фоновым потоком раз в SHARED_POLL_INTERVAL.
+        С таблицей в общей памяти (table) чтение видит чужие изменения сразу,
+        а фоновый поток будит SSE и long-poll раз в SHARED_MEMORY_POLL_INTERVAL.
+        """
+        if not hasattr(self.storage, 'exclusive'):
+            raise ValueError("Несколько процессов могут работать только с GAME_STORAGE=sqlite")
+        self.shared = True
+        self.table = table
+        self._follower = threading.Thread(target=self._follow_loop, name='room-follower', daemon=True)
+        self._follower.start()
+    
+    def __len__(self):
+        return len(self._rooms)
+    
+    def loaded(self):
+        """Список (комната, хранилище) загруженных в память комнат"""
+        with self._lock:
+            return list(self._rooms.items())
+    
+    def get(self, room):
+        """Хранилище комнаты; при первом обращении состояние читается с диска"""
+        store = self._rooms.get(room)
+        while store is None:
+            with self._lock:
+                store = self._rooms.get(room)
+                closing = self._closing.get(room)
+                if store is None and closing is None:
+                    store = GameStateStore(room, self.storage, self.flusher, shared=self.shared,
+                                           table=self.table, listeners=self.listeners)
+                    self._rooms[room] = store
+                    self._start_janitor()
+            if store is None:
+                # С диска читаем только после того, как выгрузка всё дописала
+                closing.wait()
+        store.last_access = time.monotonic()
+        return store
+    
+    def wake(self):
+        """Разбудить SSE и long-poll всех загруженных комнат: тело ответа
+        изменилось без новой версии (картинки, каталог кампаний)"""
+        for _, store in self.loaded():
+            store.wake()
+    
+    def touch(self, names):
+        """Отметить комнаты как используемые, не загружая выгруженные"""
+        now = time.monotonic()
+        for name in names:
+            store = self._rooms.get(name)
+            if store is not None:
+                store.last_access = now
+    
+    def execute(self, room, op, **params):
+        """store.execute() с повтором, если комнату как раз выгрузили"""
+        while True:
+            try:
+                return self.get(room).execute(op, **params)
+            except StoreClosedError:
+                continue
+    
+    def rooms_at_level(self, min_level):
+        """{комната: уровень} для всех комнат (и на диске, и в памяти)"""
+        found = self.storage.rooms_at_level(min_level)
+        # Состояние в памяти новее сохранённого снимка
+        for room, store in self.loaded():
+            level = store.get()['level']
+            if level >= min_level:
+                found[room] = level
+            else:
+                found.pop(room, None)
+        return found
+    
+    def evict_idle(self):
+        """Выгрузить комнаты без обращений и без подписчиков дольше idle_ttl"""
+        deadline = time.monotonic() - self.idle_ttl
+        idle = self._unload(lambda store: store.last_access < deadline and store.watchers == 0,
+                            keep_failed=True)
+        if idle:
+            log_event(logging.INFO, 'rooms.evict', "🧹 Выгружено комнат: %s, в памяти: %s", len(idle), len(self._rooms))
+        return len(idle)
+    
+    def release(self):
+        """Выгрузить все комнаты, записав их; SSE и long-poll клиенты отключатся"""
+        self._unload(lambda store: True)
+    
+    def _unload(self, select, keep_failed=False):
+        """Убрать из памяти комнаты, для хранилищ которых select(store)
+        истинно, записав их журнал; вернуть имена выгруженных
+        
+        Пока журнал пишется, комната числится в _closing: get() ждёт, а не
+        читает с диска состояние без последних изменений, и операции над
+        старым хранилищем получают StoreClosedError и повторяются в новом.
+        keep_failed - комнаты, которые записать не удалось, остаются в памяти.
+        """
+        done = threading.Event()
+        with self._lock:
+            names = [room for room, store in self._rooms.items() if select(store)]
+            stores = [self._rooms.pop(room) for room in names]
+            for store in stores:
+                store.stop()
+                self._closing[store.room] = done
+        failed = []
+        try:
+            with self.storage.batch():
+                failed = [store for store in stores if not store.close()]
+        finally:
+            with self._lock:
+                for store in stores:
+                    del self._closing[store.room]
+                if keep_failed:
+                    for store in failed:
+                        store.reopen()
+                        self._rooms[store.room] = store
+            done.set()
+        if failed:
+            log_event(logging.WARNING, 'rooms.evict', "⚠️ Не записаны при выгрузке: %s",
+                      ', '.join(store.room for store in failed))
+        return [store.room for store in stores if store not in failed]
+    
+    def close(self):
+        """Остановка сервера: записать все комнаты (повторный вызов ничего не делает)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._follower is not None:
+            self._follower.join(timeout=1)
+        self.release()
+        self.flusher.close()
+        self.storage.close()
+    
+    def _start_janitor(self):
+        if self._janitor is None:
+            self._janitor = threading.Thread(target=self._sweep_loop, name='room-janitor', daemon=True)
+            self._janitor.start()
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(ROOM_SWEEP_INTERVAL)
+            self.evict_idle()
+    
+    def _follow_loop(self):
+        interval = SHARED_POLL_INTERVAL if self.table is None else SHARED_MEMORY_POLL_INTERVAL
+        while not self._closed:
+            time.sleep(interval)
+            for room, store in self.loaded():
+                try:
+                    store.sync()
+                except Exception as e:
+                    log_event(logging.ERROR, 'storage.error', "❌ Ошибка чтения событий [%s]: %s", room, e, room=room)
+
+rooms = RoomRegistry(storage)
+atexit.register(rooms.close)
+
+class RoomConverter(BaseConverter):
+    """<room:...> в URL: только безопасные для имени файла символы"""
+    regex = ROOM_ID_PATTERN
+
+app.url_map.converters['room'] = RoomConverter
+
+# ==================== МАНИФЕСТ МЕДИА ====================
+
+class MediaManifest:
+    """Имена файлов media/ с отпечатком содержимого: monster2.jpeg -> monster2.3fa9c1d2.jpeg.
+    
+    Отпечатанный URL никогда не меняет содержимое, поэтому браузер кэширует
+    его навсегда. Файл перехешируется, только если изменились mtime или размер.
+    """
+    
+    HASH_LENGTH = 8
+    
+    def __init__(self, media_dir=MEDIA_DIR):
+        self.media_dir = media_dir
+        self.on_change = []  # вызываются после изменения манифеста
+        self._entries = {}   # имя -> (mtime_ns, size, отпечаток, отпечатанное имя)
+        self._hashed = {}    # отпечатанное имя -> имя
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.refresh()
+    
+    def _hash_file(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()[:self.HASH_LENGTH]
+    
+    def refresh(self):
+        """Пересканировать media/; True - манифест изменился"""
+        entries = {}
+        try:
+            scanned = list(os.scandir(self.media_dir))
+        except OSError:
+            scanned = []
+        for item in scanned:
+            if item.name.startswith('.') or not item.is_file():
+                continue
+            file_stat = item.stat()
+            old = self._entries.get(item.name)
+            if old is not None and old[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+                entries[item.name] = old
+                continue
+            try:
+                digest = self._hash_file(item.path)
+            except OSError:
+                continue
+            stem, ext = os.path.splitext(item.name)
+            entries[item.name] = (file_stat.st_mtime_ns, file_stat.st_size, digest, f'{stem}.{digest}{ext}')
+        
+        if entries == self._entries:
+            return False
+        with self._lock:
+            self._entries = entries
+            self._hashed = {entry[3]: name for name, entry in entries.items()}
+        log_event(logging.INFO, 'media.manifest', "🗂️ Манифест медиа: %s файлов", len(entries))
+        for callback in self.on_change:
+            callback()
+        return True
+    
+    def url(self, name):
+        """URL файла media/ с отпечатком (или обычный, если файла нет)"""
+        entry = self._entries.get(name)
+        if entry is None:
+            return f'/media/{name}'
+        return f'/media/{entry[3]}'
+    
+    def items(self):
+        """[(имя, (mtime_ns, size, отпечаток, отпечатанное имя))]"""
+        return list(self._entries.items())
+    
+    def path(self, name):
+        return os.path.join(self.media_dir, name)
+    
+    def digest(self, name):
+        entry = self._entries.get(name)
+        return entry[2] if entry is not None else None
+    
+    def asset(self, path):
+        """{url, size, hash} для '/media/...' - описание для предзагрузки"""
+        name = path[len('/media/'):] if path.startswith('/media/') else path
+        entry = self._entries.get(name)
+        if entry is None:
+            return {'url': path, 'size': None, 'hash': None}
+        return {'url': f'/media/{entry[3]}', 'size': entry[1], 'hash': entry[2]}
+    
+    def resolve(self, filename):
+        """(настоящее имя, отпечаток совпал) для запрошенного имени"""
+        name = self._hashed.get(filename)
+        if name is not None:
+            return name, True
+        # Устаревший отпечаток: отдаём текущий файл, но без вечного кэша
+        stem, ext = os.path.splitext(filename)
+        base, dot, digest = stem.rpartition('.')
+        if dot and len(digest) == self.HASH_LENGTH and all(c in '0123456789abcdef' for c in digest):
+            return base + ext, False
+        return filename, False
+    
+    def start_watcher(self, interval=MEDIA_SCAN_INTERVAL):
+        """Фоновая перепроверка media/ раз в interval секунд"""
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_loop, args=(interval,), name='media-watcher', daemon=True)
+            self._watcher.start()
+    
+    def _watch_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log_event(logging.ERROR, 'media.error', "❌ Ошибка манифеста медиа: %s", e)
+
+media_manifest = MediaManifest()
+media_manifest.start_watcher()
+
+def media_url(path):
+    """'/media/monster1.jpeg' -> URL с отпечатком; прочие пути без изменений"""
+    if path.startswith('/media/'):
+        return media_manifest.url(path[len('/media/'):])
+    return path
+
+# ==================== ВАРИАНТЫ КАРТИНОК ====================
+# Уменьшенные копии картинок в WebP/AVIF/JPEG. Нужен Pillow (pip install pillow);
+# без него картинки отдаются как есть.
+
+def render_image_variant(src_path, dst_path, width, fmt):
+    """Уменьшить картинку до ширины width и сохранить в формате fmt (в отдельном процессе)
+    
+    Пишется во временный файл <имя>.<случайное>.tmp и только целиком
+    переименовывается в dst_path: по этому адресу файл кэшируется на год.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path), prefix=os.path.basename(dst_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, Image.open(src_path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((width, width * 10))  # никогда не увеличивает
+            if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(f, format=fmt.upper(), quality=IMAGE_VARIANT_QUALITY[fmt])
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return dst_path
+
+class ImageVariants:
+    """Варианты картинок media/ в пуле процессов, кэш на диске по отпечатку.
+    
+    Файл варианта - <отпечаток>-<ширина>.<формат> в IMAGE_VARIANT_DIR, поэтому
+    готовые варианты переживают перезапуск, а изменённая картинка получает новые.
+    
+    Считает и чистит папку кэша один процесс - тот, кто держит flock на
+    .render.lock в ней. Остальные (serve --workers) ждут готовые файлы и
+    забирают их; если считающий процесс завершился, его место занимает
+    следующий.
+    """
+    
+    LOCK_NAME = '.render.lock'
+    
+    # В порядке предпочтения; jpeg - для браузеров без WebP/AVIF
+    FORMATS = (('avif', 'image/avif'), ('webp', 'image/webp'), ('jpeg', 'image/jpeg'))
+    SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+    
+    def __init__(self, manifest, cache_dir=IMAGE_VARIANT_DIR, widths=IMAGE_VARIANT_WIDTHS):
+        self.manifest = manifest
+        self.cache_dir = cache_dir
+        self.widths = widths
+        self.formats = self._available_formats()
+        self._ready = {}      # имя -> (отпечаток, {(формат, ширина): (путь, размер)})
+        self._pending = set()  # пути, которые считает этот процесс
+        self._awaited = {}     # путь -> аргументы _register: его считает другой процесс
+        self._collected_at = 0.0
+        self._lock_file = None
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _available_formats():
+        if Image is None:
+            return ()
+        formats = []
+        for fmt, mimetype in ImageVariants.FORMATS:
+            try:
+                supported = fmt == 'jpeg' or pil_features.check(fmt)
+            except Exception:
+                supported = False
+            if supported:
+                formats.append((fmt, mimetype))
+        return tuple(formats)
+    
+    @property
+    def enabled(self):
+        return bool(self.formats)
+    
+    def handles(self, name):
+        return self.enabled and name.lower().endswith(self.SOURCE_EXTENSIONS)
+    
+    def _claim(self):
+        """Стать процессом, который считает варианты; True - если им и остаёмся"""
+        if self._lock_file is not None or fcntl is None:
+            return True
+        lock_file = open(os.path.join(self.cache_dir, self.LOCK_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+    
+    def start(self):
+        """Посчитать недостающие варианты и пересчитывать их при изменении media/
+        
+        Зовём при запуске сервера, а не при импорте: процессы пула, запущенные
+        через spawn (нет fork), импортируют модуль заново и запустили бы свой пул.
+        """
+        self.manifest.on_change.append(self.schedule)
+        self.schedule()
+        atexit.register(self.close)
+    
+    def schedule(self):
+        """Поставить в очередь недостающие варианты всех картинок media/"""
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        renderer = self._claim()
+        with self._lock:
+            self._awaited = {}
+        wanted = set()
+        for name, (_, size, digest, _) in self.manifest.items():
+            if not self.handles(name):
+                continue
+            is_jpeg = name.lower().endswith(('.jpg', '.jpeg'))
+            with self._lock:
+                if self._ready.get(name, (None,))[0] != digest:
+                    self._ready[name] = (digest, {})
+            for fmt, _ in self.formats:
+                if fmt == 'jpeg' and not is_jpeg:
+                    continue  # PNG с прозрачностью в JPEG не превращаем
+                for width in self.widths:
+                    dst_path = os.path.join(self.cache_dir, f'{digest}-{width}.{fmt}')
+                    wanted.add(os.path.basename(dst_path))
+                    if os.path.exists(dst_path):
+                        self._register(name, digest, fmt, width, dst_path, size)
+                    elif renderer:
+                        self._submit(name, digest, fmt, width, dst_path, size)
+                    else:
+                        with self._lock:
+                            self._awaited[dst_path] = (name, digest, fmt, width, dst_path, size)
+        if renderer:
+            self._remove_stale(wanted)
+    
+    def _collect(self):
+        """Забрать варианты, которые досчитал другой процесс (не чаще
+        раза в IMAGE_VARIANT_COLLECT_INTERVAL сек)"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._awaited or now - self._collected_at < IMAGE_VARIANT_COLLECT_INTERVAL:
+                return
+            self._collected_at = now
+            awaited = list(self._awaited.values())
+        if self._claim():
+            # Считавший процесс завершился, не закончив: досчитываем сами
+            self.schedule()
+            return
+        for job in awaited:
+            if os.path.exists(job[4]):
+                with self._lock:
+                    self._awaited.pop(job[4], None)
+                self._register(*job)
+    
+    def _submit(self, name, digest, fmt, width, dst_path, source_size):
+        with self._lock:
+            if dst_path in self._pending:
+                return
+            self._pending.add(dst_path)
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        future = self._executor.submit(render_image_variant, self.manifest.path(name), dst_path, width, fmt)
+        
+        def done(future):
+            with self._lock:
+                self._pending.discard(dst_path)
+            try:
+                future.result()
+            except Exception as e:
+                log_event(logging.ERROR, 'media.error', "❌ Ошибка обработки %s (%s, %spx): %s", name, fmt, width, e)
+                return
+            self._register(name, digest, fmt, width, dst_path, source_size)
+        
+        future.add_done_callback(done)
+    
+    def _register(self, name, digest, fmt, width, path, source_size):
+        size = os.path.getsize(path)
+        if size >= source_size:
+            return  # вариант не меньше оригинала - смысла нет
+        with self._lock:
+            ready = self._ready.get(name)
+            if ready is not None and ready[0] == digest:
+                ready[1][(fmt, width)] = (path, size)
+    
+    def _remove_stale(self, wanted):
+        """Удалить варианты картинок, которых больше нет, и брошенные временные файлы"""
+        with self._lock:
+            pending = {os.path.basename(path) for path in self._pending}
+        for item in os.scandir(self.cache_dir):
+            if item.name in wanted or item.name == self.LOCK_NAME:
+                continue
+            # <вариант>.<случайное>.tmp: вариант ещё пишется
+            if item.name.endswith('.tmp') and item.name.rsplit('.', 2)[0] in pending:
+                continue
+            try:
+                os.remove(item.path)
+            except OSError:
+                pass
+    
+    def busy(self, name):
+        """Варианты картинки ещё считаются (этим или другим процессом)"""
+        prefix = os.path.join(self.cache_dir, f'{self.manifest.digest(name)}-')
+        with self._lock:
+            return any(path.startswith(prefix) for paths in (self._pending, self._awaited) for path in paths)
+    
+    def pick(self, name, accepted, width_hint=None):
+        """(путь, mimetype) лучшего готового варианта или None - отдать оригинал"""
+        self._collect()
+        digest = self.manifest.digest(name)
+        with self._lock:
+            ready = self._ready.get(name)
+            if ready is None or ready[0] != digest or not ready[1]:
+                return None
+            variants = dict(ready[1])
+        for fmt, mimetype in self.formats:
+            if fmt != 'jpeg' and mimetype not in accepted:
+                continue
+            widths = sorted(width for f, width in variants if f == fmt)
+            if not widths:
+                continue
+            width = widths[-1]
+            if width_hint:
+                width = next((w for w in widths if w >= width_hint), widths[-1])
+            return variants[(fmt, width)][0], mimetype
+        return None
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+image_variants = ImageVariants(media_manifest)
+
+# ==================== КЭШ ОТВЕТОВ ====================
+
+def build_game_payload(state):
+    """Собрать ответ /api/game из состояния"""
+    boss_info = get_boss_info(state['level'], state.get('campaign'))
+    
+    return {
+        'level': state['level'],
+        'hp': state['current_hp'],
+        'max_hp': state['max_hp'],
+        'monster': boss_info['name'],
+        'emoji': boss_info['emoji'],
+        'image': media_url(boss_info['image']),
+        'background': build_background(boss_info),
+        'level_up_video': media_url(LEVEL_UP_VIDEO),
+        'campaign': state.get('campaign', DEFAULT_CAMPAIGN),
+        'version': state['version'],
+        'g': payload_cache.generation,
+        'timestamp': state['last_updated']
+    }
+
+def encode_json(data):
+    """Компактный JSON без экранирования кириллицы"""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+class StagePayloadCache:
+    """Заранее закодированные JSON-фрагменты стадий всех кампаний.
+    
+    У стадии меняются только hp/level/version/timestamp, поэтому всё
+    остальное кодируется один раз, а в ответ вклеиваются лишь
+    динамические поля. Готовое тело /api/game запоминается для
+    последней версии каждой комнаты.
+    """
+    
+    MAX_MEMO = 4096
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._generation = 0
+        self.on_change = []  # вызываются после перекодирования фрагментов
+        self.rebuild()
+    
+    def rebuild(self):
+        """Перекодировать фрагменты (при старте, изменении каталога или media/)"""
+        # Кампания -> кортеж фрагментов по индексу стадии
+        game, level_up = {}, {}
+        video = media_url(LEVEL_UP_VIDEO)
+        for campaign, stages in campaigns.catalog.stages.items():
+            game_stages, level_up_stages = [], []
+            for boss_info in stages:
+                background = build_background(boss_info)
+                # Срезаем внешние скобки: фрагмент вклеивается внутрь объекта
+                image = media_url(boss_info['image'])
+                game_stages.append(encode_json({
+                    'monster': boss_info['name'],
+                    'emoji': boss_info['emoji'],
+                    'image': image,
+                    'background': background,
+                    'level_up_video': video,
+                    'campaign': campaign,
+                })[1:-1])
+                level_up_stages.append(encode_json({
+                    'new_boss': boss_info['name'],
+                    'emoji': boss_info['emoji'],
+                    'image': image,
+                    'level_up_video': video,
+                    'background': background,
+                })[1:-1])
+            game[campaign], level_up[campaign] = tuple(game_stages), tuple(level_up_stages)
+        with self._lock:
+            self._game, self._level_up = game, level_up
+            self._generation += 1
+            self._memo = {}
+        for callback in self.on_change:
+            callback()
+    
+    def _stage(self, state):
+        """(кампания, индекс стадии) состояния"""
+        return self._stage_at(state.get('campaign'), state['level'])
+    
+    def _stage_at(self, campaign, level):
+        """(кампания, индекс стадии) уровня; кампании, которой ещё или уже
+        нет во фрагментах, соответствует кампания по умолчанию"""
+        stages = self._game.get(campaign)
+        if stages is None:
+            campaign, stages = DEFAULT_CAMPAIGN, self._game[DEFAULT_CAMPAIGN]
+        return campaign, (level - 1) % len(stages)
+    
+    def game_body(self, room, state):
+        """Тело ответа /api/game (str) для состояния комнаты"""
+        key = (state['version'], self._generation)
+        memo = self._memo.get(room)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+        version = state['version']
+        campaign, stage = self._stage(state)
+        body = (
+            f'{{"level":{state["level"]},"hp":{state["current_hp"]},'
+            f'"max_hp":{state["max_hp"]},"version":{version},"g":{self._generation},'
+            f'"timestamp":{encode_json(state["last_updated"])},'
+            f'{self._game[campaign][stage]}}}'
+        )
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo = {}
+        self._memo[room] = (key, body)
+        return body
+    
+    @property
+    def generation(self):
+        """Номер сборки фрагментов: меняется вместе с картинками и каталогом"""
+        return self._generation
+    
+    def delta(self, state, old, generation=None):
+        """Поля ответа /api/game, изменившиеся после old (RecentState или None -
+        клиент ничего не знает).
+        
+        Возвращает (поля, фрагмент стадии или None): фрагмент - монстр,
+        картинка и фон - нужен, только если сменилась стадия или сборка.
+        """
+        fields = {'version': state['version']}
+        for key, name in (('level', 'level'), ('current_hp', 'hp'), ('max_hp', 'max_hp')):
+            if old is None or getattr(old, key) != state[key]:
+                fields[name] = state[key]
+        campaign, stage = self._stage(state)
+        if (old is not None and generation == self._generation
+                and self._stage_at(old.campaign, old.level) == (campaign, stage)):
+            return fields, None
+        fields['g'] = self._generation
+        return fields, self._game[campaign][stage]
+    
+    def level_up_body(self, state, old_level):
+        """Тело ответа /api/level-up (str)"""
+        campaign, stage = self._stage(state)
+        return (
+            f'{{"success":true,"old_level":{old_level},"new_level":{state["level"]},'
+            f'"new_hp":{state["current_hp"]},"new_max_hp":{state["max_hp"]},'
+            f'{self._level_up[campaign][stage]}}}'
+        )
+
+payload_cache = StagePayloadCache()
+
+# Двоичная дельта: флаги, version, сборка; дальше поля по флагам и JSON стадии
+DELTA_HEADER = struct.Struct('<BIH')
+DELTA_FIELDS = (('level', 1, struct.Struct('<I')), ('hp', 2, struct.Struct('<I')), ('max_hp', 4, struct.Struct('<I')))
+DELTA_STAGE = 8
+
+def encode_delta_json(fields, stage):
+    """Дельта в JSON: изменившиеся поля и, если нужно, фрагмент стадии"""
+    body = encode_json(fields)
+    return body if stage is None else f'{body[:-1]},{stage}}}'
+
+def encode_delta_binary(fields, stage):
+    """Дельта в двоичном виде: обычно 7-19 байт вместо сотен"""
+    flags, parts = 0, []
+    for name, flag, packer in DELTA_FIELDS:
+        if name in fields:
+            flags |= flag
+            parts.append(packer.pack(fields[name]))
+    if stage is not None:
+        flags |= DELTA_STAGE
+        parts.append(f'{{{stage}}}'.encode('utf-8'))
+    header = DELTA_HEADER.pack(flags, fields['version'], fields.get('g', payload_cache.generation) & 0xFFFF)
+    return header + b''.join(parts)
+media_manifest.on_change.append(payload_cache.rebuild)
+campaigns.on_change.append(payload_cache.rebuild)
+# Подписчики SSE и long-poll получают новое тело той же версии
+payload_cache.on_change.append(rooms.wake)
+
+def json_response(body, status=200):
+    """Ответ с уже закодированным JSON"""
+    return Response(body, status=status, mimetype='application/json')
+
+# ==================== API ROUTES ====================
+
+class PushSlots:
+    """Места для SSE и long-poll в пуле потоков serve
+    
+    Такой запрос занимает поток пула, пока открыт. Без ограничения
+    несколько классов с открытыми потоками заняли бы весь пул, и обычные
+    запросы (атака учителя, /api/game) ждали бы в очереди. limit=None -
+    без ограничения: отладочный сервер и bench запускают поток на каждое
+    соединение, а serve --async держит SSE и long-poll в цикле событий.
+    """
+    
+    def __init__(self):
+        self.limit = None
+        self.used = 0
+        self._lock = threading.Lock()
+    
+    def acquire(self, kind):
+        with self._lock:
+            if self.limit is None or self.used < self.limit:
+                self.used += 1
+                return True
+        PUSH_REJECTED.labels(kind).inc()
+        return False
+    
+    def release(self):
+        with self._lock:
+            self.used -= 1
+    
+    @contextmanager
+    def hold(self, kind):
+        """Место на время блока; None, если мест нет"""
+        if not self.acquire(kind):
+            yield None
+            return
+        try:
+            yield self
+        finally:
+            self.release()
+
+push_slots = PushSlots()
+
+def push_unavailable():
+    """503: мест для SSE и long-poll нет, клиенту стоит опрашивать без ожидания"""
+    response = Response(status=503)
+    response.headers['Retry-After'] = str(SERVE_PUSH_RETRY)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def state_etag(state):
+    """ETag ответа /api/game - меняется вместе с версией состояния и сборкой
+    фрагментов (картинки и каталог меняют тело без новой версии)"""
+    return f"v{state['version']}-g{payload_cache.generation}"
+
+@app.route('/api/game', methods=['GET'])
+@app.route('/r/<room:room>/api/game', methods=['GET'])
+def get_game_state(room=DEFAULT_ROOM):
+    """Получить текущее состояние игры
+    
+    Поддерживает If-None-Match (ответ 304 без тела) и long-poll:
+    ?wait=25&since=<version>&g=<сборка> ждёт изменения до wait секунд
+    (version и g - из предыдущего ответа).
+    """
+    store = rooms.get(room)
+    state = store.get()
+    since = request.args.get('since', type=int)
+    generation = request.args.get('g', type=int)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    
+    def unchanged(state):
+        return since == state['version'] and generation == payload_cache.generation
+    
+    if wait > 0 and unchanged(state):
+        with push_slots.hold('long-poll') as slot:
+            if slot is None:
+                return push_unavailable()
+            with LONG_POLL_WAITERS.track():
+                state = store.wait_for_change(since, wait, generation) or store.get()
+    
+    etag = state_etag(state)
+    if unchanged(state) or request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    response = json_response(payload_cache.game_body(room, state))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    
+    log_event(logging.INFO, 'game.poll', "📊 GET /api/game [%s]: Уровень %s, ХП %s/%s",
+              room, state['level'], state['current_hp'], state['max_hp'], room=room)
+    return response
+
+@app.route('/api/game/delta', methods=['GET'])
+@app.route('/r/<room:room>/api/game/delta', methods=['GET'])
+def get_game_delta(room=DEFAULT_ROOM):
+    """Только изменившиеся поля /api/game: ?since=<version>&g=<сборка>
+    
+    Пустой 304 - ничего не изменилось. Иначе - поля, которые изменились
+    после версии since (монстр, картинка и фон - только при смене стадии).
+    ?wait= - long-poll, как у /api/game; ?format=bin - двоичный ответ.
+    """
+    store = rooms.get(room)
+    state = store.get()
+    since = request.args.get('since', type=int)
+    generation = request.args.get('g', type=int)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    
+    def unchanged(state):
+        return since == state['version'] and generation == payload_cache.generation
+    
+    if wait > 0 and unchanged(state):
+        with push_slots.hold('long-poll') as slot:
+            if slot is None:
+                return push_unavailable()
+            with LONG_POLL_WAITERS.track():
+                state = store.wait_for_change(since, wait, generation) or store.get()
+    if unchanged(state):
+        response = Response(status=304)
+    else:
+        old = store.state_at(since) if since is not None else None
+        fields, stage = payload_cache.delta(state, old, generation)
+        if request.args.get('format') == 'bin':
+            response = Response(encode_delta_binary(fields, stage), mimetype='application/octet-stream')
+        else:
+            response = json_response(encode_delta_json(fields, stage))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def sse_state_frames(room, state, top):
+    """Кадры SSE о новом состоянии: state и, если топ изменился, leaderboard
+    (только изменившиеся места относительно top). Вернуть (кадры, новый топ)."""
+    version = state['version']
+    frames = f"id: {version}\nevent: state\ndata: {payload_cache.game_body(room, state)}\n\n"
+    new_top = state.get('top', [])
+    if new_top != top:
+        delta = encode_json({'version': version, 'size': len(new_top), 'set': leaderboard_delta(top, new_top)})
+        frames += f"event: leaderboard\ndata: {delta}\n\n"
+    return frames, new_top
+
+@app.route('/api/game/stream', methods=['GET'])
+@app.route('/r/<room:room>/api/game/stream', methods=['GET'])
+def game_stream(room=DEFAULT_ROOM):
+    """Поток Server-Sent Events: новое состояние сразу после каждого изменения"""
+    # Переподключившийся браузер сам присылает Last-Event-ID = последняя версия
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    since = int(last_event_id) if last_event_id.isdigit() else -1
+    
+    if not push_slots.acquire('sse'):
+        log_event(logging.WARNING, 'sse.rejected', "⚠️ SSE [%s]: свободных мест в пуле нет (занято %s), ответ 503",
+                  room, push_slots.limit, room=room)
+        return push_unavailable()
+    store = rooms.get(room)
+    
+    def generate(since):
+        top = []  # топ, который уже знает клиент: шлём только изменившиеся места
+        generation = payload_cache.generation
+        with SSE_SUBSCRIBERS.track():
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            # Если комнату выгрузят, поток закроется и браузер переподключится
+            while not store.closed:
+                store.last_access = time.monotonic()
+                state = store.wait_for_change(since, SSE_HEARTBEAT, generation)
+                if state is None:
+                    yield "event: ping\ndata: {}\n\n"
+                    continue
+                since, generation = state['version'], payload_cache.generation
+                frames, top = sse_state_frames(room, state, top)
+                yield frames
+    
+    log_event(logging.INFO, 'sse.connect', "📡 SSE [%s]: подключение (Last-Event-ID=%s)", room, last_event_id or '-', room=room)
+    response = Response(generate(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx не должен буферизовать поток
+    })
+    # Место освобождается с закрытием ответа, даже если поток не начался
+    response.call_on_close(push_slots.release)
+    return response
+
+@app.route('/api/award-points', methods=['POST'])
+@app.route('/r/<room:room>/api/award-points', methods=['POST'])
+def award_points(room=DEFAULT_ROOM):
+    """Учитель начисляет баллы (урон боссу)"""
+    try:
+        data = request.json or {}
+        params = {'amount': int(data.get('amount', 0))}
+        if data.get('student'):
+            params['student'] = str(data['student'])
+        
+        state, result = rooms.execute(room, 'award', **params)
+        damage = result['damage']
+        
+        boss_info = get_boss_info(state['level'], state.get('campaign'))
+        
+        response_data = {
+            'success': True,
+            'damage': damage,
+            'new_hp': state['current_hp'],
+            'max_hp': state['max_hp'],
+            'boss_dead': state['current_hp'] <= 0,
+            'level': state['level'],
+            'monster': boss_info['name']
+        }
+        if 'student' in result:
+            response_data['student'] = result['student']
+            response_data['total'] = result['total']
+        
+        log_event(logging.INFO, 'game.award', "💥 award_points [%s]: Урон %s, осталось %s ХП", room, damage, state['current_hp'], room=room)
+        return jsonify(response_data)
+    except Exception as e:
+        log_event(logging.ERROR, 'game.error', "❌ Ошибка award_points: %s", e, room=room)
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/level-up', methods=['POST'])
+@app.route('/r/<room:room>/api/level-up', methods=['POST'])
+def level_up(room=DEFAULT_ROOM):
+    """Переход на новый уровень"""
+    try:
+        # Уровень и ХП меняются одной атомарной операцией
+        state, result = rooms.execute(room, 'level_up')
+        old_level = result['old_level']
+        next_boss = get_boss_info(state['level'], state.get('campaign'))
+        
+        log_event(logging.INFO, 'game.level_up', "🚀 level_up [%s]: Уровень %s → %s, новый босс: %s",
+                  room, old_level, state['level'], next_boss['name'], room=room)
+        return json_response(payload_cache.level_up_body(state, old_level))
+    except Exception as e:
+        log_event(logging.ERROR, 'game.error', "❌ Ошибка level_up: %s", e, room=room, exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/reset', methods=['POST'])
+@app.route('/r/<room:room>/api/reset', methods=['POST'])
+def reset_game(room=DEFAULT_ROOM):
+    """Сбросить игру"""
+    try:
+        rooms.execute(room, 'reset')
+        
+        log_event(logging.INFO, 'game.reset', "♻️  Игра перезагружена [%s]", room, room=room)
+        return jsonify({'success': True, 'message': 'Game reset'})
+    except Exception as e:
+        log_event(logging.ERROR, 'game.error', "❌ Ошибка reset: %s", e, room=room)
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/commands', methods=['POST'])
+@app.route('/r/<room:room>/api/commands', methods=['POST'])
+def run_commands(room=DEFAULT_ROOM):
+    """Пакет действий учителя: {"commands": [{"op": "award", "amount": 100}, ...]}
+    
+    Операции (award, level_up, reset, set_hp, set_campaign) применяются по порядку и
+    атомарно: либо все, либо ни одной. Ученики видят только итог, а на
+    диск уходит одно событие журнала.
+    """
+    try:
+        commands = (request.json or {}).get('commands')
+        if not isinstance(commands, list) or not commands or not all(isinstance(c, dict) for c in commands):
+            raise ValueError("Нужен непустой список commands: [{\"op\": ...}, ...]")
+        if len(commands) > COMMANDS_MAX:
+            raise ValueError(f"Не больше {COMMANDS_MAX} операций за раз")
+        
+        state, result = rooms.execute(room, 'batch', commands=commands)
+        
+        log_event(logging.INFO, 'game.commands', "📦 commands [%s]: %s операций, уровень %s, ХП %s/%s",
+                  room, len(commands), state['level'], state['current_hp'], state['max_hp'], room=room)
+        return json_response(
+            f'{{"success":true,"results":{encode_json(result["results"])},'
+            f'"state":{payload_cache.game_body(room, state)}}}'
+        )
+    except Exception as e:
+        log_event(logging.ERROR, 'game.error', "❌ Ошибка commands: %s", e, room=room)
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/leaderboard', methods=['GET'])
+@app.route('/r/<room:room>/api/leaderboard', methods=['GET'])
+def get_leaderboard(room=DEFAULT_ROOM):
+    """Топ учеников комнаты по урону боссу (ETag - версия состояния)"""
+    state = rooms.get(room).get()
+    etag = state_etag(state)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = json_response(encode_json({
+            'version': state['version'],
+            'top': [{'student': student, 'damage': damage} for student, damage in state.get('top', [])],
+            'students': len(state.get('scores', {})),
+        }))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def stage_assets(level, campaign=None):
+    """Медиа стадии для предзагрузки"""
+    return {
+        'level': level,
+        'image': media_manifest.asset(get_boss_info(level, campaign)['image']),
+    }
+
+@app.route('/api/assets', methods=['GET'])
+@app.route('/r/<room:room>/api/assets', methods=['GET'])
+def get_assets(room=DEFAULT_ROOM):
+    """Медиа текущей и следующей стадии (с размерами и отпечатками)"""
+    state = rooms.get(room).get()
+    level, campaign = state['level'], state.get('campaign')
+    response = jsonify({
+        'current': stage_assets(level, campaign),
+        'next': stage_assets(level + 1, campaign),
+        'video': media_manifest.asset(LEVEL_UP_VIDEO),
+        'prefetch_window_ms': ASSET_PREFETCH_WINDOW_MS,
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/history', methods=['GET'])
+@app.route('/r/<room:room>/api/history', methods=['GET'])
+def get_history(room=DEFAULT_ROOM):
+    """История ХП комнаты для графика: записи новее версии ?since= (последней
+    version прошлого ответа), сжатые до ?points= точек (по умолчанию HISTORY_POINTS)"""
+    since = request.args.get('since', -1, type=int)
+    points = max(1, min(request.args.get('points', HISTORY_POINTS, type=int), HISTORY_POINTS_MAX))
+    response = json_response(encode_json(rooms.get(room).history(since, points)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/campaigns', methods=['GET'])
+@app.route('/r/<room:room>/api/campaigns', methods=['GET'])
+def list_campaigns(room=DEFAULT_ROOM):
+    """Кампании из каталога и кампания этой комнаты"""
+    catalog = campaigns.catalog
+    response = jsonify({
+        'campaigns': catalog.describe(),
+        'default': DEFAULT_CAMPAIGN,
+        'current': rooms.get(room).get().get('campaign', DEFAULT_CAMPAIGN),
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/campaign', methods=['POST'])
+@app.route('/r/<room:room>/api/campaign', methods=['POST'])
+def set_campaign(room=DEFAULT_ROOM):
+    """Выбрать кампанию комнаты: {"campaign": "math"} - игра начинается с её уровня 1"""
+    try:
+        campaign = str((request.json or {}).get('campaign', ''))
+        state, result = rooms.execute(room, 'set_campaign', campaign=campaign)
+        
+        log_event(logging.INFO, 'game.campaign', "📚 Кампания [%s]: %s (%s стадий)",
+                  room, campaign, result['stages'], room=room)
+        return json_response(
+            f'{{"success":true,"campaign":{encode_json(campaign)},"stages":{result["stages"]},'
+            f'"state":{payload_cache.game_body(room, state)}}}'
+        )
+    except Exception as e:
+        log_event(logging.ERROR, 'game.error', "❌ Ошибка campaign: %s", e, room=room)
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/rooms', methods=['GET'])
+def list_rooms():
+    """Комнаты на уровне не ниже ?min_level= (по умолчанию - все)"""
+    min_level = request.args.get('min_level', 1, type=int)
+    found = rooms.rooms_at_level(min_level)
+    return jsonify({
+        'rooms': [{'room': room, 'level': level} for room, level in sorted(found.items())],
+        'loaded': len(rooms),
+    })
+
+@app.route('/api/logs', methods=['GET'])
+@app.route('/r/<room:room>/api/logs', methods=['GET'])
+def get_logs(room=DEFAULT_ROOM):
+    """Последние записи лога (комнаты и общие) новее ?since=<seq>"""
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), LOG_RING_SIZE))
+    items, last_seq = log_ring.since(since, room, limit)
+    return jsonify({'items': items, 'last_seq': last_seq, 'dropped': log_queue_handler.dropped})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# ==================== МЕДИА ROUTES ====================
+
+class MediaCache:
+    """LRU-кэш небольших медиа-файлов в памяти (ключ - путь, mtime и размер)"""
+    
+    def __init__(self, max_item_bytes=MEDIA_CACHE_ITEM_BYTES, max_total_bytes=MEDIA_CACHE_TOTAL_BYTES):
+        self.max_item_bytes = max_item_bytes
+        self.max_total_bytes = max_total_bytes
+        self._items = OrderedDict()  # path -> ((mtime_ns, size), data)
+        self._total = 0
+        self._lock = threading.Lock()
+    
+    def get(self, path, file_stat):
+        """Содержимое файла из памяти; None - файл слишком большой для кэша"""
+        key = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self._lock:
+            item = self._items.get(path)
+            if item is not None and item[0] == key:
+                self._items.move_to_end(path)
+                return item[1]
+        if file_stat.st_size > self.max_item_bytes:
+            return None
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            old = self._items.pop(path, None)
+            if old is not None:
+                self._total -= len(old[1])
+            self._items[path] = (key, data)
+            self._total += len(data)
+            while self._total > self.max_total_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._total -= len(evicted)
+        return data
+
+media_cache = MediaCache()
+
+@app.route('/media/<filename>', methods=['GET'])
+def serve_media(filename):
+    """Служить медиа-файлы
+    
+    ETag/Last-Modified/Cache-Control, ответ 304 и Range-запросы (перемотка
+    видео) есть для всех файлов. Маленькие картинки отдаются из памяти,
+    большие - через send_file (sendfile/X-Sendfile, если сервер умеет).
+    Имена с актуальным отпечатком из манифеста кэшируются на год (immutable).
+    """
+    try:
+        name, immutable = media_manifest.resolve(filename)
+        max_age = MEDIA_IMMUTABLE_MAX_AGE if immutable else MEDIA_MAX_AGE
+        # safe_join отсекает '..' и абсолютные пути; скрытые файлы не отдаём
+        file_path = safe_join(MEDIA_DIR, name)
+        file_stat = None
+        if file_path is not None and not name.startswith('.'):
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                pass
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            log_event(logging.WARNING, 'media.missing', "⚠️ Файл не найден: %s", filename)
+            return {'error': 'File not found'}, 404
+        
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        has_variants = image_variants.handles(name)
+        if has_variants:
+            # Уменьшенная копия под формат браузера (Accept) и ширину (?w= или Sec-CH-Width)
+            accepted = {mime for mime, quality in request.accept_mimetypes if quality > 0}
+            width_hint = (request.args.get('w', type=int)
+                          or request.headers.get('Sec-CH-Width', type=int)
+                          or request.headers.get('Width', type=int))
+            picked = image_variants.pick(name, accepted, width_hint)
+            if picked is not None:
+                file_path, mimetype = picked
+                file_stat = os.stat(file_path)
+            elif image_variants.busy(name):
+                # Оригинал, пока варианты готовятся: не даём закэшировать его навсегда
+                immutable, max_age = False, 0
+        
+        data = media_cache.get(file_path, file_stat)
+        if data is None:
+            # Абсолютный путь: иначе Flask ищет файл от папки приложения, а не от текущей
+            response = send_file(os.path.abspath(file_path), mimetype=mimetype, conditional=True, max_age=max_age)
+            source = 'file'
+        else:
+            response = Response(data, mimetype=mimetype)
+            response.set_etag(f"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}")
+            response.last_modified = file_stat.st_mtime
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            response = response.make_conditional(request, accept_ranges=True, complete_length=file_stat.st_size)
+            source = 'memory'
+        if response.status_code in (200, 206):
+            MEDIA_BYTES.labels(source).inc(response.content_length or 0)
+        if immutable:
+            response.cache_control.immutable = True
+        if has_variants:
+            response.vary.add('Accept')
+            response.vary.add('Sec-CH-Width')
+        return response
+    except Exception as e:
+        log_event(logging.ERROR, 'media.error', "❌ Ошибка serve_media: %s", e)
+        return {'error': str(e)}, 500
+
+# ==================== СТРАНИЦЫ ====================
+
+class CompressedAsset:
+    """Готовое тело ответа в памяти вместе с заранее сжатыми gzip/br-копиями
+    
+    Сжимаем один раз при старте на максимальном уровне; на запрос только
+    выбираем копию по Accept-Encoding. У каждой копии свой строгий ETag.
+    """
+    
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha1(data).hexdigest()
+        self.bodies = {'identity': data}
+        candidates = {'gzip': gzip.compress(data, PAGE_GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            candidates['br'] = brotli.compress(data, quality=PAGE_BROTLI_QUALITY)
+        for encoding, body in candidates.items():
+            if len(body) < len(data):
+                self.bodies[encoding] = body
+    
+    def negotiate(self, accept_encodings):
+        """Лучшая из имеющихся кодировок, которую принимает браузер"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and accept_encodings.quality(encoding) > 0:
+                return encoding
+        return 'identity'
+    
+    def response(self, max_age=0, immutable=False):
+        encoding = self.negotiate(request.accept_encodings)
+        response = Response(self.bodies[encoding], mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(self.digest if encoding == 'identity' else f"{self.digest}-{encoding}")
+        response.cache_control.public = True
+        if max_age:
+            response.cache_control.max_age = max_age
+            if immutable:
+                response.cache_control.immutable = True
+        else:
+            # Страницу всегда перепроверяем, но по ETag это дешёвый 304
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+class PageBundle:
+    """Страницы из templates/ и их CSS/JS из static/, собранные один раз
+    
+    Файлы static/ получают имя с отпечатком (student.3fa9c1d2.js), которое
+    шаблоны узнают через asset_url(); такие URL кэшируются браузером на год.
+    """
+    
+    PAGES = ('index', 'student', 'teacher')
+    
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.assets = {}  # имя файла (и с отпечатком, и без) -> (CompressedAsset, immutable)
+        self.urls = {}    # имя файла -> /static/<имя с отпечатком>
+        self.pages = {}
+    
+    def load(self):
+        for name in sorted(os.listdir(self.static_dir)):
+            path = os.path.join(self.static_dir, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                asset = CompressedAsset(f.read(), mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            stem, ext = os.path.splitext(name)
+            hashed_name = f"{stem}.{asset.digest[:8]}{ext}"
+            self.assets[name] = (asset, False)
+            self.assets[hashed_name] = (asset, True)
+            self.urls[name] = f"/static/{hashed_name}"
+        
+        for page in self.PAGES:
+            html = app.jinja_env.get_template(f'{page}.html').render(asset_url=self.asset_url)
+            # charset=utf-8 к text/* werkzeug допишет сам
+            self.pages[page] = CompressedAsset(html.encode('utf-8'), 'text/html')
+        log_event(logging.INFO, 'pages.build', "📄 Страницы собраны: %s шт., %s файлов static/%s",
+                  len(self.pages), len(self.urls), '' if brotli is not None else ' (без brotli)')
+    
+    def asset_url(self, name):
+        return self.urls[name]
+    
+    def source_files(self):
+        """Файлы, от которых зависят страницы (для перезапуска отладочного сервера)"""
+        templates_dir = os.path.join(app.root_path, app.template_folder)
+        return ([os.path.join(templates_dir, f'{page}.html') for page in self.PAGES]
+                + [os.path.join(self.static_dir, name) for name in self.urls])
+
+pages = PageBundle(os.path.join(app.root_path, STATIC_DIR))
+pages.load()
+
+@app.route('/static/<filename>', methods=['GET'])
+def serve_static(filename):
+    item = pages.assets.get(filename)
+    if item is None:
+        return {'error': 'File not found'}, 404
+    asset, immutable = item
+    return asset.response(max_age=MEDIA_IMMUTABLE_MAX_AGE if immutable else MEDIA_MAX_AGE, immutable=immutable)
+
+@app.route('/student')
+@app.route('/r/<room:room>/student')
+def student(room=DEFAULT_ROOM):
+    return pages.pages['student'].response()
+
+@app.route('/teacher')
+@app.route('/r/<room:room>/teacher')
+def teacher(room=DEFAULT_ROOM):
+    return pages.pages['teacher'].response()
+
+@app.route('/')
+@app.route('/r/<room:room>/')
+def index(room=DEFAULT_ROOM):
+    return pages.pages['index'].response()
+
+# ==================== ЗАПУСК ====================
+
+def bench_payload(iterations=20000):
+    """Сравнить сборку ответа /api/game: jsonify(dict) против кэша фрагментов"""
+    state = default_game_state()
+    
+    def jsonify_body(i):
+        state['version'] = i
+        return app.json.dumps(build_game_payload(state))
+    
+    def fragments_body(i):
+        state['version'] = i  # каждый раз новая версия - мемо не помогает
+        return payload_cache.game_body('bench', state)
+    
+    def memo_body(i):
+        return payload_cache.game_body('bench', state)
+    
+    results = {}
+    with app.app_context():
+        for name, body_func, respond in (
+            ('jsonify', jsonify_body, lambda body: app.response_class(body, mimetype='application/json')),
+            ('fragments', fragments_body, json_response),
+            ('memo', memo_body, json_response),
+        ):
+            timings = []
+            for func in (body_func, lambda i: respond(body_func(i)).get_data()):
+                func(0)
+                started = time.perf_counter()
+                for i in range(1, iterations + 1):
+                    func(i)
+                timings.append((time.perf_counter() - started) / iterations * 1e6)
+            results[name] = timings
+    
+    base_body, base_response = results['jsonify']
+    print(f"📏 Сборка ответа /api/game, {iterations} итераций (мкс на ответ):")
+    print(f"   {'путь':<10} {'тело':>8} {'':>7} {'+Response':>10}")
+    for name, (body, response) in results.items():
+        print(f"   {name:<10} {body:8.2f} x{base_body / body:5.1f} {response:10.2f} x{base_response / response:5.1f}")
+    return results
+
+class BenchStats:
+    """Задержки и ошибки одного вида запросов в bench"""
+    
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+    
+    def record(self, latency, ok=True):
+        with self._lock:
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.errors += 1
+    
+    def summary(self, duration):
+        with self._lock:
+            latencies, errors = sorted(self.latencies), self.errors
+        count = len(latencies) + errors
+        
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000, 2)
+        
+        return {
+            'count': count,
+            'errors': errors,
+            'error_rate': round(errors / count, 4) if count else 0.0,
+            'per_second': round(count / duration, 1),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+        }
+
+class BenchConnection(http.client.HTTPConnection):
+    """Соединение bench: каждый открытый сокет запоминается в on_connect"""
+    
+    def __init__(self, host, port, timeout, on_connect):
+        super().__init__(host, port, timeout=timeout)
+        self.on_connect = on_connect
+    
+    def connect(self):
+        super().connect()
+        self.on_connect(self.sock)
+
+class LoadBench:
+    """Нагрузка урока: N комнат x M учеников, учитель в каждой комнате
+    
+    Ученики опрашивают /api/game раз в interval сек (как страница ученика)
+    или ждут изменений через long-poll/SSE; учитель раз в award_interval
+    сек начисляет пачку баллов и переводит на новый уровень убитого босса.
+    """
+    
+    TRANSPORTS = ('poll', 'long-poll', 'sse')
+    
+    def __init__(self, host, port, rooms=4, students=25, duration=30, interval=0.3,
+                 transport='poll', award_interval=2.0, burst=5, room_prefix='bench', timeout=60):
+        self.host = host
+        self.port = port
+        self.rooms = [f'{room_prefix}-{i}' for i in range(rooms)]
+        self.students = students
+        self.duration = duration
+        self.interval = interval
+        self.transport = transport
+        self.award_interval = award_interval
+        self.burst = burst
+        self.timeout = timeout
+        self.stats = {kind: BenchStats() for kind in (transport, 'award', 'level_up', 'update_lag')}
+        self.sse_events = 0
+        self._changes = {room: {} for room in self.rooms}  # (уровень, ХП) -> когда учитель их задал
+        self._arrivals = []  # (комната, (уровень, ХП), когда ученик это увидел)
+        self._sockets = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+    
+    def connect(self):
+        return BenchConnection(self.host, self.port, self.timeout, self._opened)
+    
+    def _opened(self, sock):
+        with self._lock:
+            self._sockets.append(sock)
+    
+    def call(self, conn, kind, method, path, body=None, headers=None):
+        """Запрос с замером (kind=None - без); (статус, тело, ответ) или None при ошибке"""
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        started = time.monotonic()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if kind is not None and not self._stop.is_set():
+                self.stats[kind].record(0, ok=False)
+            return None
+        if kind is not None:
+            self.stats[kind].record(time.monotonic() - started, response.status in (200, 304))
+        return response.status, data, response
+    
+    def seen(self, room, payload, last_key):
+        """Ученик увидел новое состояние (задержку считаем в конце: по SSE
+        оно приходит раньше, чем учитель получит ответ на свой запрос)"""
+        key = (payload['level'], payload['hp'])
+        if key != last_key:
+            self._arrivals.append((room, key, time.monotonic()))
+        return key
+    
+    def teacher(self, room):
+        conn = self.connect()
+        base = f'/r/{room}/api'
+        while not self._stop.wait(random.uniform(0.5, 1.0) * self.award_interval):
+            for _ in range(self.burst):
+                sent = time.monotonic()
+                result = self.call(conn, 'award', 'POST', f'{base}/award-points',
+                                   {'amount': random.randint(50, 150)})
+                if result is None or result[0] != 200:
+                    continue
+                payload = json.loads(result[1])
+                self._changes[room][(payload['level'], payload['new_hp'])] = sent
+                if payload['boss_dead']:
+                    sent = time.monotonic()
+                    result = self.call(conn, 'level_up', 'POST', f'{base}/level-up')
+                    if result is not None and result[0] == 200:
+                        payload = json.loads(result[1])
+                        self._changes[room][(payload['new_level'], payload['new_hp'])] = sent
+    
+    def student(self, room):
+        # Ученики открывают страницу не одновременно
+        if self._stop.wait(random.uniform(0, self.interval)):
+            return
+        conn = self.connect()
+        path = f'/r/{room}/api/game'
+        last_key = None
+        etag = None
+        version, generation = -1, ''
+        while not self._stop.is_set():
+            started = time.monotonic()
+            if self.transport == 'poll':
+                result = self.call(conn, 'poll', 'GET', path, headers={'If-None-Match': etag} if etag else None)
+                if result is not None and result[0] == 200:
+                    etag = result[2].getheader('ETag')
+                    last_key = self.seen(room, json.loads(result[1]), last_key)
+                self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+            elif self.transport == 'long-poll':
+                result = self.call(conn, 'long-poll', 'GET', f'{path}?since={version}&g={generation}&wait=25')
+                if result is None or result[0] == 503:
+                    self._stop.wait(self.interval)
+                elif result[0] == 200:
+                    payload = json.loads(result[1])
+                    version, generation = payload['version'], payload['g']
+                    last_key = self.seen(room, payload, last_key)
+            else:
+                last_key = self.stream(conn, room, last_key)
+                self._stop.wait(self.interval)
+    
+    def stream(self, conn, room, last_key):
+        """Читать SSE до обрыва; в статистике sse - время до начала потока"""
+        started = time.monotonic()
+        try:
+            conn.request('GET', f'/r/{room}/api/game/stream', headers={'Accept': 'text/event-stream'})
+            response = conn.getresponse()
+            self.stats['sse'].record(time.monotonic() - started, response.status == 200)
+            if response.status != 200:
+                response.read()
+                return last_key
+            event = None
+            for raw in response:
+                line = raw.decode('utf-8').rstrip('\r\n')
+                if line.startswith('event: '):
+                    event = line[7:]
+                elif line.startswith('data: ') and event == 'state':
+                    with self._lock:
+                        self.sse_events += 1
+                    last_key = self.seen(room, json.loads(line[6:]), last_key)
+        except (OSError, http.client.HTTPException, ValueError):
+            if not self._stop.is_set():
+                self.stats['sse'].record(0, ok=False)
+        conn.close()
+        return last_key
+    
+    def scrape_persist_counts(self):
+        """Счётчики записей на диск из /metrics сервера"""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', '/metrics')
+            text = conn.getresponse().read().decode('utf-8')
+        except (OSError, http.client.HTTPException):
+            return {}
+        finally:
+            conn.close()
+        counts = {}
+        for match in re.finditer(r'^state_persist_duration_seconds_count\{operation="(\w+)"\} (\d+)$', text, re.M):
+            counts[match.group(1)] = int(match.group(2))
+        return counts
+    
+    def run(self):
+        conn = self.connect()
+        for room in self.rooms:
+            self.call(conn, None, 'POST', f'/r/{room}/api/reset')
+        conn.close()
+        
+        persist_before = self.scrape_persist_counts()
+        threads = [threading.Thread(target=self.teacher, args=(room,), daemon=True) for room in self.rooms]
+        threads += [threading.Thread(target=self.student, args=(room,), daemon=True)
+                    for room in self.rooms for _ in range(self.students)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        self._stop.wait(self.duration)
+        self._stop.set()
+        elapsed = time.monotonic() - started
+        # Разбудить тех, кто висит в long-poll или SSE (сокет потока SSE
+        # принадлежит уже ответу, а не соединению, поэтому закрываем сокеты)
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        deadline = time.monotonic() + 5
+        for thread in threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        persist_after = self.scrape_persist_counts()
+        for room, key, arrived_at in self._arrivals:
+            changed_at = self._changes[room].get(key)
+            if changed_at is not None and arrived_at >= changed_at:
+                self.stats['update_lag'].record(arrived_at - changed_at)
+        
+        requests = {kind: stats.summary(elapsed) for kind, stats in self.stats.items() if kind != 'update_lag'}
+        total = sum(summary['count'] for summary in requests.values())
+        results = {
+            'duration_s': round(elapsed, 2),
+            'throughput_rps': round(total / elapsed, 1),
+            'error_rate': round(sum(s['errors'] for s in requests.values()) / total, 4) if total else 0.0,
+            'requests': requests,
+            'update_lag': self.stats['update_lag'].summary(elapsed),
+            'disk_writes_per_s': {
+                operation: round((count - persist_before.get(operation, 0)) / elapsed, 2)
+                for operation, count in sorted(persist_after.items())
+            },
+        }
+        if self.transport == 'sse':
+            results['sse_events'] = self.sse_events
+        return results
+
+def disk_write_bytes():
+    """Сколько байт процесс записал на диск (Linux, /proc/self/io)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def bench(args):
+    """Нагрузочный тест урока; результат печатается и пишется в JSON"""
+    global storage, rooms
+    config = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'label': args.label,
+        'server': args.url or 'inprocess',
+        'storage': args.storage if not args.url else None,
+        'transport': args.transport,
+        'rooms': args.rooms,
+        'students': args.students,
+        'duration_s': args.duration,
+        'interval_s': args.interval,
+        'award_interval_s': args.award_interval,
+        'burst': args.burst,
+        'python': sys.version.split()[0],
+    }
+    
+    server = workdir = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        # Свой сервер на свободном порту и хранилище во временной папке:
+        # настоящие комнаты урока не трогаем
+        workdir = tempfile.TemporaryDirectory(prefix='monster-bench-')
+        storage = create_storage(args.storage, os.path.join(workdir.name, 'rooms' if args.storage == 'json' else 'bench.db'))
+        rooms = RoomRegistry(storage)
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=ServeRequestHandler)
+        threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+        host, port = '127.0.0.1', server.server_port
+        # Печать каждого запроса в консоль исказила бы замер
+        for logger in (log, logging.getLogger('werkzeug')):
+            logger.setLevel(max(logger.level, logging.WARNING))
+    
+    print(f"🏋️ bench: {args.rooms} комнат x {args.students} учеников, {args.transport}, "
+          f"{args.duration} с -> {config['server']}")
+    written_before = disk_write_bytes() if server else None
+    load = LoadBench(host, port, rooms=args.rooms, students=args.students, duration=args.duration,
+                     interval=args.interval, transport=args.transport,
+                     award_interval=args.award_interval, burst=args.burst, room_prefix=args.room_prefix)
+    results = load.run()
+    if server is not None:
+        server.shutdown()
+        rooms.close()
+        storage.close()
+        written = disk_write_bytes()
+        if written is not None and written_before is not None:
+            results['disk_write_bytes_per_s'] = round((written - written_before) / results['duration_s'], 1)
+        workdir.cleanup()
+    
+    print(f"   запросов/с: {results['throughput_rps']}, ошибок: {results['error_rate']:.2%}")
+    print(f"   {'вид':<12} {'всего':>8} {'ошибок':>7} {'p50':>8} {'p95':>8} {'p99':>8}  (мс)")
+    for kind, summary in list(results['requests'].items()) + [('update_lag', results['update_lag'])]:
+        print(f"   {kind:<12} {summary['count']:>8} {summary['errors']:>7} "
+              f"{summary['p50_ms'] or '-':>8} {summary['p95_ms'] or '-':>8} {summary['p99_ms'] or '-':>8}")
+    print(f"   записей на диск в секунду: {results['disk_writes_per_s']}")
+    
+    output = args.output or f"bench-{args.label or config['transport']}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'config': config, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результат: {output}")
+    return results
+
+class ServeRequestHandler(WSGIRequestHandler):
+    """HTTP/1.1 с keep-alive: соединение простаивает не дольше timeout сек"""
+    
+    protocol_version = 'HTTP/1.1'
+    timeout = SERVE_KEEPALIVE
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Сервер werkzeug с пулом потоков вместо нового потока на каждое соединение
+    
+    SSE и long-poll держат поток всё время соединения, поэтому им отдаётся
+    только часть пула (push_slots), остальные потоки - обычным запросам.
+    """
+    
+    def __init__(self, host, port, wsgi_app, threads=SERVE_THREADS, fd=None):
+        super().__init__(host, port, wsgi_app, handler=ServeRequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self._active = set()
+        self._active_lock = threading.Lock()
+    
+    def process_request(self, request, client_address):
+        future = self.pool.submit(self._handle, request, client_address)
+        with self._active_lock:
+            self._active.add(future)
+        future.add_done_callback(self._done)
+    
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+    
+    def _done(self, future):
+        with self._active_lock:
+            self._active.discard(future)
+    
+    def drain(self, timeout):
+        """Дождаться принятых соединений (не дольше timeout сек); вернуть, сколько осталось"""
+        with self._active_lock:
+            active = list(self._active)
+        _, not_done = futures_wait(active, timeout=timeout)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        return len(not_done)
+
+# ==================== АСИНХРОННЫЙ СЕРВЕР ====================
+
+# Пути, которые асинхронный сервер обслуживает сам (GET): SSE и long-poll
+ASYNC_PUSH_PATH = re.compile(rf'/(?:r/({ROOM_ID_PATTERN})/)?api/game(/stream|/delta)?')
+SSE_PING = b"event: ping\ndata: {}\n\n"
+
+def query_params(query):
+    """Параметры строки запроса; из повторов - первый, как request.args.get()"""
+    params = {}
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        params.setdefault(name, value)
+    return params
+
+def query_arg(params, name, type, default=None):
+    """params[name], приведённый к type, или default - как request.args.get(type=)"""
+    try:
+        return type(params[name])
+    except (KeyError, ValueError):
+        return default
+
+class RoomBroadcaster:
+    """Рассылка изменений комнат подписчикам асинхронного сервера
+    
+    Хранилища зовут notify() из любых потоков, рассылка идёт в цикле
+    событий. Кадр SSE собирается один раз на всех подписчиков с одинаковым
+    топом; клиент с полным буфером записи получит только последнее
+    состояние, когда снова начнёт читать, и не задерживает остальных.
+    """
+    
+    def __init__(self, loop):
+        self.loop = loop
+        self.streams = {}   # комната -> {AsyncHTTPProtocol} открытых SSE
+        self.waiters = {}   # комната -> {Future} ждущих long-poll
+        self.states = {}    # комната -> последнее разосланное состояние
+        self.closing = False
+        self._pending = {}  # комната -> состояние, ещё не разосланное
+        self._pending_lock = threading.Lock()
+    
+    def notify(self, room, state):
+        """Слушатель RoomRegistry: зовётся под блокировкой комнаты из любого потока"""
+        with self._pending_lock:
+            schedule = not self._pending
+            self._pending[room] = state
+        # Пачка изменений подряд - одно пробуждение цикла и одна рассылка
+        if schedule:
+            self.loop.call_soon_threadsafe(self._publish_pending)
+    
+    def _publish_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for room, state in pending.items():
+            self.publish(room, state)
+    
+    def publish(self, room, state):
+        """Разослать новое состояние комнаты (в цикле событий)"""
+        latest = self.states.get(room)
+        if latest is not None and latest['version'] >= state['version']:
+            return
+        self.states[room] = state
+        for future in self.waiters.pop(room, ()):
+            if not future.done():
+                future.set_result(None)
+        frames = {}
+        for stream in self.streams.get(room, ()):
+            stream.send_state(state, frames)
+    
+    def wait(self, room, version, timeout):
+        """Future, которое завершится, когда комната станет новее version,
+        через timeout сек или при остановке сервера"""
+        future = self.loop.create_future()
+        latest = self.states.get(room)
+        # Изменение могло прийти, пока версию читали в пуле потоков
+        if self.closing or (latest is not None and latest['version'] > version):
+            future.set_result(None)
+            return future
+        waiters = self.waiters.setdefault(room, set())
+        waiters.add(future)
+        timer = self.loop.call_later(timeout, self._expire, future)
+        
+        def done(_):
+            timer.cancel()
+            waiters.discard(future)
+        
+        future.add_done_callback(done)
+        return future
+    
+    def _expire(self, future):
+        if not future.done():
+            future.set_result(None)
+    
+    def subscribe(self, stream, state):
+        """Подписать поток SSE на его комнату и догнать пропущенное;
+        state - состояние, с которого поток начался"""
+        self.streams.setdefault(stream.room, set()).add(stream)
+        SSE_SUBSCRIBERS.inc()
+        latest = self.states.setdefault(stream.room, state)
+        if latest['version'] > stream.version:
+            stream.send_state(latest)
+    
+    def republish(self):
+        """Слушатель payload_cache (из любого потока): то же состояние
+        с новыми фрагментами - в потоки, ждущим long-poll - ответ сразу"""
+        self.loop.call_soon_threadsafe(self._republish)
+    
+    def _republish(self):
+        for room, streams in self.streams.items():
+            frames = {}
+            for stream in list(streams):
+                stream.send_state(self.states[room], frames)
+        for waiters in self.waiters.values():
+            for future in list(waiters):
+                if not future.done():
+                    future.set_result(None)
+    
+    def unsubscribe(self, stream):
+        streams = self.streams.get(stream.room)
+        if streams is not None and stream in streams:
+            streams.discard(stream)
+            SSE_SUBSCRIBERS.dec()
+            if not streams:
+                del self.streams[stream.room]
+    
+    async def heartbeat(self):
+        """Раз в SSE_HEARTBEAT сек: ping в потоки, отключение клиентов, которые
+        не читают, и отметка комнат с подписчиками, чтобы их не выгрузили"""
+        while True:
+            await asyncio.sleep(SSE_HEARTBEAT)
+            rooms.touch(list(self.streams))
+            now = self.loop.time()
+            for streams in list(self.streams.values()):
+                for stream in list(streams):
+                    stream.ping(now)
+            # Выгруженные комнаты без подписчиков больше не нужны
+            loaded = {room for room, _ in rooms.loaded()}
+            for room in [room for room in self.states if room not in loaded and room not in self.streams]:
+                del self.states[room]
+            for room in [room for room, waiters in self.waiters.items() if not waiters]:
+                del self.waiters[room]
+    
+    def close(self):
+        """Остановка: закрыть потоки SSE и сразу ответить всем long-poll"""
+        self.closing = True
+        for streams in list(self.streams.values()):
+            for stream in list(streams):
+                stream.transport.close()
+        for waiters in list(self.waiters.values()):
+            for future in list(waiters):
+                if not future.done():
+                    future.set_result(None)
+
+class AsyncHTTPProtocol(asyncio.Protocol):
+    """Одно соединение асинхронного сервера: HTTP/1.1 с keep-alive
+    
+    SSE и long-poll /api/game обслуживаются прямо в цикле событий и не
+    занимают поток. Остальные запросы выполняет приложение Flask в пуле
+    потоков, ответ уходит клиенту по мере того, как тот его читает.
+    """
+    
+    __slots__ = ('server', 'transport', 'peer', 'buffer', 'busy', 'closed', 'continued', 'idle_timer',
+                 'task', 'writable', 'room', 'version', 'generation', 'top', 'pending', 'paused_at')
+    NO_TOP = []  # топ, который знает только что подключившийся клиент
+    
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.peer = ('-', 0)
+        self.buffer = bytearray()
+        self.busy = False         # запрос в обработке, следующие ждут в buffer
+        self.closed = False
+        self.continued = False    # уже ответили 100 Continue на этот запрос
+        self.idle_timer = None
+        self.task = None          # начало SSE или ожидание long-poll
+        self.writable = None      # threading.Event для потока пула: буфер записи не полон
+        self.room = None          # SSE: комната, на которую подписан поток
+        self.version = -1         # SSE: версия, которую клиент уже получил
+        self.generation = None    # SSE: сборка фрагментов, с которой она пришла
+        self.top = self.NO_TOP    # SSE: топ, который клиент уже знает
+        self.pending = None       # SSE: состояние, отложенное до resume_writing()
+        self.paused_at = None     # когда переполнился буфер записи (loop.time())
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername') or self.peer
+        transport.set_write_buffer_limits(high=ASYNC_WRITE_BUFFER)
+        self.server.connections.add(self)
+        self._arm_idle_timer()
+    
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.connections.discard(self)
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if self.task is not None:
+            self.task.cancel()
+        if self.writable is not None:
+            self.writable.set()  # поток пула увидит closed и бросит ответ
+        if self.room is not None:
+            self.server.broadcaster.unsubscribe(self)
+    
+    def pause_writing(self):
+        self.paused_at = self.server.loop.time()
+        if self.writable is not None:
+            self.writable.clear()
+    
+    def resume_writing(self):
+        self.paused_at = None
+        if self.writable is not None:
+            self.writable.set()
+        if self.pending is not None:
+            state, self.pending = self.pending, None
+            self.send_state(state)
+    
+    def data_received(self, data):
+        if self.room is not None:
+            return  # клиент SSE ничего не присылает
+        self.buffer += data
+        if not self.busy:
+            self._next_request()
+        elif len(self.buffer) > ASYNC_MAX_HEADER_BYTES + ASYNC_MAX_BODY_BYTES:
+            self.transport.pause_reading()  # следующие запросы подождут
+    
+    def _arm_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = self.server.loop.call_later(self.server.keepalive, self.transport.close)
+    
+    def _next_request(self):
+        """Разобрать следующий запрос из буфера, если он пришёл целиком"""
+        while self.buffer.startswith(b'\r\n'):
+            del self.buffer[:2]
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0 or end > ASYNC_MAX_HEADER_BYTES:
+            if end > ASYNC_MAX_HEADER_BYTES or len(self.buffer) > ASYNC_MAX_HEADER_BYTES:
+                self._reject(431)
+            return
+        try:
+            lines = self.buffer[:end].decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                name, value = name.strip().lower(), value.strip()
+                headers[name] = f"{headers[name]}, {value}" if name in headers else value
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return self._reject(400)
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            return self._reject(505)
+        if 'transfer-encoding' in headers:
+            return self._reject(411)  # тело только с Content-Length
+        if not 0 <= length <= ASYNC_MAX_BODY_BYTES:
+            return self._reject(413)
+        if len(self.buffer) < end + 4 + length:
+            if headers.get('expect', '').lower() == '100-continue' and not self.continued:
+                self.continued = True
+                self.transport.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            return
+        body = bytes(self.buffer[end + 4:end + 4 + length])
+        del self.buffer[:end + 4 + length]
+        connection = headers.get('connection', '').lower()
+        keep_alive = 'close' not in connection if version == 'HTTP/1.1' else 'keep-alive' in connection
+        self.busy = True
+        self.continued = False
+        self.idle_timer.cancel()
+        self.transport.resume_reading()
+        self._dispatch(method, target, version, headers, body, keep_alive)
+    
+    def _reject(self, status):
+        """Ответить ошибкой и закрыть соединение"""
+        self.busy = True
+        reason = http.HTTPStatus(status).phrase
+        body = f"{status} {reason}\n".encode()
+        self.transport.write(self.server.response_head(f"{status} {reason}", [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Connection', 'close'),
+        ]) + body)
+        self.transport.close()
+    
+    def _dispatch(self, method, target, version, headers, body, keep_alive):
+        path, _, query = target.partition('?')
+        match = ASYNC_PUSH_PATH.fullmatch(path) if method == 'GET' else None
+        if match is not None:
+            room = match.group(1) or DEFAULT_ROOM
+            if match.group(2) == '/stream':
+                self.task = self.server.loop.create_task(self._stream(room, headers))
+                return
+            params = query_params(query)
+            wait = min(query_arg(params, 'wait', float, 0), LONG_POLL_MAX_WAIT)
+            if wait > 0:
+                # Ответит Flask, когда ждать уже нечего: wait из запроса убираем
+                query = urlencode([item for item in parse_qsl(query, keep_blank_values=True) if item[0] != 'wait'])
+                request = (method, path, query, version, headers, body, keep_alive)
+                self.task = self.server.loop.create_task(
+                    self._long_poll(room, params, wait, match.group(2) == '/delta', request))
+                return
+        self._delegate(method, path, query, version, headers, body, keep_alive)
+    
+    async def _long_poll(self, room, params, wait, delta, request):
+        """Long-poll /api/game и /api/game/delta без потока: ждём в цикле событий"""
+        since = query_arg(params, 'since', int)
+        generation = query_arg(params, 'g', int)
+        try:
+            version = (await self.server.room_state(room))['version']
+        except Exception as e:
+            log_event(logging.ERROR, 'http', "❌ Long-poll [%s]: %s", room, e, room=room)
+            return self._reject(500)
+        if since == version and generation == payload_cache.generation:
+            with LONG_POLL_WAITERS.track():
+                await self.server.broadcaster.wait(room, version, wait)
+        self.task = None
+        self._delegate(*request)
+    
+    async def _stream(self, room, headers):
+        """SSE без потока: начальное состояние и подписка в RoomBroadcaster"""
+        # Переподключившийся браузер сам присылает Last-Event-ID = последняя версия
+        last_event_id = headers.get('last-event-id', '')
+        since = int(last_event_id) if last_event_id.isdigit() else -1
+        try:
+            state = await self.server.room_state(room)
+        except Exception as e:
+            log_event(logging.ERROR, 'http', "❌ SSE [%s]: %s", room, e, room=room)
+            return self._reject(500)
+        self.task = None
+        if self.server.broadcaster.closing:
+            return self._reject(503)
+        log_event(logging.INFO, 'sse.connect', "📡 SSE [%s]: подключение (Last-Event-ID=%s)",
+                  room, last_event_id or '-', room=room)
+        self.transport.write(self.server.response_head('200 OK', [
+            ('Content-Type', 'text/event-stream; charset=utf-8'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),  # nginx не должен буферизовать поток
+            ('Connection', 'close'),      # поток идёт до закрытия соединения
+        ]) + f"retry: {SSE_RETRY_MS}\n\n".encode())
+        self.room = room
+        if state['version'] != since:
+            self.send_state(state)
+        else:
+            self.version, self.generation = since, payload_cache.generation
+        self.server.broadcaster.subscribe(self, state)
+    
+    def send_state(self, state, frames=None):
+        """Отправить состояние в поток SSE; frames - кадры, общие на одну рассылку"""
+        if self.paused_at is not None:
+            self.pending = state  # клиент не читает: держим только последнее состояние
+            return
+        if state['version'] == self.version and self.generation == payload_cache.generation:
+            return
+        cached = frames.get(id(self.top)) if frames is not None else None
+        if cached is None:
+            text, top = sse_state_frames(self.room, state, self.top)
+            # Старый топ в кортеже не даст его id достаться новому списку
+            cached = (text.encode(), top, self.top)
+            if frames is not None:
+                frames[id(self.top)] = cached
+        self.transport.write(cached[0])
+        self.top = cached[1]
+        self.version, self.generation = state['version'], payload_cache.generation
+    
+    def ping(self, now):
+        """Heartbeat потока SSE; клиента, который долго не читает, отключаем"""
+        if self.paused_at is None:
+            self.transport.write(SSE_PING)
+        elif now - self.paused_at > ASYNC_SLOW_CONSUMER_TIMEOUT:
+            log_event(logging.WARNING, 'sse.slow', "🐢 SSE [%s]: %s не читает поток %s с, отключаю",
+                      self.room, self.peer[0], ASYNC_SLOW_CONSUMER_TIMEOUT, room=self.room)
+            self.transport.abort()
+    
+    def _delegate(self, method, path, query, version, headers, body, keep_alive):
+        """Передать запрос приложению Flask в пул потоков"""
+        if self.writable is None:
+            self.writable = threading.Event()
+            if self.paused_at is None:
+                self.writable.set()
+        environ = self.server.environ(self, method, path, query, version, headers, body)
+        try:
+            self.server.pool.submit(self._run_wsgi, environ, keep_alive)
+        except RuntimeError:  # пул уже остановлен
+            self._reject(503)
+    
+    def _run_wsgi(self, environ, keep_alive):
+        """Выполнить запрос в приложении (поток пула) и отправить ответ"""
+        method, version = environ['REQUEST_METHOD'], environ['SERVER_PROTOCOL']
+        response = {}  # status, headers, sent, chunked, body
+        
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response.update(status=status, headers=list(headers))
+            return send
+        
+        def send(data):
+            if not response.get('sent'):
+                code = int(response['status'][:3])
+                headers = response['headers']
+                response['body'] = method != 'HEAD' and code >= 200 and code not in (204, 304)
+                if response['body'] and not any(name.lower() == 'content-length' for name, _ in headers):
+                    if version == 'HTTP/1.1':
+                        response['chunked'] = True
+                        headers.append(('Transfer-Encoding', 'chunked'))
+                    else:
+                        response['keep_alive'] = False
+                if not response.get('keep_alive', keep_alive):
+                    headers.append(('Connection', 'close'))
+                response['sent'] = True
+                self._write_from_pool(self.server.response_head(response['status'], headers))
+            if data and response['body']:
+                self._write_from_pool(b'%x\r\n%s\r\n' % (len(data), data) if response.get('chunked') else data)
+        
+        try:
+            result = self.server.wsgi_app(environ, start_response)
+            try:
+                for data in result:
+                    if data:
+                        send(data)
+                if not response.get('sent'):
+                    send(b'')
+                if response.get('chunked'):
+                    self._write_from_pool(b'0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            if not isinstance(e, ConnectionError):
+                log_event(logging.ERROR, 'http', "❌ Ошибка ответа на %s %s: %s", method, environ['PATH_INFO'], e,
+                          exc_info=True)
+            self.server.loop.call_soon_threadsafe(self.transport.close)
+            return
+        log_event(logging.INFO, 'http', '%s - - "%s %s %s" %s -', self.peer[0], method,
+                  environ['RAW_URI'], version, response['status'][:3])
+        self.server.loop.call_soon_threadsafe(self._finish, response.get('keep_alive', keep_alive))
+    
+    def _write_from_pool(self, data):
+        """Запись из потока пула: по одному куску за раз и только пока
+        клиент успевает читать, так что в буфере не больше ASYNC_WRITE_BUFFER"""
+        if not self.writable.wait(ASYNC_SLOW_CONSUMER_TIMEOUT):
+            self.server.loop.call_soon_threadsafe(self.transport.abort)
+        if self.closed or not self.writable.is_set():
+            raise ConnectionAbortedError("клиент отключился или не читает ответ")
+        self.writable.clear()
+        self.server.loop.call_soon_threadsafe(self._write, data)
+    
+    def _write(self, data):
+        if not self.closed:
+            self.transport.write(data)  # при переполнении буфера зовёт pause_writing()
+        if self.paused_at is None or self.closed:
+            self.writable.set()
+    
+    def _finish(self, keep_alive):
+        """Ответ отправлен: закрыть соединение или взять следующий запрос"""
+        if self.closed:
+            return
+        if not keep_alive or self.server.stopping:
+            self.transport.close()
+            return
+        self.busy = False
+        self._next_request()
+        if not self.busy:
+            self._arm_idle_timer()
+
+class AsyncGameServer:
+    """Асинхронный сервер (serve --async): один цикл событий на процесс
+    
+    Поток на соединение не нужен: SSE и long-poll ждут изменений в цикле
+    событий, а RoomBroadcaster рассылает их подписчикам комнаты. Прочие
+    запросы выполняет то же приложение Flask в небольшом пуле потоков.
+    """
+    
+    def __init__(self, wsgi_app, threads=SERVE_THREADS, keepalive=SERVE_KEEPALIVE, multiprocess=False):
+        self.wsgi_app = wsgi_app
+        self.keepalive = keepalive
+        self.multiprocess = multiprocess
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self.loop = None
+        self.broadcaster = None
+        self.connections = set()
+        self.stopping = False
+        self.host = self.port = None
+        self._date = (0, '')
+    
+    def response_head(self, status, headers):
+        """Строка статуса и заголовки ответа (Date пересчитывается раз в секунду)"""
+        now = int(time.time())
+        if self._date[0] != now:
+            self._date = (now, formatdate(now, usegmt=True))
+        lines = [f"HTTP/1.1 {status}", f"Date: {self._date[1]}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    
+    def environ(self, connection, method, path, query, version, headers, body):
+        """WSGI environ запроса для приложения Flask"""
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'RAW_URI': f"{path}?{query}" if query else path,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': connection.peer[0],
+            'REMOTE_PORT': str(connection.peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            environ[key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{key}"] = value
+        return environ
+    
+    async def room_state(self, room):
+        """Состояние комнаты; загрузка с диска и чтение базы - в пуле потоков"""
+        return await self.loop.run_in_executor(self.pool, lambda: rooms.get(room).get())
+    
+    async def run(self, host, port, fd=None):
+        """Принимать соединения до SIGTERM/SIGINT; вернуть, сколько запросов не дождались"""
+        self.loop = asyncio.get_running_loop()
+        self.broadcaster = RoomBroadcaster(self.loop)
+        rooms.listeners.append(self.broadcaster.notify)
+        payload_cache.on_change.append(self.broadcaster.republish)
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, stop.set)
+        
+        def factory():
+            return AsyncHTTPProtocol(self)
+        
+        if fd is not None:
+            server = await self.loop.create_server(factory, sock=socket.socket(fileno=fd), backlog=1024)
+        else:
+            server = await self.loop.create_server(factory, host, port, backlog=1024, reuse_address=True)
+        self.host, self.port = host, server.sockets[0].getsockname()[1]
+        heartbeat = self.loop.create_task(self.broadcaster.heartbeat())
+        log_event(logging.INFO, 'serve.start', "🚀 Сервер [%s] на http://%s:%s (async, потоков для Flask: %s, keep-alive: %s с)",
+                  os.getpid(), host, self.port, self.threads, self.keepalive)
+        await stop.wait()
+        
+        # Новые соединения уже не принимаются. SSE закрываются, long-poll
+        # отвечают сразу, простаивающие keep-alive соединения закрываются;
+        # ждём запросы, которые ещё выполняет Flask
+        self.stopping = True
+        server.close()
+        heartbeat.cancel()
+        self.broadcaster.close()
+        for connection in list(self.connections):
+            if not connection.busy:
+                connection.transport.close()
+        left = await self.drain(SERVE_GRACE)
+        rooms.listeners.remove(self.broadcaster.notify)
+        payload_cache.on_change.remove(self.broadcaster.republish)
+        for connection in list(self.connections):
+            connection.transport.abort()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        return left
+    
+    async def drain(self, timeout):
+        """Дождаться запросов в обработке (не дольше timeout сек); вернуть, сколько осталось"""
+        deadline = self.loop.time() + timeout
+        while True:
+            busy = sum(1 for connection in self.connections if connection.busy and connection.room is None)
+            if not busy or self.loop.time() >= deadline:
+                return busy
+            await asyncio.sleep(0.05)
+
+def serve(args):
+    """Боевой режим: без отладчика и перезагрузки, пул потоков или цикл событий (--async), плавная остановка"""
+    if args.workers > 1 and args.worker_fd is None:
+        return serve_workers(args)
+    
+    create_media_directory()
+    image_variants.start()
+    if args.worker_fd is not None:
+        rooms.share_between_processes(SharedRoomTable.attach(args.shared_memory) if args.shared_memory else None)
+    if args.use_async:
+        server = AsyncGameServer(app, threads=args.threads, keepalive=args.keepalive,
+                                 multiprocess=args.worker_fd is not None)
+        left = asyncio.run(server.run(args.host, args.port, args.worker_fd))
+    else:
+        left = serve_threads(args)
+    rooms.close()
+    if rooms.table is not None:
+        rooms.table.close()
+    log_event(logging.INFO, 'serve.stop', "🛑 Сервер [%s] остановлен%s",
+              os.getpid(), f", не дождались запросов: {left}" if left else '')
+
+def serve_threads(args):
+    """Пул потоков werkzeug; вернуть, сколько запросов не дождались при остановке"""
+    ServeRequestHandler.timeout = args.keepalive
+    server = PooledWSGIServer(args.host, args.port, app, threads=args.threads, fd=args.worker_fd)
+    push_slots.limit = args.threads - max(1, round(args.threads * SERVE_PUSH_RESERVE))
+    stopping = threading.Event()
+    
+    def request_stop(signum, frame):
+        # shutdown() ждёт выхода из serve_forever(), поэтому зовём его не из этого потока
+        if not stopping.is_set():
+            stopping.set()
+            threading.Thread(target=server.shutdown, name='serve-stop', daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    log_event(logging.INFO, 'serve.start', "🚀 Сервер [%s] на http://%s:%s (потоков: %s, из них для SSE и long-poll: %s, keep-alive: %s с)",
+              os.getpid(), args.host, server.port, args.threads, push_slots.limit, args.keepalive)
+    server.serve_forever()
+    
+    # Новые соединения уже не принимаются. Закрытые комнаты записываются
+    # на диск и отпускают SSE и long-poll; ждём запросы, которые ещё идут
+    rooms.release()
+    return server.drain(SERVE_GRACE)
+
+def serve_workers(args):
+    """Несколько процессов на одном порту
+    
+    Сокет открывает этот процесс, а обработчики наследуют его. Комнаты
+    согласованы через SQLite: каждое изменение записывается сразу под
+    блокировкой базы и публикуется в общей памяти (SharedRoomTable),
+    откуда его сразу видят остальные процессы.
+    """
+    if not hasattr(storage, 'exclusive'):
+        raise SystemExit("❌ serve --workers N требует GAME_STORAGE=sqlite: процессы делят комнаты через базу")
+    if os.name != 'posix':
+        raise SystemExit("❌ serve --workers N работает только в Linux/macOS, используйте --threads")
+    
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    fd = sock.fileno()
+    os.set_inheritable(fd, True)
+    command = [sys.executable, os.path.abspath(__file__), 'serve', '--worker-fd', str(fd),
+               '--host', args.host, '--port', str(args.port),
+               '--threads', str(args.threads), '--keepalive', str(args.keepalive)]
+    if args.use_async:
+        command.append('--async')
+    table = None
+    if SHARED_MEMORY_ROOMS > 0:
+        table = SharedRoomTable.create()
+        command += ['--shared-memory', table.name]
+    workers = []
+    stopping = threading.Event()
+    
+    def request_stop(signum, frame):
+        stopping.set()
+    
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    for _ in range(args.workers):
+        workers.append(subprocess.Popen(command, pass_fds=(fd,)))
+    log_event(logging.INFO, 'serve.start', "🚀 Процессов: %s на http://%s:%s", args.workers, args.host, args.port)
+    
+    while not stopping.wait(1):
+        for i, worker in enumerate(workers):
+            if worker.poll() is not None:
+                log_event(logging.WARNING, 'serve.worker', "⚠️ Процесс %s завершился (код %s), запускаю заново",
+                          worker.pid, worker.returncode)
+                if table is not None:
+                    # Умерший процесс мог оставить слот общей памяти недописанным
+                    with storage.exclusive():
+                        repaired = table.repair(lambda room: storage.load(room)[0])
+                    if repaired:
+                        log_event(logging.WARNING, 'shm.repair', "⚠️ Общая память: слоты %s переписаны из базы",
+                                  ', '.join(repaired))
+                workers[i] = subprocess.Popen(command, pass_fds=(fd,))
+    
+    for worker in workers:
+        if worker.poll() is None:
+            worker.terminate()
+    for worker in workers:
+        try:
+            worker.wait(timeout=SERVE_GRACE + 5)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+    sock.close()
+    if table is not None:
+        table.close()
+
+def run_dev_server():
+    """Прежний режим: отладочный сервер Flask"""
+    create_media_directory()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Запросы обслуживает процесс, который перезапускает reloader
+        image_variants.start()
     print("=" * 60)
     print("🚀 Запуск сервера на http://localhost:5000")
     print("📁 Директория 'media' создана")
@@ -897,4 +4294,52 @@ if __name__ == '__main__':
     print("👨‍🎓 Ученик: http://localhost:5000/student")
     print("👨‍🏫 Учитель: http://localhost:5000/teacher")
     print("=" * 60)
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    # Правка шаблона или static/ перезапускает сервер и пересобирает страницы
+    app.run(debug=True, port=5000, host='0.0.0.0', extra_files=pages.source_files())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='🐉 Эволюция монстра - сервер')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='отладочный сервер Flask (по умолчанию)')
+    serve_parser = commands.add_parser('serve', help='боевой режим: пул потоков, несколько процессов')
+    serve_parser.add_argument('--host', default=SERVE_HOST, help='адрес (GAME_HOST, по умолчанию 0.0.0.0)')
+    serve_parser.add_argument('--port', type=int, default=SERVE_PORT, help='порт (GAME_PORT, по умолчанию 5000)')
+    serve_parser.add_argument('--threads', type=int, default=SERVE_THREADS,
+                              help='потоков на процесс, не меньше числа учеников на процесс (GAME_THREADS)')
+    serve_parser.add_argument('--workers', type=int, default=SERVE_WORKERS,
+                              help='процессов; больше одного - только с GAME_STORAGE=sqlite (GAME_WORKERS)')
+    serve_parser.add_argument('--keepalive', type=float, default=SERVE_KEEPALIVE,
+                              help='сколько секунд держать простаивающее соединение (GAME_KEEPALIVE)')
+    serve_parser.add_argument('--async', dest='use_async', action='store_true',
+                              help='цикл событий: SSE и long-poll без потока на ученика, Flask - в пуле --threads')
+    serve_parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    serve_parser.add_argument('--shared-memory', help=argparse.SUPPRESS)
+    bench_parser = commands.add_parser('bench-payload', help='замер сборки ответа /api/game')
+    bench_parser.add_argument('-n', '--iterations', type=int, default=20000)
+    load_parser = commands.add_parser('bench', help='нагрузочный тест урока: комнаты x ученики')
+    load_parser.add_argument('--rooms', type=int, default=4, help='сколько комнат (классов)')
+    load_parser.add_argument('--students', type=int, default=25, help='учеников в комнате')
+    load_parser.add_argument('--duration', type=float, default=30, help='длительность, сек')
+    load_parser.add_argument('--interval', type=float, default=0.3, help='период опроса учеником, сек')
+    load_parser.add_argument('--transport', choices=LoadBench.TRANSPORTS, default='poll')
+    load_parser.add_argument('--award-interval', type=float, default=2.0, help='период пачек баллов от учителя, сек')
+    load_parser.add_argument('--burst', type=int, default=5, help='начислений в пачке')
+    load_parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS), default=GAME_STORAGE,
+                             help='хранилище встроенного сервера')
+    load_parser.add_argument('--url', help='нагрузить уже запущенный сервер (http://host:port) вместо встроенного')
+    load_parser.add_argument('--room-prefix', default='bench', help='комнаты <prefix>-0, <prefix>-1, ...')
+    load_parser.add_argument('--label', help='метка запуска для сравнения результатов')
+    load_parser.add_argument('-o', '--output', help='JSON с результатом (по умолчанию bench-<метка>-<время>.json)')
+    args = parser.parse_args(argv)
+    
+    if args.command == 'bench-payload':
+        bench_payload(args.iterations)
+    elif args.command == 'bench':
+        bench(args)
+    elif args.command == 'serve':
+        serve(args)
+    else:
+        run_dev_server()
+
+if __name__ == '__main__':
+    main()
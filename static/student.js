@@ -0,0 +1,538 @@
+let lastVersion = -1;
+let syncInProgress = false;
+
+// ?debug=1 в адресе: подробный лог и время кадров
+const DEBUG = new URLSearchParams(location.search).has('debug');
+
+function debugLog(...args) {
+    if (DEBUG) console.log(...args);
+}
+
+// Опрос получает только изменения (/api/game/delta); на медленной сети
+// (или с ?compact=1 в адресе) - в двоичном виде
+let gameState = null;
+let syncGeneration = '';
+const connection = navigator.connection || {};
+const COMPACT_SYNC = new URLSearchParams(location.search).has('compact')
+    || connection.saveData === true || /2g/.test(connection.effectiveType || '');
+
+async function fetchDelta(wait) {
+    let url = `api/game/delta?since=${lastVersion}&g=${syncGeneration}`;
+    if (wait) url += '&wait=' + wait;
+    if (COMPACT_SYNC) url += '&format=bin';
+    const response = await fetch(url, { cache: 'no-store' });
+    if (response.status === 304) return null;
+    if (!response.ok) {
+        const error = new Error('HTTP ' + response.status);
+        error.status = response.status;
+        throw error;
+    }
+    const delta = COMPACT_SYNC ? decodeDelta(await response.arrayBuffer()) : await response.json();
+    if (delta.g !== undefined) syncGeneration = delta.g;
+    return Object.assign({}, gameState, delta);
+}
+
+// Двоичная дельта: флаги, version (u32), сборка (u16), затем по флагам
+// level (u32), hp (u32), max_hp (u32) и JSON стадии до конца
+function decodeDelta(buffer) {
+    const view = new DataView(buffer);
+    const flags = view.getUint8(0);
+    const delta = { version: view.getUint32(1, true), g: view.getUint16(5, true) };
+    let offset = 7;
+    if (flags & 1) { delta.level = view.getUint32(offset, true); offset += 4; }
+    if (flags & 2) { delta.hp = view.getUint32(offset, true); offset += 4; }
+    if (flags & 4) { delta.max_hp = view.getUint32(offset, true); offset += 4; }
+    if (flags & 8) Object.assign(delta, JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset))));
+    return delta;
+}
+
+async function syncWithServer() {
+    if (syncInProgress) return;
+    syncInProgress = true;
+
+    try {
+        const data = await fetchDelta(0);
+        if (data) {
+            applyState(data);
+            refreshLeaderboard(data.version);
+        }
+    } catch (error) {
+        console.error('❌ Sync error:', error);
+    } finally {
+        syncInProgress = false;
+    }
+}
+
+// Состояние только запоминается: DOM обновляется в ближайшем кадре,
+// и только то, что изменилось. Несколько обновлений между кадрами
+// (очередь SSE, догоняющий long-poll) дают одну перерисовку
+let pendingState = null;
+
+function applyState(data) {
+    gameState = data;
+    lastVersion = data.version;
+    pendingState = data;
+    requestFrame();
+}
+
+// Что сейчас показано на странице (из разметки student.html)
+const view = {
+    level: 1,
+    hp: 100,
+    max_hp: 100,
+    monster: 'Кракен',
+    image: null,
+    background: 'ocean_deep'
+};
+
+function renderState(data) {
+    debugLog('📊 Sync data:', {
+        level: data.level,
+        hp: data.hp,
+        max_hp: data.max_hp,
+        bg: data.background.name
+    });
+
+    // Обновить фон если он изменился
+    if (data.background && data.background.name !== view.background) {
+        debugLog('🎨 Фон меняется:', view.background, '→', data.background.name);
+        updateBackground(data.background);
+        view.background = data.background.name;
+    }
+
+    if (data.level !== view.level) {
+        // Проверка на новый уровень (сброс боя видео не показывает)
+        if (data.level > view.level) {
+            console.log('🚀 НОВЫЙ УРОВЕНЬ:', view.level, '→', data.level);
+            showLevelUpAnimation(data);
+        }
+        document.getElementById('levelNum').textContent = data.level;
+        view.level = data.level;
+    }
+
+    // Обновить ХП если изменился
+    if (data.hp !== view.hp || data.max_hp !== view.max_hp) {
+        debugLog('💚 ХП меняется:', view.hp, '→', data.hp);
+        renderHp(data.hp, data.max_hp);
+        view.hp = data.hp;
+        view.max_hp = data.max_hp;
+    }
+
+    if (data.monster !== view.monster) {
+        document.getElementById('monsterName').textContent = data.monster;
+        view.monster = data.monster;
+    }
+    if (data.image !== view.image) {
+        document.getElementById('monsterImage').src = sizedImage(data.image);
+        view.image = data.image;
+    }
+
+    // Медиа текущей и следующей стадии - заранее, пока идёт бой
+    schedulePreload(data.level);
+}
+
+// ===== Кадры: состояние и эффекты рисуются в одном requestAnimationFrame =====
+let frameQueued = false;
+
+function requestFrame() {
+    if (frameQueued) return;
+    frameQueued = true;
+    requestAnimationFrame(frame);
+}
+
+function frame(now) {
+    frameQueued = false;
+    const started = performance.now();
+
+    if (pendingState) {
+        const data = pendingState;
+        pendingState = null;
+        renderState(data);
+    }
+    if (effects.active) {
+        effects.step(now);
+        if (effects.active) requestFrame();
+    }
+
+    if (DEBUG) frameStats.record(now, performance.now() - started, frameQueued);
+}
+
+// Отладка: сколько длится наша работа в кадре и сколько кадров пропало
+// между подряд идущими кадрами анимации. Сводка - раз в 2 сек или когда
+// анимация закончилась
+const frameStats = {
+    frames: 0,
+    total: 0,
+    worst: 0,
+    dropped: 0,
+    since: 0,
+    chained: false,
+    previous: 0,
+
+    record(now, work, continues) {
+        if (!this.frames) this.since = now;
+        this.frames++;
+        this.total += work;
+        this.worst = Math.max(this.worst, work);
+        if (this.chained) {
+            this.dropped += Math.max(0, Math.round((now - this.previous) / (1000 / 60)) - 1);
+        }
+        this.chained = continues;
+        this.previous = now;
+
+        if (!continues || now - this.since >= 2000) {
+            console.log(`🎞️ Кадры: ${this.frames}, работа в среднем ${(this.total / this.frames).toFixed(2)} мс, `
+                + `максимум ${this.worst.toFixed(2)} мс, пропущено кадров: ${this.dropped}, частиц: ${effects.active}`);
+            this.frames = this.total = this.worst = this.dropped = 0;
+        }
+    }
+};
+
+// Картинка монстра 200px: просим у сервера копию под экран
+function sizedImage(url) {
+    return url + '?w=' + Math.round(200 * (window.devicePixelRatio || 1));
+}
+
+// ===== Фоновая предзагрузка медиа =====
+const preloaded = {};  // url -> url картинки (она в кэше браузера) или blob-URL видео
+let preloadQueue = [];
+let preloadRunning = false;
+let preloadLevel = null;
+
+async function schedulePreload(level) {
+    if (preloadLevel === level) return;
+    preloadLevel = level;
+
+    try {
+        const response = await fetch('api/assets');
+        const assets = await response.json();
+        assets.current.image.url = sizedImage(assets.current.image.url);
+        assets.next.image.url = sizedImage(assets.next.image.url);
+        for (const asset of [assets.current.image, assets.video, assets.next.image]) {
+            if (asset.url in preloaded || preloadQueue.some(queued => queued.url === asset.url)) continue;
+            preloadQueue.push(asset);
+        }
+        if (!preloadRunning) runPreloadQueue(assets.prefetch_window_ms);
+    } catch (error) {
+        console.error('❌ Assets error:', error);
+    }
+}
+
+async function runPreloadQueue(windowMs) {
+    preloadRunning = true;
+    // Случайная задержка: 30 учеников не начинают качать одновременно
+    await new Promise(resolve => setTimeout(resolve, Math.random() * windowMs));
+
+    // По одному файлу за раз, с низким приоритетом
+    while (preloadQueue.length) {
+        const asset = preloadQueue.shift();
+        try {
+            const response = await fetch(asset.url, { priority: 'low' });
+            if (!response.ok) throw new Error('HTTP ' + response.status);
+            const blob = await response.blob();
+            preloaded[asset.url] = blob.type.startsWith('video/') ? URL.createObjectURL(blob) : asset.url;
+            console.log('📦 Предзагружено:', asset.url, asset.size, 'байт');
+        } catch (error) {
+            console.error('❌ Preload error:', asset.url, error);
+        }
+    }
+    preloadRunning = false;
+}
+
+// ===== Push-поток (SSE) с запасным long-poll =====
+let pollActive = false;
+let streamWatchdog = null;
+
+// Long-poll: сервер держит запрос, пока версия не изменится (или 25 сек).
+// Если у сервера нет свободных мест для ожидания (503), 30 сек опрашиваем
+// раз в секунду без ожидания
+async function startPolling() {
+    if (pollActive) return;
+    pollActive = true;
+    console.log('⏱️ Переходим на long-poll');
+    let longPollAfter = 0;
+
+    while (pollActive) {
+        const wait = Date.now() < longPollAfter ? 0 : 25;
+        try {
+            const data = await fetchDelta(wait);
+            if (data) {
+                applyState(data);
+                refreshLeaderboard(data.version);
+            }
+            if (!wait) await new Promise(resolve => setTimeout(resolve, 1000));
+        } catch (error) {
+            if (error.status === 503) {
+                console.warn('⚠️ Сервер занят, опрос раз в секунду');
+                longPollAfter = Date.now() + 30000;
+                continue;
+            }
+            console.error('❌ Long-poll error:', error);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+}
+
+function stopPolling() {
+    pollActive = false;
+}
+
+function connectStream() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource('api/game/stream');
+
+    // Если прокси буферизует поток, даже пинги не доходят - уходим на опрос
+    const resetWatchdog = () => {
+        clearTimeout(streamWatchdog);
+        streamWatchdog = setTimeout(() => {
+            console.warn('⚠️ SSE молчит, переходим на опрос');
+            source.close();
+            startPolling();
+            setTimeout(connectStream, 30000);
+        }, 40000);
+    };
+
+    // Соединение может зависнуть и до onopen (сервер перегружен)
+    resetWatchdog();
+
+    source.onopen = () => {
+        console.log('📡 SSE подключен');
+        stopPolling();
+        resetWatchdog();
+    };
+    source.addEventListener('state', (event) => {
+        resetWatchdog();
+        const data = JSON.parse(event.data);
+        syncGeneration = data.g;
+        applyState(data);
+    });
+    source.addEventListener('leaderboard', (event) => applyLeaderboardDelta(JSON.parse(event.data)));
+    source.addEventListener('ping', resetWatchdog);
+    source.onerror = () => {
+        // Пока браузер переподключается, не теряем обновления
+        startPolling();
+        if (source.readyState === EventSource.CLOSED) {
+            clearTimeout(streamWatchdog);
+            setTimeout(connectStream, 30000);
+        }
+    };
+}
+
+// ===== Топ учеников: SSE присылает только изменившиеся места =====
+let leaderboard = [];
+let leaderboardVersion = -1;
+
+function applyLeaderboardDelta(delta) {
+    for (const [rank, student, damage] of delta.set) {
+        leaderboard[rank] = { student, damage };
+    }
+    leaderboard.length = delta.size;
+    leaderboardVersion = delta.version;
+    renderLeaderboard();
+}
+
+// Без SSE топ перечитывается целиком, когда меняется версия состояния
+async function refreshLeaderboard(version) {
+    if (version === leaderboardVersion) return;
+    try {
+        const response = await fetch('api/leaderboard');
+        const data = await response.json();
+        leaderboard = data.top;
+        leaderboardVersion = data.version;
+        renderLeaderboard();
+    } catch (error) {
+        console.error('❌ Leaderboard error:', error);
+    }
+}
+
+function renderLeaderboard() {
+    const list = document.getElementById('leaderboard');
+    list.replaceChildren(...leaderboard.map((entry) => {
+        const item = document.createElement('li');
+        item.textContent = `${entry.student} - ${entry.damage} урона`;
+        return item;
+    }));
+}
+
+function updateBackground(backgroundData) {
+    const body = document.body;
+
+    // Удалить все классы фона
+    body.classList.remove('bg-ocean-deep', 'bg-ocean-mid', 'bg-ocean-shallow', 'bg-volcano');
+
+    // Добавить новый класс
+    const bgClassName = 'bg-' + backgroundData.name.replace(/_/g, '-');
+    body.classList.add(bgClassName);
+
+    console.log('✅ Фон применен:', bgClassName);
+
+    if (backgroundData.water_effect) {
+        createWaterParticles(backgroundData.particle_color);
+    }
+}
+
+function createWaterParticles(color) {
+    // 5 капель с интервалом 200мс, падают 3-5 сек
+    for (let i = 0; i < 5; i++) {
+        effects.spawn({
+            delay: i * 200,
+            life: 3000 + Math.random() * 2000,
+            size: Math.random() * 20 + 10,
+            drift: Math.random() * 100 - 50,
+            alpha: 0.5,
+            color
+        });
+    }
+}
+
+// Полоса ХП плавно меняет ширину сама (transition в student.css)
+function renderHp(hp, max) {
+    document.getElementById('hpBar').style.width = (hp / max) * 100 + '%';
+    document.getElementById('hpText').textContent = hp + '/' + max + ' HP';
+}
+
+async function showLevelUpAnimation(data) {
+    console.log('🎬 Показываем видео...');
+
+    try {
+        const videoOverlay = document.getElementById('videoOverlay');
+        const videoElement = document.getElementById('levelUpVideo');
+
+        // Показать видео
+        videoOverlay.classList.add('show');
+        console.log('✅ Видео-overlay показан');
+
+        // Видео из предзагрузки (уже в памяти), иначе - с сервера
+        const videoUrl = data.level_up_video || '/media/next_level.mp4';
+        const videoSrc = preloaded[videoUrl] || videoUrl;
+        videoElement.src = videoSrc;
+
+        // Попробовать воспроизвести
+        const playPromise = videoElement.play();
+        if (playPromise !== undefined) {
+            playPromise.then(() => {
+                console.log('✅ Видео воспроизводится');
+            }).catch(error => {
+                console.error('❌ Ошибка воспроизведения:', error);
+            });
+        }
+
+        // Confetti!
+        createConfetti();
+
+        // Закрыть после завершения видео
+        videoElement.onended = () => {
+            console.log('✅ Видео закончилось');
+            videoOverlay.classList.remove('show');
+        };
+
+        // Или закрыть через 8 сек макс
+        setTimeout(() => {
+            videoOverlay.classList.remove('show');
+            console.log('⏱️ Видео закрыто (timeout)');
+        }, 8000);
+
+    } catch (error) {
+        console.error('❌ Ошибка видео:', error);
+    }
+}
+
+function createConfetti() {
+    console.log('🎉 Confetti!');
+    const colors = ['#ffeb3b', '#ff9800', '#32b8c6', '#4caf50'];
+    for (let i = 0; i < 50; i++) {
+        effects.spawn({
+            delay: i * 20,
+            life: 3000,
+            size: Math.random() * 10 + 5,
+            drift: 0,
+            alpha: 1,
+            color: colors[Math.floor(Math.random() * colors.length)]
+        });
+    }
+}
+
+// ===== Слой эффектов: один canvas и пул частиц фиксированного размера =====
+// Конфетти и капли не создают элементы DOM: частицы - записи в заранее
+// выделенном массиве, а рисуются кругами на одном canvas поверх страницы.
+// Когда пул полон, новые частицы не добавляются
+const MAX_PARTICLES = 120;
+
+const effects = {
+    pool: Array.from({ length: MAX_PARTICLES }, () => ({
+        start: 0, life: 0, x: 0, size: 0, drift: 0, alpha: 0, color: ''
+    })),
+    active: 0,
+    canvas: null,
+    context: null,
+
+    spawn(options) {
+        if (this.active === MAX_PARTICLES) return;
+        if (!this.canvas) this.attach();
+
+        const particle = this.pool[this.active++];
+        particle.start = performance.now() + options.delay;
+        particle.life = options.life;
+        particle.x = Math.random() * this.canvas.width;
+        particle.size = options.size;
+        particle.drift = options.drift;
+        particle.alpha = options.alpha;
+        particle.color = options.color;
+        requestFrame();
+    },
+
+    attach() {
+        this.canvas = document.createElement('canvas');
+        this.canvas.className = 'effects-layer';
+        document.body.appendChild(this.canvas);
+        this.context = this.canvas.getContext('2d');
+        this.resize();
+        window.addEventListener('resize', () => this.resize());
+    },
+
+    // Canvas в CSS-пикселях без учёта devicePixelRatio: размытость кругов
+    // не видна, а на слабых экранах заливать в 4 раза меньше пикселей
+    resize() {
+        this.canvas.width = window.innerWidth;
+        this.canvas.height = window.innerHeight;
+    },
+
+    step(now) {
+        const ctx = this.context;
+        const height = this.canvas.height;
+        ctx.clearRect(0, 0, this.canvas.width, height);
+
+        let i = 0;
+        while (i < this.active) {
+            const particle = this.pool[i];
+            const t = (now - particle.start) / particle.life;
+            if (t >= 1) {
+                // Умершая частица меняется местами с последней живой
+                this.pool[i] = this.pool[--this.active];
+                this.pool[this.active] = particle;
+                continue;
+            }
+            i++;
+            if (t < 0) continue;
+
+            // Падение сверху на высоту окна с затуханием
+            const radius = particle.size / 2;
+            ctx.globalAlpha = particle.alpha * (1 - t);
+            ctx.fillStyle = particle.color;
+            ctx.beginPath();
+            ctx.arc(particle.x + particle.drift * t, -radius + (height + radius) * t, radius, 0, Math.PI * 2);
+            ctx.fill();
+        }
+        ctx.globalAlpha = 1;
+    }
+};
+
+// Первая загрузка, дальше обновления приходят через SSE
+console.log('🚀 Загружаем первый раз...');
+syncWithServer();
+connectStream();
+
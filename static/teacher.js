@@ -0,0 +1,391 @@
+let debugLog = [];
+
+function addDebug(msg) {
+    debugLog.push('[' + new Date().toLocaleTimeString() + '] ' + msg);
+    if (debugLog.length > 10) debugLog.shift();
+    document.getElementById('debugInfo').textContent = debugLog.join('\n');
+}
+
+async function updateBossStatus() {
+    try {
+        const response = await fetch('api/game');
+        const data = await response.json();
+        renderBossStatus(data);
+        refreshLeaderboard(data.version);
+    } catch (error) {
+        addDebug('❌ Status error: ' + error.message);
+    }
+}
+
+function renderBossStatus(data) {
+    // Имя и эмодзи монстра приходят из файлов кампаний - только как текст
+    const info = document.getElementById('bossInfo');
+    const title = document.createElement('strong');
+    title.textContent = `${data.emoji} ${data.monster}`;
+    info.replaceChildren(
+        title, document.createElement('br'),
+        `Уровень: ${data.level}`, document.createElement('br'),
+        `ХП: ${data.hp}/${data.max_hp}`
+    );
+    // Список переключаем, только когда кампания комнаты сменилась
+    if (data.campaign && data.campaign !== currentCampaign) {
+        currentCampaign = data.campaign;
+        campaignSelect.value = data.campaign;
+    }
+    addDebug(`Status: L${data.level} ${data.monster} ${data.hp}/${data.max_hp}HP`);
+    scheduleHistory();
+}
+
+// График ХП: сжатая история с сервера, дальше - только новые записи
+const HISTORY_POINTS = 300;
+let hpHistory = null;
+let historyTimer = null;
+
+async function loadHistory(full) {
+    // Курсор - версия последней точки: она не сбрасывается при выгрузке
+    // комнаты и одна у всех процессов сервера
+    const since = !full && hpHistory && hpHistory.version.length ? hpHistory.version[hpHistory.version.length - 1] : null;
+    try {
+        const response = await fetch('api/history?points=' + HISTORY_POINTS + (since !== null ? '&since=' + since : ''));
+        const data = await response.json();
+        if (since === null || !hpHistory) {
+            hpHistory = data;
+        } else {
+            for (const key of ['version', 't', 'level', 'hp', 'max_hp']) hpHistory[key].push(...data[key]);
+            hpHistory.total = data.total;
+        }
+        // Долгий урок: вместо роста без конца - снова сжатая история
+        if (hpHistory.t.length > 2 * HISTORY_POINTS) return loadHistory(true);
+        drawHistory();
+    } catch (error) {
+        addDebug('❌ History error: ' + error.message);
+    }
+}
+
+// При частых изменениях - не чаще раза в секунду
+function scheduleHistory() {
+    if (historyTimer) return;
+    historyTimer = setTimeout(() => {
+        historyTimer = null;
+        loadHistory(false);
+    }, 1000);
+}
+
+function drawHistory() {
+    const canvas = document.getElementById('hpChart');
+    const ctx = canvas.getContext('2d');
+    const { t, hp, max_hp: maxHp, level } = hpHistory;
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    if (!t.length) return;
+
+    const pad = 10;
+    const span = Math.max(t[t.length - 1] - t[0], 1);
+    const x = (i) => pad + (t[i] - t[0]) / span * (canvas.width - 2 * pad);
+    const y = (i) => canvas.height - pad - (maxHp[i] ? hp[i] / maxHp[i] : 0) * (canvas.height - 2 * pad);
+
+    // Смена уровня - вертикальная черта с номером
+    ctx.strokeStyle = '#bbb';
+    ctx.fillStyle = '#666';
+    ctx.font = '11px sans-serif';
+    for (let i = 1; i < t.length; i++) {
+        if (level[i] === level[i - 1]) continue;
+        ctx.beginPath();
+        ctx.moveTo(x(i), pad);
+        ctx.lineTo(x(i), canvas.height - pad);
+        ctx.stroke();
+        ctx.fillText('L' + level[i], x(i) + 3, pad + 10);
+    }
+
+    // ХП в долях от максимума: у боссов разных уровней разный max_hp
+    ctx.strokeStyle = '#f44336';
+    ctx.lineWidth = 2;
+    ctx.beginPath();
+    ctx.moveTo(x(0), y(0));
+    for (let i = 1; i < t.length; i++) ctx.lineTo(x(i), y(i));
+    ctx.stroke();
+    ctx.lineWidth = 1;
+}
+
+const campaignSelect = document.getElementById('campaignSelect');
+let currentCampaign = null;
+
+// Каталог перечитывается на сервере на лету, поэтому список обновляется
+// раз в полминуты; выбранный, но ещё не начатый вариант сохраняется
+async function loadCampaigns() {
+    try {
+        const response = await fetch('api/campaigns');
+        const data = await response.json();
+        const selected = campaignSelect.value;
+        campaignSelect.replaceChildren(...data.campaigns.map((campaign) => {
+            const option = document.createElement('option');
+            option.value = campaign.id;
+            option.textContent = `${campaign.title || campaign.id} (стадий: ${campaign.stages})`;
+            return option;
+        }));
+        campaignSelect.value = selected || data.current;
+        if (!campaignSelect.value) campaignSelect.value = data.current;
+    } catch (error) {
+        addDebug('❌ Campaigns error: ' + error.message);
+    }
+}
+
+async function startCampaign() {
+    const campaign = campaignSelect.value;
+    if (!campaign || !confirm('Начать кампанию с уровня 1? Текущий уровень будет потерян.')) return;
+
+    try {
+        const response = await fetch('api/campaign', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ campaign })
+        });
+        const data = await response.json();
+
+        if (data.success) {
+            showStatus(`✅ Кампания «${campaign}»: стадий ${data.stages}, босс ${data.state.emoji} ${data.state.monster}`, 'success');
+            addDebug(`Campaign: ${campaign}`);
+            renderBossStatus(data.state);
+        } else {
+            showStatus('❌ Ошибка: ' + data.error, 'error');
+            addDebug(`❌ Campaign failed: ${data.error}`);
+        }
+    } catch (error) {
+        addDebug('❌ Campaign error: ' + error);
+        showStatus('❌ Ошибка: ' + error, 'error');
+    }
+}
+
+let pollTimer = null;
+
+function startPolling() {
+    if (pollTimer) return;
+    pollTimer = setInterval(updateBossStatus, 500);
+}
+
+function connectStream() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource('api/game/stream');
+    // Пока поток не открылся, статус обновляет опрос
+    const openTimer = setTimeout(startPolling, 10000);
+    source.onopen = () => {
+        clearTimeout(openTimer);
+        addDebug('📡 SSE подключен');
+        clearInterval(pollTimer);
+        pollTimer = null;
+    };
+    source.addEventListener('state', (event) => renderBossStatus(JSON.parse(event.data)));
+    source.addEventListener('leaderboard', (event) => applyLeaderboardDelta(JSON.parse(event.data)));
+    source.onerror = () => {
+        startPolling();
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(connectStream, 30000);
+        }
+    };
+}
+
+let leaderboard = [];
+let leaderboardVersion = -1;
+
+// SSE присылает только изменившиеся места: [[место, ученик, урон], ...]
+function applyLeaderboardDelta(delta) {
+    for (const [rank, student, damage] of delta.set) {
+        leaderboard[rank] = { student, damage };
+    }
+    leaderboard.length = delta.size;
+    leaderboardVersion = delta.version;
+    renderLeaderboard();
+}
+
+async function refreshLeaderboard(version) {
+    if (version === leaderboardVersion) return;
+    try {
+        const response = await fetch('api/leaderboard');
+        const data = await response.json();
+        leaderboard = data.top;
+        leaderboardVersion = data.version;
+        renderLeaderboard();
+    } catch (error) {
+        addDebug('❌ Leaderboard error: ' + error.message);
+    }
+}
+
+function renderLeaderboard() {
+    document.getElementById('leaderboard').replaceChildren(...leaderboard.map((entry) => {
+        const item = document.createElement('li');
+        item.textContent = `${entry.student}: ${entry.damage} урона`;
+        return item;
+    }));
+}
+
+async function awardPoints() {
+    const points = parseInt(document.getElementById('pointsInput').value);
+
+    if (points <= 0) {
+        showStatus('❌ Введите положительное число', 'error');
+        return;
+    }
+
+    try {
+        const response = await fetch('api/award-points', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ amount: points })
+        });
+
+        const data = await response.json();
+
+        if (data.success) {
+            showStatus(`✅ ${points} баллов! Урон: ${data.damage}HP. Осталось: ${data.new_hp}/${data.max_hp}HP`, 'success');
+            addDebug(`Award: +${points} баллов, ${data.damage} урона`);
+
+            if (data.boss_dead) {
+                showStatus('☠️ БОСС УБИТ! Нажмите УРОВЕНЬ +1', 'success');
+                addDebug('Boss defeated!');
+            }
+
+            updateBossStatus();
+        }
+    } catch (error) {
+        showStatus('❌ Ошибка: ' + error, 'error');
+        addDebug('❌ Award error: ' + error);
+    }
+}
+
+function parseClassPoints(text) {
+    const rows = [];
+    for (const line of text.split('\n')) {
+        const match = line.trim().match(/^(.*?)[\s:;,=-]*(\d+)$/);
+        if (match && parseInt(match[2]) > 0) {
+            rows.push({ name: match[1], points: parseInt(match[2]) });
+        }
+    }
+    return rows;
+}
+
+async function awardClass() {
+    const rows = parseClassPoints(document.getElementById('classPoints').value);
+    if (!rows.length) {
+        showStatus('❌ Впишите строки вида «Маша 120»', 'error');
+        return;
+    }
+
+    try {
+        // Весь класс - один запрос и одно изменение состояния
+        const response = await fetch('api/commands', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ commands: rows.map((row) => ({ op: 'award', amount: row.points, student: row.name || undefined })) })
+        });
+        const data = await response.json();
+
+        if (!data.success) {
+            showStatus('❌ Ошибка: ' + data.error, 'error');
+            addDebug(`❌ Commands failed: ${data.error}`);
+            return;
+        }
+
+        const list = document.getElementById('classResults');
+        list.replaceChildren(...rows.map((row, i) => {
+            const item = document.createElement('li');
+            const result = data.results[i];
+            item.textContent = row.name
+                ? `${row.name}: +${row.points} баллов, урон ${result.damage}HP (всего ${result.total})`
+                : `+${row.points} баллов, урон ${result.damage}HP`;
+            return item;
+        }));
+        const total = data.results.reduce((sum, result) => sum + result.damage, 0);
+        showStatus(`✅ Учеников: ${rows.length}, общий урон: ${total}HP. Осталось: ${data.state.hp}/${data.state.max_hp}HP`, 'success');
+        addDebug(`Commands: ${rows.length} award, ${total} урона`);
+        if (data.state.hp <= 0) {
+            showStatus('☠️ БОСС УБИТ! Нажмите УРОВЕНЬ +1', 'success');
+        }
+        renderBossStatus(data.state);
+    } catch (error) {
+        showStatus('❌ Ошибка: ' + error, 'error');
+        addDebug('❌ Commands error: ' + error);
+    }
+}
+
+async function levelUp() {
+    try {
+        addDebug('Requesting level-up...');
+        const response = await fetch('api/level-up', { method: 'POST' });
+        const data = await response.json();
+
+        if (data.success) {
+            addDebug(`✅ Level up: ${data.old_level} → ${data.new_level}`);
+            showStatus(`✅ УРОВЕНЬ ${data.new_level}!
+🎮 Новый босс: ${data.emoji} ${data.new_boss}`, 'success');
+            updateBossStatus();
+        } else {
+            addDebug(`❌ Level-up failed: ${data.error}`);
+            showStatus('❌ Ошибка: ' + data.error, 'error');
+        }
+    } catch (error) {
+        addDebug('❌ Level-up error: ' + error);
+        showStatus('❌ Ошибка: ' + error, 'error');
+    }
+}
+
+async function resetGame() {
+    if (!confirm('Вы уверены? Это сбросит всё!')) return;
+
+    try {
+        const response = await fetch('api/reset', { method: 'POST' });
+        const data = await response.json();
+
+        if (data.success) {
+            showStatus('✅ Игра сброшена', 'success');
+            addDebug('Game reset');
+            updateBossStatus();
+        }
+    } catch (error) {
+        addDebug('❌ Reset error: ' + error);
+        showStatus('❌ Ошибка: ' + error, 'error');
+    }
+}
+
+let logSeq = 0;
+const LOG_LINES = 200;
+
+async function updateServerLog() {
+    try {
+        const response = await fetch('api/logs?since=' + logSeq);
+        const data = await response.json();
+        logSeq = data.last_seq;
+        if (!data.items.length) return;
+
+        const box = document.getElementById('serverLog');
+        const atBottom = box.scrollTop + box.clientHeight >= box.scrollHeight - 5;
+        for (const item of data.items) {
+            const line = document.createElement('div');
+            line.className = item.level.toLowerCase();
+            line.textContent = new Date(item.t * 1000).toLocaleTimeString() + ' ' + item.message;
+            box.appendChild(line);
+        }
+        while (box.childElementCount > LOG_LINES) box.firstChild.remove();
+        if (atBottom) box.scrollTop = box.scrollHeight;
+    } catch (error) {
+        addDebug('❌ Log error: ' + error.message);
+    }
+}
+
+function showStatus(message, type) {
+    const elem = document.getElementById('statusMessage');
+    elem.textContent = message;
+    elem.className = 'status show ' + type;
+    setTimeout(() => { elem.classList.remove('show'); }, 4000);
+}
+
+loadCampaigns();
+setInterval(loadCampaigns, 30000);
+loadHistory(true);
+updateBossStatus();
+connectStream();
+updateServerLog();
+setInterval(updateServerLog, 3000);
+